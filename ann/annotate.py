@@ -10,7 +10,11 @@
 ##
 __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
+import itertools
 import file_utils as fu
+import dbpool
+import sources as src
+import genes as gs
 import utils as u
 
 indicesKnownGenes=[12, 1, 3] #12 for gene
@@ -107,1023 +111,875 @@ def getComplementary(nuc):
         return compNuc
 
 
-""""Format must be pileup or vcf
-    Types of variants in dbSNP135: DIV, SNV, MNV, MIXED
-""" 
-def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1',
-    varclass='SNV', sep='\t'):
-    
-    outfile = vcf + tmpextout
-    fh_out = open(outfile, "w")
-    logcountfile = vcf + '.count.log'
-    fh_log = open(logcountfile, 'w')
-    var_count = 0
+"""A VCF (or pileup) data line split into fields
+   Chromosome, position and alleles are parsed once and shared by every
+   stage; stages annotate the record in place by editing its fields
+"""
+class Variant(object):
+    def __init__(self, line, inds, sep='\t'):
+        self.line = line
+        self.sep = sep
+        self.inds = inds
+        self.fields = line.split(sep)
+        self.chr = self.fields[inds[0]].strip()
+        self.pos = self.fields[inds[1]].strip()
+        self.joiner = None
+
+    @property
+    def ref(self):
+        return self.fields[self.inds[2]].strip()
+
+    @property
+    def alt(self):
+        return self.fields[self.inds[3]].strip()
+
+    """Chromosome without the "chr" prefix, e.g. for dbSNP and gadAll
+    """
+    def chrNoPrefix(self):
+        if self.chr.startswith("chr"):
+            return self.chr.replace('chr', '')
+        return self.chr
+
+    """Chromosome with the "chr" prefix, e.g. for the UCSC tables
+    """
+    def chrWithPrefix(self):
+        if not self.chr.startswith("chr"):
+            return "chr" + self.chr
+        return self.chr
+
+    """Marks the fields as rewritten; joiner is the separator the stage
+       would have used when writing its output line
+    """
+    def touch(self, joiner='\t'):
+        self.joiner = joiner
+
+    def text(self):
+        if self.joiner is None:
+            return self.line
+        return self.joiner.join([str(x) for x in self.fields])
+
+    """Re-reads the record the way the next stage would read it back
+       from an intermediate file, so output stays byte-identical to the
+       file-per-stage chain
+    """
+    def normalize(self):
+        if self.joiner is not None:
+            self.line = self.text().strip()
+            self.fields = self.line.split(self.sep)
+            self.joiner = None
+
+
+"""Base class for annotation stages
+   A stage looks up reference tables for a variant through its source
+   and edits the record's fields; counters are written to the .count.log
+   at the end. Without a source, tables are read from the backends set
+   in ann_config.ini
+"""
+class Stage(object):
+    label = None
+    # Attributes written to the log, summed when shards are merged
+    counters = ()
 
-    inds = getFormatSpecificIndices(format=format)
+    def __init__(self, table=None, source=None):
+        self.table = table
+        self.source = source if (source is not None) else src.configured()
 
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            if chr.startswith("chr"):
-                chr = chr.replace('chr', '')
-
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-
-            compRef = getComplementary(ref)
-            compAlt = getComplementary(alt)
-
-            sql = 'select * from dbSNP where CHR="' + str(chr) + \
-                '" AND POS=' + str(pos) + ' AND ( REF="' + str(ref) + \
-                '" OR REF ="' + str(compRef) + '" )  AND INFO = "' + \
-                varclass + '" ;'
-            cursor.execute(sql)
-            rows = cursor.fetchall()
-
-            fields[2] = '.'
-            rsids = []
-            mafs = []
-            if (len(rows) > 0):
-                for row in rows:
-                    rsids.append(str(row[3]))
-                    if (str(row[7]) != '.'):
-                        mafs.append('GMAF=' + str(row[7]))
+    def open(self):
+        self.source.open()
 
-                maf_str=''
-                if (len(mafs) > 0):
-                    maf_str = ';' + ';'.join([str(x) for x in mafs])
+    """Lines passed through untouched by this stage
+    """
+    def isHeader(self, line):
+        return line.startswith("##") or line.startswith('CHROM') or \
+            line.startswith('#CHROM')
 
-                var_count = var_count + 1
-                if (str(fields[7]) == '.'):
-                    fields[7] = 'DB' + maf_str
-                else:
-                    fields[7] = fields[7] + ';DB;VC=' + varclass + maf_str
+    """Called with all the variants of a block before they are annotated
+    """
+    def prefetch(self, variants):
+        pass
 
-                fields[2] = str(';'.join(rsids))
-                l = '\t'.join([str(x) for x in fields])
-                fh_out.write(l + '\n')
+    def annotate(self, variant):
+        raise NotImplementedError
 
-            else:
-                ## reset rsid to "." - in case there was annotation from old release of dbSNP
-                fh_out.write('\t'.join([str(x) for x in fields]) + '\n')
+    def writeLog(self, fh_log):
+        pass
 
-            linenum = linenum + 1
+    def counts(self):
+        return dict([(x, getattr(self, x)) for x in self.counters])
 
-        else:
-            fh_out.write(line + '\n')
+    """Adds the counters of a stage that annotated another part of the file
+    """
+    def addCounts(self, counts):
+        for x in self.counters:
+            setattr(self, x, getattr(self, x) + counts[x])
 
-    ratioInDbSnp = (var_count / float(linenum)) * 100
-    fh_log.write("## Please notice that all Isoforms were counted\n")
-    fh_log.write("## Numbers may exceed number of variants in the annotated file\n")
-    fh_log.write(f"Total: {str(linenum)}\n")
-    fh_log.write(f"In dbSNP: {str(var_count)} ({str(ratioInDbSnp)}%)\n")
-    fh_log.close()
+    """Releases anything the stage holds once the file is annotated
+    """
+    def close(self):
+        self.source.close()
 
-    conn.close()
-    fh.close()
-    fh_out.close()
 
-
-"""NOTE: all isoforms are collapsed in one record
-    1. chrom_pos_equal_base
-    2. chrom_pos_equal_nobase
-    3. chrom_pos_unequal
+"""Base class for the range overlap stages logging hits per variant
+   Rows overlapping a position are those with
+   chromStart <= pos <= chromEnd on the variant's chromosome
 """
-def getBigRefGene(vcf, format='vcf', tmpextin='.1', tmpextout='.2', sep='\t'):
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
-
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    vcf_linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            if chr.startswith("chr"):
-                chr = chr.replace('chr', '')
-
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-
-            compRef = getComplementary(ref)
-            compAlt = getComplementary(alt)
+class OverlapStage(Stage):
+    counters = ('var_count', 'line_count')
+    chromName = 'chrom'
+    startName = 'chromStart'
+    endName = 'chromEnd'
+    columns = '*'
+
+    def __init__(self, table=None, source=None):
+        Stage.__init__(self, table=table, source=source)
+        self.tracks = {}
+        self.stab_rows = {}
+        self.var_count = 0
+        self.line_count = 0
+
+    """Table holding the rows of a chromosome
+    """
+    def trackTable(self, chr):
+        return self.table
+
+    def track(self, chr):
+        table = self.trackTable(chr)
+        if table not in self.tracks:
+            self.tracks[table] = src.Track(table, chrom=self.chromName,
+                start=self.startName, end=self.endName, columns=self.columns,
+                name=self.table)
+        return self.tracks[table]
+
+    """Chromosome and position the stage looks a variant up at, or None
+       if it does not look it up
+    """
+    def stabQuery(self, variant):
+        return (variant.chrWithPrefix(), variant.pos)
+
+    """Looks up the rows of all the variants of a block together, a
+       window of positions per query on the SQL backends
+    """
+    def prefetch(self, variants):
+        queries = {}
+        for variant in variants:
+            query = self.stabQuery(variant)
+            if query is not None:
+                queries.setdefault(self.trackTable(query[0]), {})[query] = 1
+
+        self.stab_rows = {}
+        for table in queries:
+            keys = list(queries[table])
+            results = self.source.batch_stab(self.track(keys[0][0]), keys)
+            self.stab_rows.update(zip(keys, results))
+
+    """All rows overlapping the position
+    """
+    def stab(self, chr, pos):
+        if (chr, pos) in self.stab_rows:
+            return self.stab_rows[(chr, pos)]
+        return self.source.stab(self.track(chr), chr, pos)
+
+    """First row overlapping the position, or None
+    """
+    def stabFirst(self, chr, pos):
+        if (chr, pos) in self.stab_rows:
+            rows = self.stab_rows[(chr, pos)]
+            return rows[0] if (len(rows) > 0) else None
+        return self.source.stab_first(self.track(chr), chr, pos)
+
+    def writeLog(self, fh_log):
+        fh_log.write(f"In {str(self.table)}: {str(self.var_count)} in " + \
+            f"{str(self.line_count)} variants\n")
+
+
+"""Single-pass annotation engine
+   Parses each line once, runs every stage on the in-memory record and
+   writes one output file; replaces the chain of intermediate files.
+   Lines are processed in blocks so that stages can prefetch lookups for
+   a whole block before annotating it. Stages share the pooled database
+   connections, whose idle connections are closed at the end unless
+   close_connections is False
+"""
+def annotateVcf(infile, outfile, stages, logfile=None, logmode='a',
+    format='vcf', sep='\t', block_size=10000, close_connections=True):
 
-            sql1 = 'select * from chrom_pos_equal_base where CHR="' + \
-                str(chr) + '" AND start = ' + str(pos) + \
-                ' AND ((haplotypeReference="' + str(ref) + \
-                '" AND haplotypeAlternate ="' + str(alt) + \
-                '") OR (haplotypeReference="' + str(compRef) + \
-                '" AND haplotypeAlternate ="' + str(compAlt) + '"));'
+    inds = getFormatSpecificIndices(format=format)
+    for stage in stages:
+        stage.open()
 
-            sql2 = 'select * from chrom_pos_equal_nobase where CHR="' + \
-                str(chr) + '" AND start = ' + str(pos) + ';'
+    fh = open(infile)
+    fh_out = open(outfile, "w")
 
-            sql3 = 'select * from chrom_pos_unequal where CHR="' + \
-                str(chr) + '" AND start <= ' + str(pos) + ' AND ' + \
-                str(pos) + ' <= end ;'
+    while True:
+        lines = [line.strip() for line in itertools.islice(fh, block_size)]
+        if (len(lines) == 0):
+            break
+
+        records = [None] * len(lines)
+        for stage in stages:
+            variants = []
+            for i in range(0, len(lines)):
+                if stage.isHeader(lines[i]):
+                    continue
+                if records[i] is None:
+                    records[i] = Variant(lines[i], inds, sep=sep)
+                variants.append(records[i])
+
+            stage.prefetch(variants)
+            for variant in variants:
+                variant.normalize()
+                stage.annotate(variant)
+
+        for i in range(0, len(lines)):
+            if records[i] is None:
+                fh_out.write(lines[i] + '\n')
+            else:
+                fh_out.write(records[i].text() + '\n')
+
+    if logfile is not None:
+        fh_log = open(logfile, logmode)
+        for stage in stages:
+            stage.writeLog(fh_log)
+        fh_log.close()
+
+    for stage in stages:
+        stage.close()
+    if close_connections:
+        dbpool.closeAll()
+    fh.close()
+    fh_out.close()
 
-            keep_going = True
-            cursor.execute(sql1)
-            rows = cursor.fetchall()
 
-            if (len(rows) > 0):
-                keep_going = False
-                m = set([])
-                for row in rows:
-                    m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)] ])))
+""""Format must be pileup or vcf
+    Types of variants in dbSNP135: DIV, SNV, MNV, MIXED
+"""
+class DbSnpStage(Stage):
+    label = 'dbSNP'
+    counters = ('var_count', 'linenum')
+
+    def __init__(self, table='dbSNP', varclass='SNV', batched=False,
+        source=None):
+        Stage.__init__(self, table=table, source=source)
+        self.varclass = varclass
+        self.batched = batched
+        self.track = src.Track(table, chrom='CHR', pos='POS', ref='REF',
+            filters=[('INFO', varclass)])
+        self.batch_rows = {}
+        self.var_count = 0
+        self.linenum = 1
+
+    def isHeader(self, line):
+        return line.startswith("#")
+
+    """linenum starts at 1 in every part, so count that once
+    """
+    def addCounts(self, counts):
+        self.var_count = self.var_count + counts['var_count']
+        self.linenum = self.linenum + counts['linenum'] - 1
+
+    def lookupKey(self, variant):
+        ref = variant.ref
+        return (variant.chrNoPrefix(), int(variant.pos), ref,
+            getComplementary(ref))
+
+    """Batched mode: the whole block is looked up at once (one query per
+       chromosome on the database backends)
+    """
+    def prefetch(self, variants):
+        if not self.batched:
+            return
+
+        keys = [self.lookupKey(variant) for variant in variants]
+        results = self.source.batch_lookup(self.track,
+            [(chr, pos, (ref, compRef), None)
+            for chr, pos, ref, compRef in keys])
+        self.batch_rows = dict(zip(keys, results))
+
+    def annotate(self, variant):
+        chr = variant.chrNoPrefix()
+        ref = variant.ref
+        compRef = getComplementary(ref)
+
+        if self.batched:
+            rows = self.batch_rows[self.lookupKey(variant)]
+        else:
+            rows = self.source.point_lookup(self.track, chr, variant.pos,
+                ref=(ref, compRef))
+
+        fields = variant.fields
+        fields[2] = '.'
+        rsids = []
+        mafs = []
+        if (len(rows) > 0):
+            for row in rows:
+                rsids.append(str(row[3]))
+                if (str(row[7]) != '.'):
+                    mafs.append('GMAF=' + str(row[7]))
+
+            maf_str=''
+            if (len(mafs) > 0):
+                maf_str = ';' + ';'.join([str(x) for x in mafs])
+
+            self.var_count = self.var_count + 1
+            if (str(fields[7]) == '.'):
+                fields[7] = 'DB' + maf_str
+            else:
+                fields[7] = fields[7] + ';DB;VC=' + self.varclass + maf_str
 
-                fields[7] = fields[7] + ';' + ';'.join(m)
-                if (str(fields[7]).startswith(".;")):
-                    fields[7] = str(fields[7]).replace('.;', '', 1)
+            fields[2] = str(';'.join(rsids))
 
-                l = '\t'.join([str(x) for x in fields])
-                fh_out.write(l + '\n')
+        ## rsid is reset to "." - in case there was annotation from old release of dbSNP
+        variant.touch()
+        self.linenum = self.linenum + 1
 
-            if (keep_going):
-                cursor.execute(sql2)
-                rows = cursor.fetchall()
+    def writeLog(self, fh_log):
+        ratioInDbSnp = (self.var_count / float(self.linenum)) * 100
+        fh_log.write("## Please notice that all Isoforms were counted\n")
+        fh_log.write("## Numbers may exceed number of variants in the annotated file\n")
+        fh_log.write(f"Total: {str(self.linenum)}\n")
+        fh_log.write(f"In dbSNP: {str(self.var_count)} ({str(ratioInDbSnp)}%)\n")
 
-                if (len(rows) > 0):
-                    keep_going = False
-                    m = set([])
-                    for row in rows:
-                        m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)]])))
 
-                    fields[7] = fields[7] + ';' + ';'.join(m)
-                    if (str(fields[7]).startswith(".;")):
-                        fields[7] = str(fields[7]).replace('.;', '', 1)
-                    
-                    l = '\t'.join([str(x) for x in fields])
-                    fh_out.write(l + '\n')
+def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1',
+    varclass='SNV', sep='\t', batch_size=None, source=None):
 
-            if (keep_going):
-                cursor.execute(sql3)
-                rows = cursor.fetchall()
+    stage = DbSnpStage(varclass=varclass, batched=(batch_size is not None),
+        source=source)
+    annotateVcf(vcf, vcf + tmpextout, [stage], logfile=vcf + '.count.log',
+        logmode='w', format=format, sep=sep, block_size=(batch_size or 10000))
 
-                if (len(rows) > 0):
-                    keep_going = False
-                    m = set([])
-                    for row in rows:
-                        m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)]])))
 
-                    fields[7] = fields[7] + ';' + ';'.join(m)
-                    if (str(fields[7]).startswith(".;")):
-                        fields[7] = str(fields[7]).replace('.;', '', 1)
+"""NOTE: all isoforms are collapsed in one record
+    1. chrom_pos_equal_base
+    2. chrom_pos_equal_nobase
+    3. chrom_pos_unequal
+"""
+class BigRefGeneStage(Stage):
+    label = 'BigRefGene'
+
+    base = src.Track('chrom_pos_equal_base', chrom='CHR', pos='start',
+        ref='haplotypeReference', alt='haplotypeAlternate')
+    nobase = src.Track('chrom_pos_equal_nobase', chrom='CHR', pos='start')
+    unequal = src.Track('chrom_pos_unequal', chrom='CHR', start='start',
+        end='end')
+
+    def __init__(self, table=None, source=None):
+        Stage.__init__(self, table=table, source=source)
+        self.batch_rows = {}
+
+    def isHeader(self, line):
+        return line.startswith("#")
+
+    """Looks up the block's variants a table at a time: each table is
+       only queried for the variants the ones before it did not match
+    """
+    def prefetch(self, variants):
+        keys = list(dict.fromkeys([(variant.chrNoPrefix(), variant.pos,
+            variant.ref, variant.alt) for variant in variants
+            if variant.pos.isdigit()]))
+        results = self.source.batch_lookup(self.base,
+            [(chr, pos, (ref, getComplementary(ref)),
+            (alt, getComplementary(alt))) for chr, pos, ref, alt in keys])
+
+        missing = [i for i in range(0, len(keys)) if (len(results[i]) == 0)]
+        rows = self.source.batch_lookup(self.nobase,
+            [(keys[i][0], keys[i][1], None, None) for i in missing])
+        for i, found in zip(missing, rows):
+            results[i] = found
+
+        missing = [i for i in missing if (len(results[i]) == 0)]
+        rows = self.source.batch_stab(self.unequal,
+            [(keys[i][0], keys[i][1]) for i in missing])
+        for i, found in zip(missing, rows):
+            results[i] = found
+        self.batch_rows = dict(zip(keys, results))
+
+    """Rows of the first of the three tables with a match
+    """
+    def lookup(self, chr, pos, ref, alt):
+        compRef = getComplementary(ref)
+        compAlt = getComplementary(alt)
+
+        rows = self.source.point_lookup(self.base, chr, pos,
+            ref=(ref, compRef), alt=(alt, compAlt))
+        if (len(rows) == 0):
+            rows = self.source.point_lookup(self.nobase, chr, pos)
+        if (len(rows) == 0):
+            rows = self.source.stab(self.unequal, chr, pos)
+        return rows
+
+    def annotate(self, variant):
+        key = (variant.chrNoPrefix(), variant.pos, variant.ref, variant.alt)
+        if key in self.batch_rows:
+            rows = self.batch_rows[key]
+        else:
+            rows = self.lookup(*key)
 
-                    l = '\t'.join([str(x) for x in fields])
-                    fh_out.write(l + '\n')
+        if (len(rows) > 0):
+            fields = variant.fields
+            m = set([])
+            for row in rows:
+                m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)]])))
 
-            if (keep_going):
-                fh_out.write(line + '\n')
+            fields[7] = fields[7] + ';' + ';'.join(m)
+            if (str(fields[7]).startswith(".;")):
+                fields[7] = str(fields[7]).replace('.;', '', 1)
 
-            vcf_linenum = vcf_linenum + 1
+            variant.touch()
 
-        else:
-            fh_out.write(line + '\n')
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+def getBigRefGene(vcf, format='vcf', tmpextin='.1', tmpextout='.2', sep='\t',
+    source=None):
+    annotateVcf(vcf + tmpextin, vcf + tmpextout,
+        [BigRefGeneStage(source=source)], format=format, sep=sep)
 
 
 """Get information about location in gene structures
+   Every region of the transcripts and the CpG islands at a position
+   comes from one query of the table's gene structure (see genes.py)
 """
-def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500, 
-    tmpextin='.2', tmpextout='.3', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-
-    interGenic_count = 0
-    cds_count = 0
-    utr3_count = 0
-    utr5_count = 0
-    intronic_count = 0
-    non_coding_intronic_count = 0
-    exonic_count = 0
-    non_coding_exonic_count = 0
-    promoter_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
-
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-            info_field = clean_mysql_chars(fields[7]).strip()
-            this_gene_name = str(u.parse_field(info_field, 'name', ';', '='))
-
-            sql = 'select * from ' + table + ' where chrom="' + str(chr) + \
-                '" AND (txStart - ' + str(promoter_offset) +') <= ' + \
-                str(pos) + ' AND ' + str(pos) + ' <= (txEnd + ' + \
-                str(promoter_offset) +');'
-
-            cursor.execute(sql)
-            rows = cursor.fetchall()
-            info = []
-
-            if (len(rows) > 0):
-                cnt = 1
-                for row in rows:
-                    #count location
-                    positionType = str(u.parse_field(info_field, 
-                        'positionType', ';', '='))
-                    
-                    if (positionType == 'intron'):
-                        intronic_count = intronic_count + 1
-                    elif (positionType == 'non_coding_intron'):
-                        non_coding_intronic_count = non_coding_intronic_count + 1
-                    elif (positionType == 'CDS'):
-                        cds_count = cds_count + 1
-                    elif (positionType == 'non_coding_exon'):
-                        non_coding_exonic_count = non_coding_exonic_count + 1
-                    elif (positionType == 'utr5'):
-                        utr5_count = utr5_count + 1
-                    elif (positionType == 'utr3'):
-                        utr3_count = utr3_count + 1
-
-                    txtStart = int(row[4])
-                    txtEnd = int(row[5])
-                    cdsStart = int(row[6])
-                    cdsEnd = int(row[7])
-                    exonCount = int(row[8])
-                    exonStarts =str(row[9].decode("utf-8"))
-                    exonEnds = str(row[10].decode("utf-8"))
-                    geneSymbol = str(row[12])
-                    strand = str(row[3])
-
-                    promoter_plus = txtStart - int(promoter_offset)
-                    promoter_minus = txtEnd + int(promoter_offset)
-                    region = ""
-                    pos = int(pos)
-                    exons = []
-                    exonsSt = exonStarts.split(',')
-                    exonsEn = exonEnds.split(',')
-
-                    if (cdsStart == cdsEnd):
-                        for e in range(0, exonCount):
-                            if (u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e]))):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum = exonCount - e
-                                exons.append("non_coding_exon=" + "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                        if (len(exons) > 0):
-                            region = ";".join(exons)
-                    elif (u.isBetween(pos, cdsStart, cdsEnd)):
-                        for e in range(0, exonCount):
-                            if u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e])):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum = exonCount - e
-                                exons.append("exon=" +  "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                                exonic_count = exonic_count + 1
-                        if (len(exons) > 0):
-                            region = ";".join(exons)
-
-                    elif (u.isBetween(pos, promoter_plus, txtStart) and 
-                        (strand == "+")):
-                        sql = 'select chrom, chromStart, chromEnd, name from ' + \
-                            'cpgIslandExt where chrom="' + str(chr) + \
-                            '" AND (chromStart <= ' + str(pos) + \
-                            ' AND ' + str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
-
-                        if (rows is not None):
-                            region = 'putativePromoterRegion=' + \
-                                "".join(str(rows[3]).split())
-                            promoter_count = promoter_count + 1
-
-                    elif (u.isBetween(pos, txtEnd, promoter_minus) and (strand == "-")):
-                        sql = 'select chrom, chromStart, chromEnd, name from ' + \
-                            'cpgIslandExt where chrom="' + str(chr) + \
-                            '" AND (chromStart <= ' + str(pos) + \
-                            ' AND ' + str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-
-                        rows = cursor.fetchone()
-                        if (rows is not None):
-                            region = 'putativePromoterRegion=' +  \
-                                "".join(str(rows[3]).split())
-                            promoter_count = promoter_count + 1
-
-                    else:
-                        region = ''
-
-                    if (region != ''):
-                        info.append(collapseGeneNames(row=row, 
-                            indices=indicesKnownGenes, region=region, cnt=cnt))
-
-                    cnt = cnt + 1
-
-                str_info = ";".join(info)
-                fields[7] = fields[7] + ';' + str_info
-                fh_out.write('\t'.join(fields) + '\n')
-
-            else:
-                fields[7] = fields[7] + ";positionType=interGenic"
-                fh_out.write('\t'.join(fields) + '\n')
-                interGenic_count = interGenic_count + 1
-
-            linenum = linenum + 1
+class GenesStage(Stage):
+    label = 'BigRefGene'
+    counters = ('interGenic_count', 'cds_count', 'utr3_count', 'utr5_count',
+        'intronic_count', 'non_coding_intronic_count', 'exonic_count',
+        'non_coding_exonic_count', 'promoter_count')
+
+    cpgIslands = src.Track('cpgIslandExt',
+        columns='chrom, chromStart, chromEnd, name')
+
+    def __init__(self, table='refGene', promoter_offset=500, source=None):
+        Stage.__init__(self, table=table, source=source)
+        self.promoter_offset = promoter_offset
+        # Transcripts within promoter_offset of the position
+        self.track = src.Track(table, start='txStart', end='txEnd',
+            pad=int(promoter_offset))
+        self.genes = None
+        self.interGenic_count = 0
+        self.cds_count = 0
+        self.utr3_count = 0
+        self.utr5_count = 0
+        self.intronic_count = 0
+        self.non_coding_intronic_count = 0
+        self.exonic_count = 0
+        self.non_coding_exonic_count = 0
+        self.promoter_count = 0
+
+    def isHeader(self, line):
+        return line.startswith("#")
+
+    """Gene structure of the track, built once per process
+    """
+    def structure(self):
+        if self.genes is None:
+            self.genes = gs.get_structure(self.source, self.track,
+                self.cpgIslands, promoter_offset=self.promoter_offset)
+        return self.genes
+
+    """Counts the position type an earlier stage gave the variant
+    """
+    def countPositionType(self, info_field):
+        positionType = str(u.parse_field(info_field,
+            'positionType', ';', '='))
+
+        if (positionType == 'intron'):
+            self.intronic_count = self.intronic_count + 1
+        elif (positionType == 'non_coding_intron'):
+            self.non_coding_intronic_count = self.non_coding_intronic_count + 1
+        elif (positionType == 'CDS'):
+            self.cds_count = self.cds_count + 1
+        elif (positionType == 'non_coding_exon'):
+            self.non_coding_exonic_count = self.non_coding_exonic_count + 1
+        elif (positionType == 'utr5'):
+            self.utr5_count = self.utr5_count + 1
+        elif (positionType == 'utr3'):
+            self.utr3_count = self.utr3_count + 1
+
+    """Region of a transcript hit: the exons holding the position, or the
+       CpG island of a promoter
+    """
+    def region(self, hit, hits, pos):
+        region = ""
+        if not hit.model.isCoding():
+            exons = hit.exonLabels(pos, "non_coding_exon")
+            if (len(exons) > 0):
+                region = ";".join(exons)
+        elif hit.cds:
+            exons = hit.exonLabels(pos, "exon")
+            self.exonic_count = self.exonic_count + len(exons)
+            if (len(exons) > 0):
+                region = ";".join(exons)
+        elif hit.promoter:
+            island = hits.island()
+            if (island is not None):
+                region = 'putativePromoterRegion=' + \
+                    "".join(str(island).split())
+                self.promoter_count = self.promoter_count + 1
+        return region
+
+    def annotate(self, variant):
+        fields = variant.fields
+        chr = variant.chrWithPrefix()
+        pos = int(variant.pos)
+        info_field = clean_mysql_chars(fields[7]).strip()
+
+        hits = self.structure().stab(chr, pos)
+        info = []
+
+        if (len(hits.transcripts) > 0):
+            cnt = 1
+            for hit in hits.transcripts:
+                self.countPositionType(info_field)
+                region = self.region(hit, hits, pos)
+                if (region != ''):
+                    info.append(collapseGeneNames(row=hit.row,
+                        indices=indicesKnownGenes, region=region, cnt=cnt))
+                cnt = cnt + 1
+
+            str_info = ";".join(info)
+            fields[7] = fields[7] + ';' + str_info
 
         else:
-            fh_out.write(line + '\n')
+            fields[7] = fields[7] + ";positionType=interGenic"
+            self.interGenic_count = self.interGenic_count + 1
 
-    print("Variants located:")
-    fh_log.write("Variants located:\n")
+        variant.touch()
 
-    print(f"In interGenic {str(interGenic_count)}")
-    fh_log.write(f"In interGenic {str(interGenic_count)}\n")
+    def writeLog(self, fh_log):
+        print("Variants located:")
+        fh_log.write("Variants located:\n")
 
-    print(f"In CDS {str(cds_count)}")
-    fh_log.write(f"In CDS {str(cds_count)}\n")
+        print(f"In interGenic {str(self.interGenic_count)}")
+        fh_log.write(f"In interGenic {str(self.interGenic_count)}\n")
 
-    print(f"In \'3 UTR {str(utr3_count)}")
-    fh_log.write(f"In \'3 UTR {str(utr3_count)}\n")
+        print(f"In CDS {str(self.cds_count)}")
+        fh_log.write(f"In CDS {str(self.cds_count)}\n")
 
-    print(f"In \'5 UTR {str(utr5_count)}")
-    fh_log.write(f"In \'5 UTR {str(utr5_count)}\n")
+        print(f"In \'3 UTR {str(self.utr3_count)}")
+        fh_log.write(f"In \'3 UTR {str(self.utr3_count)}\n")
 
-    print(f"In Intronic {str(intronic_count)}")
-    fh_log.write(f"In Intronic {str(intronic_count)}\n")
+        print(f"In \'5 UTR {str(self.utr5_count)}")
+        fh_log.write(f"In \'5 UTR {str(self.utr5_count)}\n")
 
-    print(f"In Non_coding_intronic {str(non_coding_intronic_count)}")
-    fh_log.write(f"In Non_coding_intronic {str(non_coding_intronic_count)}\n")
+        print(f"In Intronic {str(self.intronic_count)}")
+        fh_log.write(f"In Intronic {str(self.intronic_count)}\n")
 
-    print(f"In Exonic {str(exonic_count)}")
-    fh_log.write(f"In Exonic {str(exonic_count)}\n")
+        print(f"In Non_coding_intronic {str(self.non_coding_intronic_count)}")
+        fh_log.write(f"In Non_coding_intronic {str(self.non_coding_intronic_count)}\n")
 
-    print(f"In Non_coding_exonic {str(non_coding_exonic_count)}")
-    fh_log.write(f"In Non_coding_exonic {str(non_coding_exonic_count)}\n")
+        print(f"In Exonic {str(self.exonic_count)}")
+        fh_log.write(f"In Exonic {str(self.exonic_count)}\n")
 
-    print(f"In Putative Promoter Region {str(promoter_count)}")
-    fh_log.write(f"In Putative Promoter Region {str(promoter_count)}\n")
+        print(f"In Non_coding_exonic {str(self.non_coding_exonic_count)}")
+        fh_log.write(f"In Non_coding_exonic {str(self.non_coding_exonic_count)}\n")
 
-    fh_out.close()
-    fh_log.close()
-    fh.close()
-    conn.close()
+        print(f"In Putative Promoter Region {str(self.promoter_count)}")
+        fh_log.write(f"In Putative Promoter Region {str(self.promoter_count)}\n")
 
 
-"""Method used in INDELS, where bigRefGeneTable is not applicable
-"""
-def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500, 
-    tmpextin='.2', tmpextout='.3', sep='\t'):
-
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
+def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500,
+    tmpextin='.2', tmpextout='.3', sep='\t', source=None):
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
+    annotateVcf(vcf + tmpextin, vcf + tmpextout,
+        [GenesStage(table=table, promoter_offset=promoter_offset,
+        source=source)],
+        logfile=vcf + '.count.log', format=format, sep=sep)
 
-    interGenic_count = 0
-    cds_count = 0
-    utr3_count = 0
-    utr5_count = 0
-    intronic_count = 0
-    non_coding_intronic_count = 0
-    exonic_count = 0
-    non_coding_exonic_count = 0
-    promoter_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
-            
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-            info_field = clean_mysql_chars(fields[7]).strip()
-            this_gene_name = str(u.parse_field(info_field, 'name', ';', '='))
-
-            sql = 'select * from ' + table + ' where chrom="' + str(chr) + \
-                '"   AND (txStart - ' + str(promoter_offset) + ') <= ' + \
-                str(pos) + ' AND ' + str(pos) + ' <= (txEnd + ' + \
-                str(promoter_offset) +');'
-            cursor.execute(sql)
-            rows = cursor.fetchall()
-            info = []
-            if (len(rows) > 0):
-                cnt = 1
-                for row in rows:
-                    txtStart = int(row[4])
-                    txtEnd = int(row[5])
-                    cdsStart = int(row[6])
-                    cdsEnd = int(row[7])
-                    exonCount = int(row[8])
-                    exonStarts =str(row[9].decode('utf-8'))
-                    exonEnds = str(row[10].decode('utf-8'))
-                    geneSymbol = str(row[12])
-                    strand = str(row[3])
-
-                    promoter_plus = txtStart - int(promoter_offset)
-                    promoter_minus = txtEnd + int(promoter_offset)
-                    region = ""
-                    pos = int(pos)
-                    exons = []
-                    exonsSt = exonStarts.split(',')
-                    exonsEn = exonEnds.split(',')
-
-                    if (cdsStart == cdsEnd):
-                        for e in range(0, exonCount):
-                            if (u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e]))):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum =  exonCount - e
-                                exons.append("non_coding_exon=" + "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                                non_coding_exonic_count = non_coding_exonic_count + 1
-                        if (len(exons) > 0):
-                            region='positionType=non_coding_exon;' + ";".join(exons)
-                        else:
-                            non_coding_intronic_count = non_coding_intronic_count + 1
-                            region = 'positionType=non_coding_intron'
-
-                    elif (u.isBetween(pos, cdsStart, cdsEnd) and (cdsStart < cdsEnd)):
-                        cds_count = cds_count + 1
-                        for e in range(0, exonCount):
-                            if (u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e]))):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum =  exonCount - e
-                                exons.append("exon=" + "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                                exonic_count=exonic_count+1
-                        if (len(exons) > 0):
-                            region = 'positionType=CDS;' + ";".join(exons)
-                        else:
-                            intronic_count = intronic_count + 1
-                            region = 'positionType=CDS;' + 'intron'
-
-                    elif (u.isBetween(pos, txtStart, cdsStart) and \
-                        (cdsStart < cdsEnd) and (strand == "+")):
-                        utr5_count = utr5_count + 1
-                        region = 'positionType=utr5'
-
-                    elif (u.isBetween(pos, cdsEnd, txtEnd) and \
-                        (cdsStart < cdsEnd) (strand == "+")):
-                        utr3_count = utr3_count + 1
-                        region = 'positionType=utr3'
-
-                    elif (u.isBetween(pos, cdsEnd, txtEnd) and 
-                        (cdsStart < cdsEnd) (strand == "-")):
-                        utr5_count = utr5_count + 1
-                        region = 'positionType=utr5'
-
-                    elif (u.isBetween(pos, txtStart, cdsStart) and \
-                        (cdsStart < cdsEnd) and (strand == "-")):
-                        utr3_count = utr3_count + 1
-                        region = 'positionType=utr3'
-
-                    elif (u.isBetween(pos, promoter_plus, txtStart) and \
-                        (strand == "+")):
-                        sql = 'select chrom, chromStart, chromEnd, name ' + \
-                            'from cpgIslandExt where chrom="' + str(chr) +  \
-                            '" AND (chromStart <= ' + str(pos) + ' AND ' + \
-                            str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
-
-                        if (rows is not None):
-                            region = 'putativePromoterRegion=' + \
-                                "".join(str(rows[3]).split())
-                            promoter_count = promoter_count + 1
-
-                    elif (u.isBetween(pos, txtEnd, promoter_minus) and \
-                        (strand == "-")):
-                        sql = 'select chrom, chromStart, chromEnd, name ' + \
-                            'from cpgIslandExt where chrom="' + str(chr) + \
-                            '" AND (chromStart <= ' + str(pos) + ' AND ' + \
-                            str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
-
-                        if (rows is not None):
-                            region = 'putativePromoterRegion=' + \
-                            "".join(str(rows[3]).split())
-                            promoter_count = promoter_count + 1
-
-                    else:
-                        region = ''
-
-                    if (region != ''):
-                        info.append(collapseGeneNames(
-                            row=row, indices=indicesKnownGenes, 
-                            region=region, cnt=cnt))
-
-                    cnt = cnt + 1
-
-                str_info = ";".join(info)
-                fields[7] = fields[7] + ';' + str_info
-                fh_out.write('\t'.join(fields) + '\n')
 
+"""Location in gene structures with the position type of every
+   transcript: the stage for INDELS, where bigRefGeneTable is not
+   applicable
+"""
+class ExonsStage(GenesStage):
+    def region(self, hit, hits, pos):
+        model = hit.model
+        region = ''
+        if not model.isCoding():
+            exons = hit.exonLabels(pos, "non_coding_exon")
+            self.non_coding_exonic_count = self.non_coding_exonic_count + \
+                len(exons)
+            if (len(exons) > 0):
+                region = 'positionType=non_coding_exon;' + ";".join(exons)
             else:
-                fields[7] = fields[7] + ";positionType=interGenic"
-                fh_out.write('\t'.join(fields) + '\n')
-                interGenic_count = interGenic_count + 1
-
-            linenum = linenum + 1
-
-        else:
-            fh_out.write(line + '\n')
-
-    print("Variants located:")
-    fh_log.write("Variants located:\n")
-
-    print(f"In interGenic {str(interGenic_count)}")
-    fh_log.write(f"In interGenic {str(interGenic_count)}\n")
-
-    print(f"In CDS {str(cds_count)}")
-    fh_log.write(f"In CDS {str(cds_count)}\n")
-
-    print(f"In \'3 UTR {str(utr3_count)}")
-    fh_log.write(f"In \'3 UTR {str(utr3_count)}\n")
+                self.non_coding_intronic_count = \
+                    self.non_coding_intronic_count + 1
+                region = 'positionType=non_coding_intron'
+
+        elif hit.cds:
+            self.cds_count = self.cds_count + 1
+            exons = hit.exonLabels(pos, "exon")
+            self.exonic_count = self.exonic_count + len(exons)
+            if (len(exons) > 0):
+                region = 'positionType=CDS;' + ";".join(exons)
+            else:
+                self.intronic_count = self.intronic_count + 1
+                region = 'positionType=CDS;' + 'intron'
 
-    print(f"In \'5 UTR {str(utr5_count)}")
-    fh_log.write(f"In \'5 UTR {str(utr5_count)}\n")
+        elif hit.utr5:
+            self.utr5_count = self.utr5_count + 1
+            region = 'positionType=utr5'
 
-    print(f"In Intronic {str(intronic_count)}")
-    fh_log.write(f"In Intronic "+str(intronic_count) +'\n')
+        elif hit.utr3:
+            self.utr3_count = self.utr3_count + 1
+            region = 'positionType=utr3'
 
-    print(f"In Non_coding_intronic {str(non_coding_intronic_count)}")
-    fh_log.write(f"In Non_coding_intronic {str(non_coding_intronic_count)}\n")
+        elif hit.promoter:
+            island = hits.island()
+            if (island is not None):
+                region = 'putativePromoterRegion=' + \
+                    "".join(str(island).split())
+                self.promoter_count = self.promoter_count + 1
+        return region
 
-    print(f"In Exonic {str(exonic_count)}")
-    fh_log.write(f"In Exonic {str(exonic_count)}\n")
+    def countPositionType(self, info_field):
+        pass
 
-    print(f"In Non_coding_exonic {str(non_coding_exonic_count)}")
-    fh_log.write(f"In Non_coding_exonic {str(non_coding_exonic_count)}\n")
 
-    print(f"In Putative Promoter Region {str(promoter_count)}")
-    fh_log.write(f"In Putative Promoter Region {str(promoter_count)}\n")
+"""Method used in INDELS, where bigRefGeneTable is not applicable
+"""
+def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500,
+    tmpextin='.2', tmpextout='.3', sep='\t', source=None):
 
-    fh_out.close()
-    fh_log.close()
-    fh.close()
-    conn.close()
+    annotateVcf(vcf + tmpextin, vcf + tmpextout,
+        [ExonsStage(table=table, promoter_offset=promoter_offset,
+        source=source)],
+        logfile=vcf + '.count.log', format=format, sep=sep)
 
 
 """Overlap with tfbsConsSites
 """
-def addOverlapWithTfbsConsSites(vcf, format='vcf', table='tfbsConsSites', 
-    tmpextin='.2', tmpextout='.3', sep='\t'):
+class TfbsConsSitesStage(OverlapStage):
+    label = 'addOverlapWithTfbsConsSites'
 
     allowed_chrom=['1','2','3','4','5','6','7','8','9','10','11','12','13',
         '14','15','16','17','18','19','20','21','22','X','Y']
 
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
+    # Each chromosome is its own table, so rows are not matched on chrom
+    chromName = None
+    columns = 'chrom, chromStart, chromEnd, name'
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+    def __init__(self, table='tfbsConsSites', source=None):
+        OverlapStage.__init__(self, table=table, source=source)
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
+    def isHeader(self, line):
+        return line.startswith("##") or line.startswith('#CHROM') or \
+            line.startswith('CHROM')
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
+    def trackTable(self, chr):
+        return self.table + chr.replace('chr', '')
 
-    linenum = 1
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if (line.startswith("##")):
-            fh_out.write(line + '\n')
+    def stabQuery(self, variant):
+        if (variant.chrWithPrefix().replace('chr', '') in self.allowed_chrom):
+            return (variant.chrWithPrefix(), variant.pos)
+        return None
 
-        #header line
-        elif (line.startswith('#CHROM') or line.startswith('CHROM')):
-            fh_out.write(line + '\n')
+    def annotate(self, variant):
+        # For some reason this table has no "chr" preceeding number
+        chr = variant.chrWithPrefix()
+        pos = variant.pos
+        chrIndex = chr.replace('chr', '')
 
-        else:
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            # For some reason this table has no "chr" preceeding number
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
-
-            pos=fields[inds[1]].strip()
-            isOverlap = False
-            chrIndex=chr.replace('chr', '')
-
-            if (chrIndex in allowed_chrom):
-                isOverlap = False
-                sql = 'select chrom, chromStart, chromEnd, name ' + \
-                    'from tfbsConsSites' + chrIndex + \
-                    ' where  chromStart <= ' + str(pos) + ' AND ' + \
-                    str(pos) + ' <= chromEnd;'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    records_count = 1
-                    line_count = line_count + 1
-
-                    for row in rows:
-                        var_count = var_count + 1
-                        t = str(row[3]) + '.' + str(row[0]) + '.' + \
-                            str(row[1]) + '.' + str(row[2])
-                        t = t.strip()
-                        records.append('tfbsRegion' + '=' + t)
-                        records_count = records_count + 1
-
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] + ';'.join(records)
-                    else:
-                        fields[7] = fields[7] + ';' + ';'.join(records)
-
-                    fh_out.write('\t'.join(fields) + '\n')
-
-                else: # chrom is not on the list
-                    fh_out.write(line + '\n')
-
-            else: # chrom is not on the list
-                fh_out.write(line + '\n')
-
-        linenum = linenum + 1
-
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
+        if (chrIndex in self.allowed_chrom):
+            rows = self.stab(chr, pos)
+            records = []
 
+            if (len(rows) > 0):
+                fields = variant.fields
+                self.line_count = self.line_count + 1
 
-"""Overlap with GadAll table
-"""
-def addOverlapWithGadAll(vcf, format='vcf', table='gadAll', tmpextin='', 
-    tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
+                for row in rows:
+                    self.var_count = self.var_count + 1
+                    t = str(row[3]) + '.' + str(row[0]) + '.' + \
+                        str(row[1]) + '.' + str(row[2])
+                    t = t.strip()
+                    records.append('tfbsRegion' + '=' + t)
+
+                if str(fields[7]).endswith(';'):
+                    fields[7] = fields[7] + ';'.join(records)
+                else:
+                    fields[7] = fields[7] + ';' + ';'.join(records)
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+                variant.touch()
 
-    logcountfile = basefile+'.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                # For some reason this table has no "chr" preceeding number
-                if chr.startswith("chr"):
-                    chr = str(chr).replace("chr", "")
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = 'select * from ' + table + ' where chromosome="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    records_count = 1
-                    line_count = line_count + 1
-                    r_tmp = []
-                    for row in rows:
-                        var_count = var_count + 1
-                        if not fu.isOnTheList(r_tmp, str(row[3])):
-                            r_tmp.append(str(row[3]) )
-                            records.append(str(table) + '=' + str(row[3]))
-                            records_count = records_count + 1
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] + ';'.join(records)
-                    else:
-                        fields[7] = fields[7] + ';' + ';'.join(records)
-                    fh_out.write('\t '.join(fields) + '\n')
-                else:
-                    fh_out.write(line + '\n')
+def addOverlapWithTfbsConsSites(vcf, format='vcf', table='tfbsConsSites',
+    tmpextin='.2', tmpextout='.3', sep='\t', source=None):
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+    annotateVcf(vcf + tmpextin, vcf + tmpextout,
+        [TfbsConsSitesStage(table=table, source=source)], logfile=vcf + '.count.log',
+        format=format, sep=sep)
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+"""Overlap with GadAll table
+"""
+class GadAllStage(OverlapStage):
+    label = 'gadAll'
+
+    chromName = 'chromosome'
+
+    def __init__(self, table='gadAll', source=None):
+        OverlapStage.__init__(self, table=table, source=source)
+
+    def stabQuery(self, variant):
+        return (variant.chrNoPrefix(), variant.pos)
+
+    def annotate(self, variant):
+        # For some reason this table has no "chr" preceeding number
+        rows = self.stab(variant.chrNoPrefix(), variant.pos)
+        records = []
+
+        if (len(rows) > 0):
+            fields = variant.fields
+            self.line_count = self.line_count + 1
+            r_tmp = []
+            for row in rows:
+                self.var_count = self.var_count + 1
+                if not fu.isOnTheList(r_tmp, str(row[3])):
+                    r_tmp.append(str(row[3]) )
+                    records.append(str(self.table) + '=' + str(row[3]))
+            if str(fields[7]).endswith(';'):
+                fields[7] = fields[7] + ';'.join(records)
+            else:
+                fields[7] = fields[7] + ';' + ';'.join(records)
+            variant.touch('\t ')
 
 
-""" Overlap with gwasCatalog table """
-def addOverlapWithGwasCatalog(vcf, format='vcf', table='gwasCatalog', \
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
+def addOverlapWithGadAll(vcf, format='vcf', table='gadAll', tmpextin='',
+    tmpextout='.1', sep='\t', source=None):
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+    annotateVcf(vcf + tmpextin, vcf + tmpextout,
+        [GadAllStage(table=table, source=source)],
+        logfile=vcf + '.count.log', format=format, sep=sep)
 
-    logcountfile = basefile+'.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
+""" Overlap with gwasCatalog table """
+class GwasCatalogStage(OverlapStage):
+    label = 'GwasCatalog'
+
+    def __init__(self, table='gwasCatalog', source=None):
+        OverlapStage.__init__(self, table=table, source=source)
+        # Catalog entries are single bases matched on their end
+        self.point = src.Track(table, pos='chromEnd')
+        self.point_rows = {}
+
+    def prefetch(self, variants):
+        keys = list(dict.fromkeys([(variant.chrWithPrefix(), variant.pos)
+            for variant in variants if variant.pos.isdigit()]))
+        results = self.source.batch_lookup(self.point,
+            [(chr, pos, None, None) for chr, pos in keys])
+        self.point_rows = dict(zip(keys, results))
+
+    def annotate(self, variant):
+        key = (variant.chrWithPrefix(), variant.pos)
+        if key in self.point_rows:
+            rows = self.point_rows[key]
+        else:
+            rows = self.source.point_lookup(self.point, key[0], key[1])
+        records = []
+
+        if (len(rows) > 0):
+            fields = variant.fields
+            self.line_count = self.line_count + 1
+            for row in rows:
+                self.var_count = self.var_count + 1
+                records.append(str(self.table) + '=' + str('pubMedID') + \
+                    '=' + str(row[5]) + ',trait=' + str(row[10]))
+            if str(fields[7]).endswith(';'):
+                fields[7] = fields[7] + ';'.join(records)
             else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-                
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND chromEnd = ' + str(pos) + ';'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    records_count = 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        records.append(str(table) + '=' + str('pubMedID') + \
-                            '=' + str(row[5]) + ',trait=' + str(row[10]))
-                        records_count = records_count + 1
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] + ';'.join(records)
-                    else:
-                        fields[7] = fields[7] + ';' + ';'.join(records)
-                    fh_out.write('\t'.join(fields) + '\n')
-                else:
-                    fh_out.write(line + '\n')
+                fields[7] = fields[7] + ';' + ';'.join(records)
+            variant.touch()
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+def addOverlapWithGwasCatalog(vcf, format='vcf', table='gwasCatalog', \
+    tmpextin='', tmpextout='.1', sep='\t', source=None):
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    annotateVcf(vcf + tmpextin, vcf + tmpextout,
+        [GwasCatalogStage(table=table, source=source)],
+        logfile=vcf + '.count.log',
+        format=format, sep=sep)
 
 
 """Overlap with HUGO Gene Nomenclature Committee (HGNC) table
 """
-def addOverlapWitHUGOGeneNomenclature(vcf, format='vcf', table='hugo', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
+class HugoStage(OverlapStage):
+    label = 'HUGO Gene Nomenclature Committee'
+
+    def __init__(self, table='hugo', source=None):
+        OverlapStage.__init__(self, table=table, source=source)
+
+    def annotate(self, variant):
+        rows = self.stab(variant.chrWithPrefix(), variant.pos)
+        records = []
+
+        if (len(rows) > 0):
+            fields = variant.fields
+            self.line_count = self.line_count + 1
+            r_tmp = []
+            for row in rows:
+                self.var_count = self.var_count + 1
+                t = str(str(row[5]) + ',' + str(row[6])).strip()
+                if not fu.isOnTheList(r_tmp, t):
+                    r_tmp.append(t)
+                    records.append('HGNC_GeneAnnotation' + '=' + t)
+
+            records_str = ','.join(records).replace(';', ',')
+
+            if str(fields[7]).endswith(';'):
+                fields[7] = fields[7] +records_str
             else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos=fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    records_count = 1
-                    r_tmp = []
-                    for row in rows:
-                        var_count = var_count + 1
-                        t = str(str(row[5]) + ',' + str(row[6])).strip()
-                        if not fu.isOnTheList(r_tmp, t):
-                            r_tmp.append(t)
-                            records.append('HGNC_GeneAnnotation' + '=' + t)
-                        records_count = records_count + 1
-
-                    records_str = ','.join(records).replace(';', ',')
-
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] +records_str
-                    else:
-                        fields[7] = fields[7] + ';' + records_str
-                    fh_out.write('\t'.join(fields) + '\n')
-                else:
-                    fh_out.write(line + '\n')
+                fields[7] = fields[7] + ';' + records_str
+            variant.touch()
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+def addOverlapWitHUGOGeneNomenclature(vcf, format='vcf', table='hugo',
+    tmpextin='', tmpextout='.1', sep='\t', source=None):
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    annotateVcf(vcf + tmpextin, vcf + tmpextout,
+        [HugoStage(table=table, source=source)],
+        logfile=vcf + '.count.log', format=format, sep=sep)
 
 
 """Overlap with segdup regions genomicSuperDups
 """
-def addOverlapWithGenomicSuperDups(vcf, format='vcf', 
-    table='genomicSuperDups', tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
+class GenomicSuperDupsStage(OverlapStage):
+    label = 'genomicSuperDups'
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+    def __init__(self, table='genomicSuperDups', source=None):
+        OverlapStage.__init__(self, table=table, source=source)
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
+    def annotate(self, variant):
+        rows = self.stabFirst(variant.chrWithPrefix(), variant.pos)
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                otherChrom = ''
-                otherStart = ''
-                otherEnd = ''
-                l = str(isOverlap)
-
-                sql = 'select * from ' + table + ' where chrom="'+ str(chr) + \
-                    '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    isOverlap = True
-                    otherChrom = rows[7]
-                    otherStart = rows[8]
-                    otherEnd = rows[9]
-                    fields[7] = fields[7] + ';' + str(table) + '=' + \
-                        str(isOverlap) + ';' + 'otherChrom=' + \
-                        str(otherChrom) + ';otherStart=' + \
-                        str(otherStart) + ';otherEnd=' + str(otherEnd)
-
-                fh_out.write('\t'.join(fields) + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+        if rows is not None:
+            fields = variant.fields
+            self.line_count = self.line_count + 1
+            self.var_count = self.var_count + 1
+            isOverlap = True
+            otherChrom = rows[7]
+            otherStart = rows[8]
+            otherEnd = rows[9]
+            fields[7] = fields[7] + ';' + str(self.table) + '=' + \
+                str(isOverlap) + ';' + 'otherChrom=' + \
+                str(otherChrom) + ';otherStart=' + \
+                str(otherStart) + ';otherEnd=' + str(otherEnd)
+            variant.touch()
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+def addOverlapWithGenomicSuperDups(vcf, format='vcf',
+    table='genomicSuperDups', tmpextin='', tmpextout='.1', sep='\t',
+    source=None):
 
+    annotateVcf(vcf + tmpextin, vcf + tmpextout,
+        [GenomicSuperDupsStage(table=table, source=source)], logfile=vcf + '.count.log',
+        format=format, sep=sep)
 
-"""Searches Genes Databases and returns Genes/Cytobands 
+
+"""Searches Genes Databases and returns Genes/Cytobands
    with which SNP or INDEL overlaps
 """
-def addOverlapWithRefGene(vcf, format='vcf', table='refGene', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+class RefGeneStage(OverlapStage):
+    label = 'refGene'
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
     colindex = 1
     colindex2 = 12
     name = 'name'
@@ -1131,273 +987,148 @@ def addOverlapWithRefGene(vcf, format='vcf', table='refGene',
     startName = 'txStart'
     endName = 'txEnd'
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
+    def __init__(self, table='refGene', source=None):
+        OverlapStage.__init__(self, table=table, source=source)
+
+    def annotate(self, variant):
+        overlapsWith = []
+        rows = self.stab(variant.chrWithPrefix(), variant.pos)
+
+        if (len(rows) > 0):
+            fields = variant.fields
+            self.line_count = self.line_count + 1
+            for row in rows:
+                self.var_count = self.var_count + 1
+                overlapsWith.append(self.name2 + '=' + \
+                    str(row[self.colindex2]) + ';' + self.name + '=' + \
+                    str(row[self.colindex]))
+
+            genes = ';'.join([str(x) for x in overlapsWith])
+            if str(fields[7]).endswith(";"):
+                fields[7] = fields[7] + str(genes)
             else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (' + startName + ' <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= ' + endName +');'
-                overlapsWith = []
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        overlapsWith.append(name2 + '=' + \
-                            str(row[colindex2]) + ';' + name + '=' + \
-                            str(row[colindex]))
-
-                    genes = ';'.join([str(x) for x in overlapsWith])
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(genes)
-                    else:
-                        fields[7] = fields[7] + ';' + str(genes)
-                fh_out.write('\t'.join(fields) + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+                fields[7] = fields[7] + ';' + str(genes)
+            variant.touch()
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+def addOverlapWithRefGene(vcf, format='vcf', table='refGene',
+    tmpextin='', tmpextout='.1', sep='\t', source=None):
+
+    annotateVcf(vcf + tmpextin, vcf + tmpextout,
+        [RefGeneStage(table=table, source=source)],
+        logfile=vcf + '.count.log', format=format, sep=sep)
 
 
 """Method to find overlap with Cytoband table
 """
-def addOverlapWithCytoband(vcf, format='vcf', table='cytoBand', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-    colindex = 12
-    startName = 'txStart'
-    endName = 'txEnd'
-
-    if (table == 'cytoBand'):
-        colindex = 3
-        startName = 'chromStart'
-        endName = 'chromEnd'
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
+class CytobandStage(OverlapStage):
+    label = 'Cytoband'
+
+    def __init__(self, table='cytoBand', source=None):
+        OverlapStage.__init__(self, table=table, source=source)
+        self.colindex = 12
+        self.startName = 'txStart'
+        self.endName = 'txEnd'
+
+        if (table == 'cytoBand'):
+            self.colindex = 3
+            self.startName = 'chromStart'
+            self.endName = 'chromEnd'
+
+    def annotate(self, variant):
+        overlapsWith = []
+        rows = self.stab(variant.chrWithPrefix(), variant.pos)
+
+        if (len(rows) > 0):
+            fields = variant.fields
+            self.line_count = self.line_count + 1
+            for row in rows:
+                self.var_count = self.var_count + 1
+                overlapsWith.append(str(row[self.colindex]))
+            overlapsWith = u.dedup(overlapsWith)
+            cytoband = ';'.join([str(x) for x in overlapsWith])
+
+            if str(fields[7]).endswith(";"):
+                fields[7] = fields[7] + str(self.table) + '=' + str(cytoband)
             else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (' + startName + ' <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= ' + endName + ');'
-                overlapsWith = []
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        overlapsWith.append(str(row[colindex]))
-                    overlapsWith = u.dedup(overlapsWith)
-                    cytoband = ';'.join([str(x) for x in overlapsWith])
-
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(table) + '=' + str(cytoband)
-                    else:
-                        fields[7] = fields[7] + ';' + str(table) + '=' + str(cytoband)
-                fh_out.write('\t'.join(fields) + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+                fields[7] = fields[7] + ';' + str(self.table) + '=' + str(cytoband)
+            variant.touch()
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+def addOverlapWithCytoband(vcf, format='vcf', table='cytoBand',
+    tmpextin='', tmpextout='.1', sep='\t', source=None):
+
+    annotateVcf(vcf + tmpextin, vcf + tmpextout,
+        [CytobandStage(table=table, source=source)],
+        logfile=vcf + '.count.log', format=format, sep=sep)
 
 
 """Method to find overlap with CNV tables
 """
-def addOverlapWithCnvDatabase(vcf, format='vcf', table='dgv_Cnv', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
+class CnvDatabaseStage(OverlapStage):
+    def __init__(self, table='dgv_Cnv', source=None):
+        OverlapStage.__init__(self, table=table, source=source)
+        self.label = table
+
+    def annotate(self, variant):
+        rows = self.stabFirst(variant.chrWithPrefix(), variant.pos)
+
+        if rows is not None:
+            fields = variant.fields
+            self.line_count = self.line_count + 1
+            self.var_count = self.var_count + 1
+            isOverlap = True
+            if str(fields[7]).endswith(";"):
+                fields[7] = fields[7] + str(self.table) + '=' + \
+                str(isOverlap)
             else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    isOverlap = True
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(table) + '=' + \
-                        str(isOverlap)
-                    else:
-                        fields[7] = fields[7] + ';' + str(table) + \
-                        '='+str(isOverlap)
-                fh_out.write('\t'.join(fields) + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+                fields[7] = fields[7] + ';' + str(self.table) + \
+                '='+str(isOverlap)
+            variant.touch()
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+def addOverlapWithCnvDatabase(vcf, format='vcf', table='dgv_Cnv',
+    tmpextin='', tmpextout='.1', sep='\t', source=None):
+
+    annotateVcf(vcf + tmpextin, vcf + tmpextout,
+        [CnvDatabaseStage(table=table, source=source)], logfile=vcf + '.count.log',
+        format=format, sep=sep)
 
 
 """Method to find overlap with targetScanS tables
 """
-def addOverlapWithMiRNA(vcf, format='vcf', table='targetScanS', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+class MiRNAStage(OverlapStage):
+    label = 'miRNA'
+
+    def __init__(self, table='targetScanS', source=None):
+        OverlapStage.__init__(self, table=table, source=source)
+
+    def annotate(self, variant):
+        rows = self.stabFirst(variant.chrWithPrefix(), variant.pos)
+
+        if rows is not None:
+            fields = variant.fields
+            self.line_count = self.line_count + 1
+            self.var_count = self.var_count + 1
+            t = str(rows[4]) + ',' +  str(rows[1]) + '_' + \
+                str(rows[2]) + '_' + str(rows[3])
+            t = 'miRNAsites=' + t.strip()
+            if str(fields[7]).endswith(";"):
+                fields[7] = fields[7] + t
+            else:
+                fields[7] = fields[7] + ';' + t
+            variant.touch()
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
+    def writeLog(self, fh_log):
+        fh_log.write(f"In miRNAsites: {str(self.var_count)} in " + \
+            f"{str(self.line_count)} variants\n")
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    t = str(rows[4]) + ',' +  str(rows[1]) + '_' + \
-                        str(rows[2]) + '_' + str(rows[3])
-                    t = 'miRNAsites=' + t.strip()
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + t
-                    else:
-                        fields[7] = fields[7] + ';' + t
-                fh_out.write('\t'.join(fields) + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
 
-    fh_log.write(f"In miRNAsites: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+def addOverlapWithMiRNA(vcf, format='vcf', table='targetScanS',
+    tmpextin='', tmpextout='.1', sep='\t', source=None):
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    annotateVcf(vcf + tmpextin, vcf + tmpextout,
+        [MiRNAStage(table=table, source=source)],
+        logfile=vcf + '.count.log', format=format, sep=sep)
 
 ### EOF
\ No newline at end of file
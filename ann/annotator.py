@@ -1,10 +1,13 @@
 from flask import Flask, request, Response, jsonify
 import uuid
-import subprocess
 import os
 import boto3
 import botocore
-import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import workers as wk
+import scheduler as sch
 
 # Get configuration
 from configparser import ConfigParser
@@ -17,100 +20,272 @@ table_name = config['dynamodb']['TABLENAME']
 # Connect to SQS and get the message queue
 sqs = boto3.client('sqs', region_name = region_name)
 
+# Warm workers run the annotation jobs, started once with the pipeline
+# loaded instead of starting run.py for each job
+workers = wk.WorkerPool()
+
 base_path = '/home/ubuntu/gas/ann/data'
 if not os.path.exists(base_path):
     os.makedirs(base_path)
 
-# Poll the message queue in a loop 
-while True:
-    # Attempt to read a message from the queue
-    # Use long polling - DO NOT use sleep() to wait between polls
-    # ref: https://boto3.amazonaws.com/v1/documentation/api/latest/guide/sqs-example-long-polling.html
-    
+# Bounds the jobs running at once, and holds off while the instance is
+# short of CPU, memory or disk for another
+scheduler = sch.Scheduler(workers, path=base_path)
+
+# Messages taken per receive (at most 10), seconds a receive waits for
+# messages when the queue was found empty, and seconds received messages
+# stay hidden from other instances while held here (renewed as needed)
+max_messages = min(10, config.getint('sqs', 'MaxMessages', fallback=10))
+wait_time = config.getint('sqs', 'WaitTime', fallback=20)
+hold_visibility = config.getint('sqs', 'HoldVisibility', fallback=120)
+# Seconds jobs released for their user being at the cap stay hidden
+defer_visibility = config.getint('sqs', 'DeferVisibility', fallback=60)
+
+# Queues job requests are received from, with the tier of their jobs (None
+# takes the priority the web tier set on each request). Premium jobs can
+# have a queue of their own, subscribed to the job requests topic with a
+# filter policy on the priority message attribute
+queues = [(queue_url, None)]
+premium_url = config.get('sqs', 'PremiumURL', fallback='').strip()
+if premium_url:
+    queues.insert(0, (premium_url, 'premium'))
+
+# Job requests held until they can start, started premium first with
+# weighted fair sharing between the tiers, round robin between users and
+# no more than UserMaxJobs at once for any user
+backlog = sch.Backlog()
+
+# Seconds between reports of the queue waits per tier
+stats_secs = config.getint('ann', 'QueueStatsSecs', fallback=300)
+reported = time.time()
+
+"""Downloads a job's input and hands the job to a warm worker; returns
+   True once the job is submitted, or False if it could not be
+   Runs on the dispatch threads, each with its own boto3 session
+"""
+def start_job(job):
+    Message = job.request
+    job_id = Message['job_id']
+    user_id = Message['user_id']
+    bucket_name = Message['s3_inputs_bucket']
+    file_name = Message['input_file_name']
+    key = Message['s3_key_input_file']
+    email = Message['email']
+
+    session = boto3.session.Session()
+
+    # Include below the same code you used in prior homework
+    # Get the input file S3 object and copy it to a local file: https://boto3.amazonaws.com/v1/documentation/api/1.9.42/guide/s3-example-download-file.html
+    s3 = session.resource('s3',region_name = region_name, config = botocore.client.Config(signature_version = 's3v4'))
+
+    new_path = base_path +'/' + job_id
+    if not os.path.exists(new_path):
+        os.makedirs(new_path, exist_ok=True)
+
+    try:
+        s3.Bucket(bucket_name).download_file(key, new_path +'/' + file_name)
+        print("Downloading...")
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] == "404":
+            print("The object does not exist.", bucket_name, key)
+        else:
+            print("Download failed!", job_id, e)
+        return False
+
+    # Hand the annotation job to a warm worker
+    workers.submit(new_path +'/' + file_name, job_id, user_id, email)
+    print("Launched annotation job", job_id, job.tier, f"after {job.waited():.1f}s")
+
+    # Update the “job_status” key in the annotations DynamoDB table to “RUNNING” only if its current status is “PENDING” with erro handling
+    dynamodb = session.resource('dynamodb', region_name = region_name, config = botocore.client.Config(signature_version = 's3v4'))
+    table = dynamodb.Table(table_name)
+    try:
+        table.update_item(
+            Key = {"job_id": job_id}, 
+            UpdateExpression = 'SET job_status = :val1',
+            ConditionExpression = 'job_status = :val2',  # https://docs.aws.amazon.com/amazondynamodb/latest/APIReference/API_UpdateItem.html -> Conditional Update
+            ExpressionAttributeValues={
+                ':val1': "RUNNING",
+                ':val2': "PENDING"
+            }          
+        )
+    except Exception as error:
+        # The job is submitted: it must not be taken as not launched
+        print("Update DynamoDB failed!", job_id, error)
+
+    return True
+
+"""start_job, returning False on any error before the job is submitted,
+   so the message is received again rather than the poll loop failing
+"""
+def launch_job(job):
+    try:
+        return start_job(job)
+    except Exception as e:
+        print("Launch failed!", job.job_id, e)
+        return False
+
+"""Takes up to count messages from a queue, waiting up to wait seconds
+   for them
+"""
+def receive_messages(url, count, wait):
     response = sqs.receive_message(
-        QueueUrl = queue_url,
+        QueueUrl = url,
         AttributeNames=[
             'SentTimestamp'
         ],
-        MaxNumberOfMessages=1,
+        MaxNumberOfMessages=count,
         MessageAttributeNames=[
             'All'
         ],
-        WaitTimeSeconds=10
+        VisibilityTimeout=hold_visibility,
+        WaitTimeSeconds=wait
     ) 
-    print(response)
-    # If message read, extract job parameters from the message body as before
-    if 'Messages' in response:
-        print("begin")
-        Message_body = json.loads(response['Messages'][0]['Body'])
-        print()
-        receipt_handle = response['Messages'][0]['ReceiptHandle']
-        print()
-        Message = json.loads(Message_body['Message'])
-
-        job_id = Message['job_id']
-        user_id = Message['user_id']
-        bucket_name = Message['s3_inputs_bucket']
-        file_name = Message['input_file_name']
-        key = Message['s3_key_input_file']
-        email = Message['email']
-        
-        # Include below the same code you used in prior homework
-        # Get the input file S3 object and copy it to a local file: https://boto3.amazonaws.com/v1/documentation/api/1.9.42/guide/s3-example-download-file.html
-        s3 = boto3.resource('s3',region_name = region_name, config = botocore.client.Config(signature_version = 's3v4'))
-        
-        new_path = base_path +'/' + job_id
-        if not os.path.exists(new_path):
-            os.makedirs(new_path)
-            
-        try:
-            s3.Bucket(bucket_name).download_file(key, new_path +'/' + file_name)
-            print("Downloading...")
-        except botocore.exceptions.ClientError as e:
-            if e.response['Error']['Code'] == "404":
-                raise("The object does not exist.")
-            else:
-                raise(e)
-
-        # Launch annotation job as a background process with erro handling
-        try:
-        # https://stackoverflow.com/questions/4856583/how-do-i-pipe-a-subprocess-call-to-a-text-file save the stdout to file
-            job = subprocess.Popen(["python", "/home/ubuntu/gas/ann/run.py", new_path +'/' + file_name, job_id, user_id, email])
-            print("Luach annotation job")
-        except subprocess.CalledProcessError:
-            response_data = {
-                "code": 500,
-                "status": "error",
-                "message": "annotator runs fail"
-            }
-            
-            raise(response_data)     
-
-        # Update the “job_status” key in the annotations DynamoDB table to “RUNNING” only if its current status is “PENDING” with erro handling
-        dynamodb = boto3.resource('dynamodb', region_name = region_name, config = botocore.client.Config(signature_version = 's3v4'))
-        table = dynamodb.Table(table_name)
+    return response.get('Messages', [])
+
+"""Takes messages from the queues into the backlog; returns whether some
+   queue filled its batch. Each queue is short polled in turn, and only
+   if all come back empty are they long polled, for up to wait seconds
+   and all at once, sharing the backlog's room, so no tier's jobs wait
+   out another queue's poll
+"""
+def receive_jobs(wait):
+    full = False
+    received = 0
+    for url, tier in queues:
+        count = min(max_messages, backlog.room())
+        if (count == 0):
+            return full
+        messages = receive_messages(url, count,
+            wait if (len(queues) == 1) else 0)
+        add_jobs(messages, url, tier)
+        received = received + len(messages)
+        full = full or (len(messages) == count)
+    if (received > 0 or wait == 0 or len(queues) == 1):
+        return full
+
+    count = min(max_messages, max(1, backlog.room() // len(queues)))
+    batches = list(polling.map(lambda queue:
+        receive_messages(queue[0], count, wait), queues))
+    for (url, tier), messages in zip(queues, batches):
+        add_jobs(messages, url, tier)
+        full = full or (len(messages) == count)
+    return full
+
+"""Adds the job requests of messages from a queue to the backlog, and
+   deletes the messages that are not job requests, which would otherwise
+   be received again and again
+"""
+def add_jobs(messages, url, tier):
+    malformed = []
+    for message in messages:
         try:
-            table.update_item(
-                Key = {"job_id": job_id}, 
-                UpdateExpression = 'SET job_status = :val1',
-                ConditionExpression = 'job_status = :val2',  # https://docs.aws.amazon.com/amazondynamodb/latest/APIReference/API_UpdateItem.html -> Conditional Update
-                ExpressionAttributeValues={
-                    ':val1': "RUNNING",
-                    ':val2': "PENDING"
-                }          
+            backlog.add(sch.Job(message, url, tier))
+        except (ValueError, KeyError) as e:
+            print("Malformed job request deleted", message.get('MessageId'), e)
+            if 'ReceiptHandle' in message:
+                malformed.append({'ReceiptHandle': message['ReceiptHandle']})
+    sqs_batches(sqs.delete_message_batch, {url: malformed})
+
+"""Runs one of the batch calls of SQS (delete_message_batch,
+   change_message_visibility_batch) over the entries of each queue, ten
+   at a time
+"""
+def sqs_batches(call, entries):
+    for url in entries:
+        for i in range(0, len(entries[url]), 10):
+            response = call(
+                QueueUrl = url,
+                Entries = [dict(entry, Id = str(i + j)) for j, entry in
+                    enumerate(entries[url][i:i + 10])]
             )
-        except botocore.exceptions.ClientError as error:
-            response_body = {
-                "code": 500,
-                "data":{
-                "status":"error",
-                "message":error
-                }
-            }
-            raise(response_body)        
-
-        # Delete message from queue, if job was successfully submitted
-        sqs.delete_message(
-            QueueUrl =queue_url,
-            ReceiptHandle=receipt_handle
-        )
\ No newline at end of file
+            for failed in response.get('Failed', []):
+                print(call.__name__, "failed!", failed)
+
+"""Keeps the messages held in the backlog hidden from other instances,
+   and reports the queue waits every stats_secs
+"""
+def tend_backlog():
+    global reported
+    now = time.time()
+    renew = {}
+    for job in backlog.held():
+        if (now - job.renewed > hold_visibility / 2):
+            renew.setdefault(job.queue_url, []).append({
+                'ReceiptHandle': job.receipt_handle,
+                'VisibilityTimeout': hold_visibility})
+            job.renewed = now
+    sqs_batches(sqs.change_message_visibility_batch, renew)
+
+    if (now - reported > stats_secs):
+        reported = now
+        for tier, stats in backlog.stats().items():
+            print(f"Queue wait of {tier} jobs: p50 {stats['p50']}s, " +
+                f"p90 {stats['p90']}s, p99 {stats['p99']}s over " +
+                f"{stats['jobs']} jobs; {stats['held']} held, " +
+                f"{stats['rescued']} started early for waiting too long")
+        for user_id, stats in backlog.userStats().items():
+            print(f"Jobs of user {user_id} deferred at the cap: " +
+                f"{stats['deferred']}, {stats['released']} of them " +
+                f"released to the queue; {stats['held']} held")
+
+# Jobs of a batch are launched concurrently, and the queues long polled
+# concurrently
+dispatch = ThreadPoolExecutor(max_workers=max_messages)
+polling = ThreadPoolExecutor(max_workers=len(queues))
+
+# Poll the message queue in a loop 
+wait = wait_time
+while True:
+    # Attempt to read messages from the queue
+    # Use long polling - DO NOT use sleep() to wait between polls
+    # ref: https://boto3.amazonaws.com/v1/documentation/api/latest/guide/sqs-example-long-polling.html
+
+    # Only take messages while a job can start and the backlog has room;
+    # until then messages stay on the queue for other instances
+    scheduler.admit(idle=tend_backlog)
+    full = receive_jobs(wait)
+
+    # Start the jobs that can, in the backlog's order, and delete their
+    # messages; the others stay held
+    slots = scheduler.free()
+    running = workers.users()
+    jobs = []
+    while (len(jobs) < slots):
+        job = backlog.next(running)
+        if job is None:
+            break
+        running[job.user_id] = running.get(job.user_id, 0) + 1
+        jobs.append(job)
+    launched = list(dispatch.map(launch_job, jobs))
+    entries = {}
+    for job, ok in zip(jobs, launched):
+        if ok:
+            entries.setdefault(job.queue_url, []).append({
+                'ReceiptHandle': job.receipt_handle})
+    sqs_batches(sqs.delete_message_batch, entries)
+
+    # Slots are left but the backlog is full of jobs of users at their
+    # cap: hand those back to the queue for a while, to take others' jobs
+    if (len(jobs) < slots and backlog.room() == 0):
+        deferred = {}
+        for job in backlog.release(running):
+            deferred.setdefault(job.queue_url, []).append({
+                'ReceiptHandle': job.receipt_handle,
+                'VisibilityTimeout': defer_visibility})
+        sqs_batches(sqs.change_message_visibility_batch, deferred)
+    tend_backlog()
+
+    # Jobs are held but none could start (their users are at the cap):
+    # wait for a job to end rather than polling again at once
+    if (len(jobs) == 0 and len(backlog) > 0 and not full):
+        workers.wait(sch.RECHECK_SECS)
+
+    # A full batch means more are waiting: receive again without waiting
+    # while the queue drains, and long poll once it comes back empty. The
+    # poll is kept short while jobs are held, so they start soon after a
+    # job of their user ends
+    wait = 0 if full else \
+        (min(wait_time, sch.RECHECK_SECS) if (len(backlog) > 0) else wait_time)
+
+### EOF
@@ -9,8 +9,8 @@
 ##
 __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
-import requests, json, os, boto3, botocore
-import subprocess
+import requests, json, os, boto3, botocore, threading
+import workers as wk
 
 from flask import Flask, jsonify, request
 
@@ -32,13 +32,25 @@ sqs = boto3.client('sqs', region_name = region_name)
 
 # Check if requests queue exists, otherwise create it
 
+# Warm workers run the annotation jobs; started by the first request, in
+# the process serving requests rather than the debug reloader watching it
+workers = None
+workers_lock = threading.Lock()
+
+def get_workers():
+  global workers
+  with workers_lock:
+    if workers is None:
+      workers = wk.WorkerPool()
+  return workers
+
 
 
 '''
 A13 - Replace polling with webhook in annotator
 
 Receives request from SNS; queries job queue and processes message.
-Reads request messages from SQS and runs AnnTools as a subprocess.
+Reads request messages from SQS and runs AnnTools on a warm worker.
 Updates the annotations database with the status of the request.
 '''
 @app.route('/process-job-request', methods=['GET', 'POST'])
@@ -88,18 +100,9 @@ def annotate():
       else:
         raise(e)
 
-     # Launch annotation job as a background process with erro handling
-    try:
-    # https://stackoverflow.com/questions/4856583/how-do-i-pipe-a-subprocess-call-to-a-text-file save the stdout to file
-      job = subprocess.Popen(["python", "/home/ubuntu/gas/ann/run.py", new_path +'/' + file_name, job_id, user_id, email])
-      print("Luach annotation job")
-    except subprocess.CalledProcessError:
-      response_data = {
-        "code": 500,
-        "status": "error",
-        "message": "annotator runs fail"
-      }
-      raise(response_data)
+    # Hand the annotation job to a warm worker
+    get_workers().submit(new_path +'/' + file_name, job_id, user_id, email)
+    print("Launched annotation job")
 
     # Update the “job_status” key in the annotations DynamoDB table to “RUNNING” only if its current status is “PENDING” with erro handling
     dynamodb = boto3.resource('dynamodb', region_name = region_name)
@@ -0,0 +1,235 @@
+# bloom.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Bloom filters over the positions of the sparse reference tables, so that
+# lookups of positions that are certainly absent skip the database
+#
+# Usage: python bloom.py <filter_dir> [backend]
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import sys
+import math
+import json
+import zlib
+import time
+import struct
+import pymysql
+
+import utils as u
+import bundle
+import interval_index as ii
+
+MAGIC = b'ANNBLOOM'
+MASK64 = (1 << 64) - 1
+
+# Tables a filter can be built for, with their chromosome and position
+# columns (the columns point lookups match on)
+TABLES = {
+    'dbSNP': ('CHR', 'POS'),
+    'chrom_pos_equal_base': ('CHR', 'start'),
+    'chrom_pos_equal_nobase': ('CHR', 'start'),
+    'gwasCatalog': ('chrom', 'chromEnd'),
+}
+
+# Filters loaded by this process, keyed by table
+filters = {}
+
+
+"""64-bit hash of a (chromosome, position) key; chromosomes are compared
+   as MySQL compares them
+"""
+def keyHash(chrom, pos):
+    x = ((zlib.crc32(str(ii.chrom_key(chrom)).encode()) << 40) ^ int(pos))
+    # splitmix64 finalizer
+    x = (x + 0x9e3779b97f4a7c15) & MASK64
+    x = ((x ^ (x >> 30)) * 0xbf58476d1ce4e5b9) & MASK64
+    x = ((x ^ (x >> 27)) * 0x94d049bb133111eb) & MASK64
+    return x ^ (x >> 31)
+
+
+"""Bloom filter over (chromosome, position) keys
+   Sized for n keys at false positive rate fp_rate; the k bit positions
+   of a key come from one 64-bit hash by double hashing. check() is False
+   only for keys that were never added. The counters record how many
+   lookups were checked, how many were skipped as certain misses, and
+   how many passed the filter but found nothing (false positives)
+"""
+class BloomFilter(object):
+    def __init__(self, n=0, fp_rate=0.01, m=None, k=None, bits=None):
+        if m is None:
+            n = max(1, n)
+            m = max(64, int(math.ceil(-n * math.log(fp_rate) /
+                (math.log(2) ** 2))))
+            k = max(1, int(round((m / float(n)) * math.log(2))))
+        self.m = m
+        self.k = k
+        self.bits = bits if (bits is not None) else bytearray((m + 7) // 8)
+        self.count = 0
+        self.checks = 0
+        self.skips = 0
+        self.false_positives = 0
+
+    def positions(self, chrom, pos):
+        h = keyHash(chrom, pos)
+        h1 = h & 0xffffffff
+        h2 = (h >> 32) | 1
+        return [(h1 + i * h2) % self.m for i in range(0, self.k)]
+
+    def add(self, chrom, pos):
+        bits = self.bits
+        for b in self.positions(chrom, pos):
+            bits[b >> 3] |= (1 << (b & 7))
+        self.count = self.count + 1
+
+    def mayContain(self, chrom, pos):
+        bits = self.bits
+        for b in self.positions(chrom, pos):
+            if not (bits[b >> 3] & (1 << (b & 7))):
+                return False
+        return True
+
+    """False when the key is certainly absent and the lookup can be skipped
+    """
+    def check(self, chrom, pos):
+        self.checks = self.checks + 1
+        if self.mayContain(chrom, pos):
+            return True
+        self.skips = self.skips + 1
+        return False
+
+    """Records the outcome of a lookup that passed the filter
+    """
+    def found(self, hit):
+        if not hit:
+            self.false_positives = self.false_positives + 1
+
+    """Share of the lookups that missed which the filter let through;
+       filters whose rate is well above the rate they were built for are
+       too small for their tables. Lookups at a position in the table
+       that found no row with their alleles count as false positives, so
+       this is an upper bound
+    """
+    def falsePositiveRate(self):
+        misses = self.skips + self.false_positives
+        return (self.false_positives / float(misses)) if (misses > 0) else 0.0
+
+    def stats(self):
+        return {'checks': self.checks, 'skips': self.skips,
+            'false_positives': self.false_positives,
+            'skip_rate': round(self.skips / float(self.checks), 4)
+                if (self.checks > 0) else 0.0,
+            'false_positive_rate': round(self.falsePositiveRate(), 4),
+            'keys': self.count, 'bits': self.m, 'hashes': self.k}
+
+    """Writes the filter atomically: a header line of JSON after the magic
+       bytes, then the bit array
+    """
+    def save(self, path, info=None):
+        header = dict(info or {})
+        header.update({'m': self.m, 'k': self.k, 'count': self.count})
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as fh:
+            fh.write(MAGIC)
+            data = json.dumps(header).encode()
+            fh.write(struct.pack('<I', len(data)))
+            fh.write(data)
+            fh.write(self.bits)
+        os.replace(tmp, path)
+
+
+def load(path):
+    with open(path, 'rb') as fh:
+        if (fh.read(len(MAGIC)) != MAGIC):
+            raise ValueError(f"{path} is not a Bloom filter")
+        size = struct.unpack('<I', fh.read(4))[0]
+        header = json.loads(fh.read(size))
+        bits = bytearray(fh.read())
+    bf = BloomFilter(m=header['m'], k=header['k'], bits=bits)
+    bf.count = header['count']
+    return bf
+
+
+def filterPath(filter_dir, table):
+    return os.path.join(filter_dir, table + '.bloom')
+
+
+"""Directory holding the filters: [ann] BloomDir, or the current version
+   of the local bundle so that filters match the snapshot they were
+   built from
+"""
+def filterDir():
+    path = u.config.get('ann', 'BloomDir', fallback='').strip()
+    if (len(path) == 0 and
+        len(u.config.get('ann', 'Bundle', fallback='').strip()) > 0):
+        path = bundle.resolve(u.config.get('ann', 'Bundle').strip())
+    return path
+
+
+"""Filter for a table if it is listed in [ann] BloomFilters and has been
+   built; None otherwise, and lookups on the table are not filtered
+"""
+def get(table):
+    if table not in filters:
+        names = [x.strip() for x in
+            u.config.get('ann', 'BloomFilters', fallback='').split(',')]
+        path = filterPath(filterDir(), table)
+        filters[table] = load(path) if ((table in names) and
+            (len(filterDir()) > 0) and os.path.exists(path)) else None
+    return filters[table]
+
+
+def stats():
+    return dict([(table, filters[table].stats()) for table in filters
+        if (filters[table] is not None)])
+
+
+"""Builds the filter for a table from a database connection
+   The table is read twice, once to count its rows for sizing
+"""
+def build(conn, table, fp_rate=0.01, fetch_size=10000):
+    chrom_col, pos_col = TABLES[table]
+    cursor = conn.cursor()
+    cursor.execute('select count(*) from ' + table + ';')
+    n = int(cursor.fetchone()[0])
+    cursor.close()
+
+    bf = BloomFilter(n=n, fp_rate=fp_rate)
+    cursor = conn.cursor(pymysql.cursors.SSCursor)
+    cursor.execute('select ' + chrom_col + ', ' + pos_col + ' from ' +
+        table + ';')
+    while True:
+        batch = cursor.fetchmany(fetch_size)
+        if (len(batch) == 0):
+            break
+        for chrom, pos in batch:
+            if pos is not None:
+                bf.add(chrom, pos)
+    cursor.close()
+    return bf
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        backend = sys.argv[2] if (len(sys.argv) > 2) else 'mysql'
+        fp_rate = u.config.getfloat('ann', 'BloomFpRate', fallback=0.01)
+        os.makedirs(sys.argv[1], exist_ok=True)
+        conn = u.connect(backend)
+        try:
+            for table in TABLES:
+                bf = build(conn, table, fp_rate=fp_rate)
+                bf.save(filterPath(sys.argv[1], table),
+                    info={'table': table, 'backend': backend,
+                    'fp_rate': fp_rate, 'created': int(time.time())})
+                print(f"Built filter for {table}: {bf.count} keys, " +
+                    f"{len(bf.bits)} bytes")
+        finally:
+            conn.close()
+    else:
+        print("A filter directory must be provided as input to this program.")
+
+### EOF
@@ -0,0 +1,304 @@
+# bundle.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Local reference bundle: a versioned SQLite snapshot of the annotator
+# database, and the connection used to annotate from it
+#
+# Usage: python bundle.py <bundle_dir> [version]
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import sqlite3
+import decimal
+import datetime
+import pymysql
+
+DB_FILE = 'annotator.db'
+MANIFEST_FILE = 'manifest.json'
+# Name of the version a bundle directory currently points to
+CURRENT_FILE = 'CURRENT'
+
+TFBS_CHROMS = ['1','2','3','4','5','6','7','8','9','10','11','12','13',
+    '14','15','16','17','18','19','20','21','22','X','Y']
+
+# Tables used by the pipeline and the composite indexes matching its
+# lookups; column names are matched case-insensitively
+TABLES = [
+    ('dbSNP', [('CHR', 'POS')]),
+    ('chrom_pos_equal_base', [('CHR', 'start')]),
+    ('chrom_pos_equal_nobase', [('CHR', 'start')]),
+    ('chrom_pos_unequal', [('CHR', 'start', 'end')]),
+    ('refGene', [('chrom', 'txStart', 'txEnd')]),
+    ('cpgIslandExt', [('chrom', 'chromStart', 'chromEnd')]),
+    ('cytoBand', [('chrom', 'chromStart', 'chromEnd')]),
+    ('gadAll', [('chromosome', 'chromStart', 'chromEnd')]),
+    ('gwasCatalog', [('chrom', 'chromEnd')]),
+    ('targetScanS', [('chrom', 'chromStart', 'chromEnd')]),
+    ('hugo', [('chrom', 'chromStart', 'chromEnd')]),
+    ('dgv_Cnv', [('chrom', 'chromStart', 'chromEnd')]),
+    ('abParts_IG_T_CelReceptors', [('chrom', 'chromStart', 'chromEnd')]),
+    ('mcCarroll_Cnv', [('chrom', 'chromStart', 'chromEnd')]),
+    ('conrad_Cnv', [('chrom', 'chromStart', 'chromEnd')]),
+    ('genomicSuperDups', [('chrom', 'chromStart', 'chromEnd')]),
+] + [('tfbsConsSites' + c, [('chromStart', 'chromEnd')]) for c in TFBS_CHROMS]
+
+# MySQL column types stored as integers, reals and blobs; everything else
+# is text compared case-insensitively, as with MySQL's default collation
+INTEGER_TYPES = ['tinyint', 'smallint', 'mediumint', 'int', 'integer',
+    'bigint', 'bit', 'year']
+REAL_TYPES = ['float', 'double', 'real']
+BLOB_TYPES = ['tinyblob', 'blob', 'mediumblob', 'longblob', 'binary',
+    'varbinary']
+
+
+def sqliteType(mysql_type):
+    mysql_type = mysql_type.lower()
+    if mysql_type in INTEGER_TYPES:
+        return 'INTEGER'
+    if mysql_type in REAL_TYPES:
+        return 'REAL'
+    if mysql_type in BLOB_TYPES:
+        return 'BLOB'
+    return 'TEXT COLLATE NOCASE'
+
+
+"""Values sqlite3 cannot bind are stored as the text str() gives for them,
+   so annotations read back the same
+"""
+def sqliteValue(value):
+    if isinstance(value, (decimal.Decimal, datetime.date,
+        datetime.timedelta)):
+        return str(value)
+    return value
+
+
+def quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+"""Copies one table, in the order MySQL returns it, and builds its indexes
+"""
+def exportTable(src, dst, table, indexes, fetch_size=10000):
+    cursor = src.cursor()
+    cursor.execute('select column_name, data_type from ' +
+        'information_schema.columns where table_schema = database() ' +
+        'and table_name = %s order by ordinal_position;', (table,))
+    columns = [(str(x[0]), str(x[1])) for x in cursor.fetchall()]
+    cursor.close()
+    if (len(columns) == 0):
+        print(f"Table {table} not found; skipped")
+        return None
+
+    dst.execute('create table ' + quote(table) + ' (' +
+        ', '.join([quote(c) + ' ' + sqliteType(t) for c, t in columns]) + ');')
+
+    insert = 'insert into ' + quote(table) + ' values (' + \
+        ', '.join(['?'] * len(columns)) + ');'
+    cursor = src.cursor(pymysql.cursors.SSCursor)
+    cursor.execute('select * from ' + table + ';')
+    rows = 0
+    while True:
+        batch = cursor.fetchmany(fetch_size)
+        if (len(batch) == 0):
+            break
+        dst.executemany(insert,
+            [[sqliteValue(x) for x in row] for row in batch])
+        rows = rows + len(batch)
+    cursor.close()
+
+    names = dict([(c.lower(), c) for c, t in columns])
+    built = []
+    for index in indexes:
+        if not all([x.lower() in names for x in index]):
+            print(f"Table {table} has no columns {index}; index skipped")
+            continue
+        cols = [names[x.lower()] for x in index]
+        name = 'ix_' + table + '_' + '_'.join(cols)
+        dst.execute('create index ' + quote(name) + ' on ' + quote(table) +
+            ' (' + ', '.join([quote(c) for c in cols]) + ');')
+        built.append(cols)
+
+    print(f"Exported {table}: {rows} rows")
+    return {'rows': rows, 'columns': [c for c, t in columns],
+        'indexes': built}
+
+
+"""Exports the pipeline's tables to bundle_dir/<version>
+   The snapshot is written under a temporary name, then renamed and made
+   current, so readers never open a partial bundle
+"""
+def export(src, bundle_dir, version=None):
+    if version is None:
+        version = time.strftime('%Y%m%d%H%M%S')
+    os.makedirs(bundle_dir, exist_ok=True)
+    final_dir = os.path.join(bundle_dir, version)
+    if os.path.exists(final_dir):
+        raise ValueError(f"Bundle version {version} already exists")
+    tmp_dir = os.path.join(bundle_dir, '.' + version + '.tmp')
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    dst = sqlite3.connect(os.path.join(tmp_dir, DB_FILE))
+    dst.execute('pragma journal_mode = off;')
+    dst.execute('pragma synchronous = off;')
+    tables = {}
+    for table, indexes in TABLES:
+        info = exportTable(src, dst, table, indexes)
+        if info is not None:
+            tables[table] = info
+        dst.commit()
+    dst.execute('analyze;')
+    dst.commit()
+    dst.close()
+
+    manifest = {
+        'version': version,
+        'created': int(time.time()),
+        'format': 'sqlite',
+        'tables': tables
+    }
+    with open(os.path.join(tmp_dir, MANIFEST_FILE), 'w') as fh:
+        json.dump(manifest, fh, indent=2)
+
+    os.rename(tmp_dir, final_dir)
+    current = os.path.join(bundle_dir, CURRENT_FILE)
+    with open(current + '.tmp', 'w') as fh:
+        fh.write(version + '\n')
+    os.replace(current + '.tmp', current)
+    return final_dir
+
+
+"""Directory of the bundle version to read: the version a CURRENT file
+   points to, or the path itself
+"""
+def resolve(path):
+    current = os.path.join(path, CURRENT_FILE)
+    if os.path.exists(current):
+        with open(current) as fh:
+            return os.path.join(path, fh.read().strip())
+    return path
+
+
+def manifest(path):
+    with open(os.path.join(resolve(path), MANIFEST_FILE)) as fh:
+        return json.load(fh)
+
+
+# A lookup on one table, to be returned in table order
+SINGLE_TABLE_SELECT = re.compile(
+    r'^\s*select\s.*\sfrom\s+\w+(\s+where\s.*)?;?\s*$', re.I | re.S)
+
+
+"""Rewrites the MySQL dialect used by the annotation queries for SQLite:
+   double-quoted strings become string literals and %s placeholders
+   become ?. Rows come back in table order whichever index answers the
+   query, as the lookups and the interval index expect
+"""
+def toSqlite(sql, args=None):
+    sql = re.sub(r'"([^"]*)"',
+        lambda m: "'" + m.group(1).replace("'", "''") + "'", sql)
+    if args is not None:
+        sql = sql.replace('%s', '?')
+    sql = sql.replace('over ()', 'over (order by rowid)')
+    if ((SINGLE_TABLE_SELECT.match(sql) is not None) and
+        ('order by' not in sql.lower())):
+        sql = sql.rstrip().rstrip(';') + ' order by rowid;'
+    return sql
+
+
+"""Cursor over the bundle with the pymysql calls the pipeline makes
+"""
+class BundleCursor(object):
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    @property
+    def description(self):
+        return self.cursor.description
+
+    @property
+    def rowcount(self):
+        return self.cursor.rowcount
+
+    def execute(self, sql, args=None):
+        if args is None:
+            self.cursor.execute(toSqlite(sql))
+        else:
+            self.cursor.execute(toSqlite(sql, args), tuple(args))
+        return self.cursor.rowcount
+
+    def executemany(self, sql, args):
+        self.cursor.executemany(toSqlite(sql, []),
+            [tuple(x) for x in args])
+        return self.cursor.rowcount
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def fetchmany(self, size=1):
+        return tuple(self.cursor.fetchmany(size))
+
+    def fetchall(self):
+        return tuple(self.cursor.fetchall())
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def close(self):
+        self.cursor.close()
+
+
+"""Read-only connection to a bundle, used in place of the RDS connection
+"""
+class BundleConnection(object):
+    def __init__(self, path):
+        self.path = resolve(path)
+        db = os.path.join(self.path, DB_FILE)
+        if not os.path.exists(db):
+            raise IOError(f"No reference bundle at {self.path}")
+        # Opened read-only; session temporary tables can still be written
+        self.conn = sqlite3.connect('file:' + db + '?mode=ro', uri=True,
+            check_same_thread=False)
+        self.conn.execute('pragma mmap_size = 1073741824;')
+
+    # Cursor classes (e.g. SSCursor) do not apply; every cursor streams
+    def cursor(self, cursorclass=None):
+        return BundleCursor(self.conn.cursor())
+
+    def ping(self, reconnect=True):
+        self.conn.execute('select 1;')
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+def connect(path):
+    return BundleConnection(path)
+
+
+if __name__ == '__main__':
+    import utils as u
+    if len(sys.argv) > 1:
+        version = sys.argv[2] if (len(sys.argv) > 2) else None
+        src = u.mysql_connect()
+        try:
+            path = export(src, sys.argv[1], version=version)
+        finally:
+            src.close()
+        print(f"Bundle written to {path}")
+    else:
+        print("A bundle directory must be provided as input to this program.")
+
+### EOF
\ No newline at end of file
@@ -0,0 +1,185 @@
+# dbpool.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Process-wide pools of reference database connections
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import time
+import threading
+from contextlib import contextmanager
+
+import utils as u
+
+# Pools of this process, one per database backend
+pools = {}
+pools_lock = threading.Lock()
+
+
+"""Pool of connections to one database backend
+   Connections are opened on first use and returned to the pool after
+   each lookup, so every stage of a job (and every job of a long-lived
+   worker) shares them. A connection idle longer than ping_after is
+   pinged before reuse and one idle longer than idle_timeout is closed.
+   At most size connections are shared by lookups, which wait for one
+   when all are in use. Callers holding a connection for a whole stream
+   (the sweep) acquire with wait=False; theirs are not counted against
+   size, so lookups never wait on a stream to finish
+"""
+class ConnectionPool(object):
+    def __init__(self, backend='mysql', size=4, idle_timeout=300,
+        ping_after=30):
+
+        self.backend = backend
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.ping_after = ping_after
+        self.pid = os.getpid()
+        self.cond = threading.Condition()
+        self.idle = []
+        self.open = 0
+        self.streams = set([])
+        self.connects = 0
+        self.reuses = 0
+        self.waits = 0
+        self.failed_pings = 0
+        self.connect_secs = 0.0
+
+    def connect(self):
+        start = time.time()
+        conn = u.connect(self.backend)
+        self.connect_secs = self.connect_secs + (time.time() - start)
+        self.connects = self.connects + 1
+        return conn
+
+    """Idle connection that is still usable, or None
+    """
+    def takeIdle(self):
+        while (len(self.idle) > 0):
+            conn, last_used = self.idle.pop()
+            idle_secs = time.time() - last_used
+            if (idle_secs > self.idle_timeout):
+                self.discard(conn)
+                continue
+            if (idle_secs > self.ping_after):
+                try:
+                    conn.ping(reconnect=False)
+                except Exception:
+                    self.failed_pings = self.failed_pings + 1
+                    self.discard(conn)
+                    continue
+            self.reuses = self.reuses + 1
+            return conn
+        return None
+
+    def discard(self, conn):
+        self.open = self.open - 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def shared(self):
+        return self.open - len(self.streams)
+
+    def acquire(self, wait=True):
+        with self.cond:
+            waited = False
+            while True:
+                conn = self.takeIdle()
+                if conn is not None:
+                    break
+                if (self.shared() < self.size or not wait):
+                    self.open = self.open + 1
+                    break
+                if not waited:
+                    self.waits = self.waits + 1
+                    waited = True
+                self.cond.wait()
+
+        if conn is None:
+            try:
+                conn = self.connect()
+            except Exception:
+                with self.cond:
+                    self.open = self.open - 1
+                    self.cond.notify()
+                raise
+        if not wait:
+            with self.cond:
+                self.streams.add(id(conn))
+        return conn
+
+    """Returns a connection to the pool; broken connections (or ones
+       left in the middle of a result) are closed instead
+    """
+    def release(self, conn, broken=False):
+        with self.cond:
+            self.streams.discard(id(conn))
+            if (broken or self.shared() > self.size):
+                self.discard(conn)
+            else:
+                self.idle.append((conn, time.time()))
+            self.cond.notify()
+
+    def closeIdle(self):
+        with self.cond:
+            while (len(self.idle) > 0):
+                self.discard(self.idle.pop()[0])
+
+    def stats(self):
+        return {'open': self.open, 'streams': len(self.streams),
+            'idle': len(self.idle),
+            'connects': self.connects, 'reuses': self.reuses,
+            'waits': self.waits, 'failed_pings': self.failed_pings,
+            'connect_secs': round(self.connect_secs, 3)}
+
+
+"""Pool for a backend, created from the [ann] Pool* settings
+   Pools inherited from a parent process are dropped without closing
+   their connections, which still belong to the parent
+"""
+def get(backend='mysql'):
+    with pools_lock:
+        pool = pools.get(backend)
+        if (pool is None or pool.pid != os.getpid()):
+            pool = ConnectionPool(backend,
+                size=u.config.getint('ann', 'PoolSize', fallback=4),
+                idle_timeout=u.config.getint('ann', 'PoolIdleTimeout',
+                    fallback=300),
+                ping_after=u.config.getint('ann', 'PoolPingAfter',
+                    fallback=30))
+            pools[backend] = pool
+        return pool
+
+
+"""Borrows a pooled connection for the duration of a with block
+"""
+@contextmanager
+def connection(backend='mysql'):
+    pool = get(backend)
+    conn = pool.acquire()
+    try:
+        yield conn
+    except:
+        pool.release(conn, broken=True)
+        raise
+    pool.release(conn)
+
+
+def closeAll():
+    with pools_lock:
+        for backend in pools:
+            if (pools[backend].pid == os.getpid()):
+                pools[backend].closeIdle()
+
+
+def stats():
+    return dict([(backend, pools[backend].stats()) for backend in pools
+        if (pools[backend].pid == os.getpid())])
+
+### EOF
\ No newline at end of file
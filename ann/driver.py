@@ -12,110 +12,79 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import sys
 import os
-import file_utils as fu
 import annotate as ann
-
-def run(infile, format):
+import dbpool
+import bloom
+import genes
+import parallel as par
+import pipeline as pl
+
+# Get configuration
+from configparser import ConfigParser
+config = ConfigParser(os.environ)
+config.read(os.path.join(os.path.abspath(os.path.dirname(__file__)),
+    'ann_config.ini'))
+
+"""Annotates infile; close_connections=False keeps the pooled database
+   connections open for the next run in this process
+"""
+def run(infile, format, close_connections=True):
 
     print("Running . . .")
 
-    ann.getSnpsFromDbSnp(vcf=infile, format='vcf', tmpextin='', 
-        tmpextout='.1')
-    print("dbSNP - done.")
-    tmpextin = 1
-    tmpextout = 2
-
-    ann.getBigRefGene(vcf=infile, format='vcf', tmpextin='.' + str(tmpextin),
-        tmpextout='.' + str(tmpextout))
-    print("BigRefGene - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.getGenes(vcf=infile, format='vcf', table='refGene', 
-        promoter_offset=500, tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("BigRefGene - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCytoband(vcf=infile, format='vcf', table='cytoBand', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("Cytoband - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGadAll(vcf=infile, format='vcf', table='gadAll', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("gadAll - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGwasCatalog(vcf=infile, format='vcf', 
-        table='gwasCatalog', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("GwasCatalog - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithMiRNA(vcf=infile, format='vcf', table='targetScanS', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("miRNA - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWitHUGOGeneNomenclature(vcf=infile, format='vcf', 
-        table='hugo', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("HUGO Gene Nomenclature Committee - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', table='dgv_Cnv', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("dgv_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='abParts_IG_T_CelReceptors', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("abParts_IG_T_CelReceptors - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='mcCarroll_Cnv', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("mcCarroll_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='conrad_Cnv', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("conrad_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGenomicSuperDups(vcf=infile, format='vcf', 
-        table='genomicSuperDups', tmpextin='.' + str(tmpextin),
-        tmpextout='.' + str(tmpextout))
-    print("genomicSuperDups - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithTfbsConsSites(vcf=infile, table='tfbsConsSites',
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("addOverlapWithTfbsConsSites - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ## Cleanup
-    for i in range(1, tmpextin):
-        fu.delete(infile + '.' + str(i))
-
-    os.rename(infile + '.' + str(tmpextin), infile + '.annot')
-    finalout=(infile + '.annot').replace('.vcf.annot', '.annot.vcf')
-    os.rename(infile + '.annot', finalout)
+    stages = [
+        ann.DbSnpStage(batched=config.getboolean('ann', 'DbSnpBatch',
+            fallback=False)),
+        ann.BigRefGeneStage(),
+        ann.GenesStage(table='refGene', promoter_offset=500),
+        ann.CytobandStage(table='cytoBand'),
+        ann.GadAllStage(table='gadAll'),
+        ann.GwasCatalogStage(table='gwasCatalog'),
+        ann.MiRNAStage(table='targetScanS'),
+        ann.HugoStage(table='hugo'),
+        ann.CnvDatabaseStage(table='dgv_Cnv'),
+        ann.CnvDatabaseStage(table='abParts_IG_T_CelReceptors'),
+        ann.CnvDatabaseStage(table='mcCarroll_Cnv'),
+        ann.CnvDatabaseStage(table='conrad_Cnv'),
+        ann.GenomicSuperDupsStage(table='genomicSuperDups'),
+        ann.TfbsConsSitesStage(table='tfbsConsSites'),
+    ]
+
+    # All stages run in a single pass over the input; no intermediate files
+    finalout = (infile + '.annot').replace('.vcf.annot', '.annot.vcf')
+    block_size = config.getint('ann', 'BlockSize', fallback=10000)
+    workers = config.getint('ann', 'Workers', fallback=1)
+    in_flight = config.getint('ann', 'InFlight', fallback=1)
+    if (workers > 1):
+        par.annotateVcfParallel(infile, finalout, stages,
+            logfile=infile + '.count.log', logmode='w', format=format,
+            block_size=block_size, workers=workers,
+            window=config.getint('ann', 'ShardWindow', fallback=0),
+            in_flight=in_flight)
+    else:
+        if (in_flight > 1):
+            pl.annotateVcfAsync(infile, finalout, stages,
+                logfile=infile + '.count.log', logmode='w', format=format,
+                block_size=block_size, in_flight=in_flight,
+                close_connections=close_connections)
+        else:
+            ann.annotateVcf(infile, finalout, stages,
+                logfile=infile + '.count.log', logmode='w', format=format,
+                block_size=block_size, close_connections=close_connections)
+        for backend, stats in dbpool.stats().items():
+            print(f"Connections to {backend}: {stats['connects']} opened " +
+                f"in {stats['connect_secs']}s, {stats['reuses']} reused, " +
+                f"{stats['waits']} waits")
+        for table, stats in bloom.stats().items():
+            print(f"Bloom filter on {table}: {stats['skips']} of " +
+                f"{stats['checks']} lookups skipped, false positive rate " +
+                f"{stats['false_positive_rate']}")
+        for table, stats in genes.stats().items():
+            print(f"CpG islands from {table}: {stats['hits']} of " +
+                f"{stats['hits'] + stats['misses']} promoter lookups " +
+                f"memoized (hit rate {stats['hit_rate']})")
+
+    for stage in stages:
+        print(f"{stage.label} - done.")
 
 ### EOF
\ No newline at end of file
@@ -0,0 +1,108 @@
+# exact_index.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Compact in-memory hash index for the exact-match reference tables
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import pymysql
+
+from interval_index import chrom_key, column_index
+
+# Bits of a packed key holding the position; the chromosome code is above
+POS_BITS = 40
+# Field separator and NULL marker in encoded rows
+SEP = '\x1f'
+NULL = '\x00'
+
+
+"""Rows are kept as one string each, which takes a fraction of the memory
+   of a tuple of values; lookups return them as tuples of strings (None
+   for NULL). The stages only use str() of the values, so annotations are
+   the same as from the database
+"""
+def encodeRow(row):
+    return SEP.join([NULL if (x is None) else str(x) for x in row])
+
+
+def decodeRow(text):
+    return tuple([None if (x == NULL) else x for x in text.split(SEP)])
+
+
+"""Exact-position index over a table: a dict from packed (chromosome,
+   position) keys to the row, or the rows, at that position
+   Chromosomes are numbered as they are first seen, so a key is a single
+   int; alleles are matched on the few rows at a position by the caller.
+   Rows at a position are returned in the order they were added
+"""
+class ExactIndex(object):
+    def __init__(self):
+        self.chroms = {}
+        self.slots = {}
+        self.rows = []
+
+    def pack(self, chrom, pos, add=False):
+        key = chrom_key(chrom)
+        code = self.chroms.get(key)
+        if code is None:
+            if not add:
+                return None
+            code = self.chroms[key] = len(self.chroms)
+        return (code << POS_BITS) | int(pos)
+
+    def add(self, chrom, pos, row):
+        key = self.pack(chrom, pos, add=True)
+        slot = len(self.rows)
+        self.rows.append(encodeRow(row))
+        found = self.slots.get(key)
+        if found is None:
+            self.slots[key] = slot
+        elif isinstance(found, int):
+            self.slots[key] = (found, slot)
+        else:
+            self.slots[key] = found + (slot,)
+
+    def lookup(self, chrom, pos):
+        key = self.pack(chrom, pos)
+        found = self.slots.get(key) if (key is not None) else None
+        if found is None:
+            return []
+        if isinstance(found, int):
+            return [decodeRow(self.rows[found])]
+        return [decodeRow(self.rows[x]) for x in found]
+
+    def __len__(self):
+        return len(self.rows)
+
+
+"""Streams a table through an unbuffered cursor on conn into an exact
+   index on pos (and chrom, unless it is None). filters are (column, value)
+   pairs a row must match, compared with matches(value, wanted)
+"""
+def load_exact(conn, table, chrom_col='chrom', pos_col='chromEnd',
+    columns='*', filters=(), matches=None, fetch_size=10000):
+
+    cursor = conn.cursor(pymysql.cursors.SSCursor)
+    cursor.execute('select ' + columns + ' from ' + table + ';')
+    chrom_i = column_index(cursor, chrom_col) \
+        if (chrom_col is not None) else None
+    pos_i = column_index(cursor, pos_col)
+    filters = [(column_index(cursor, c), v) for c, v in filters]
+    names = [str(d[0]) for d in cursor.description]
+
+    index = ExactIndex()
+    while True:
+        batch = cursor.fetchmany(fetch_size)
+        if (len(batch) == 0):
+            break
+        for row in batch:
+            if all([matches(row[i], v) for i, v in filters]):
+                chrom = row[chrom_i] if (chrom_i is not None) else None
+                index.add(chrom, row[pos_i], row)
+    cursor.close()
+    return index, names
+
+### EOF
@@ -0,0 +1,226 @@
+# genes.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Gene structure engine: the regions of every refGene transcript as one
+# labelled interval set per chromosome, and the CpG islands
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import interval_index as ii
+import transcripts as tx
+
+# Region kinds an interval is labelled with
+TRANSCRIPT = 0
+EXON = 1
+CDS = 2
+PROMOTER = 3
+UTR5 = 4
+UTR3 = 5
+
+# A label packs the transcript number, the region kind and the exon
+# number into one int, so the interval set holds no per-interval objects
+KIND_SHIFT = 16
+ITEM_SHIFT = 24
+
+# Positions a CpG island resolver remembers before it starts over
+MEMO_SIZE = 100000
+
+# Structures and CpG island resolvers built by this process
+structures = {}
+resolvers = {}
+
+
+def label(item, kind, exon=0):
+    return (item << ITEM_SHIFT) | (kind << KIND_SHIFT) | exon
+
+
+"""Regions of one transcript containing a position
+"""
+class TranscriptHit(object):
+    def __init__(self, row, model):
+        self.row = row
+        self.model = model
+        self.span = False
+        self.exons = []
+        self.cds = False
+        self.promoter = False
+        self.utr5 = False
+        self.utr3 = False
+
+    """Exons containing the position; transcripts whose exons could not
+       be parsed are checked directly, which fails as the scan always did
+    """
+    def exonsAt(self, pos):
+        if not self.model.complete:
+            return self.model.exonsAt(pos)
+        return self.exons
+
+    def exonLabels(self, pos, prefix):
+        return [prefix + "=" + "ex" + str(self.model.exonNumber(e)) + '/' +
+            str(self.model.exonCount) for e in self.exonsAt(pos)]
+
+
+"""CpG islands of a track, loaded once per worker into an interval index
+   resolve() gives the name of the first island (in table order) holding
+   a position and memoizes it by (chromosome, position), so isoforms that
+   share a promoter, and positions seen again, cost a dict probe
+"""
+class CpgIslandResolver(object):
+    def __init__(self, memo_size=MEMO_SIZE):
+        self.index = ii.IntervalIndex()
+        self.memo = {}
+        self.memo_size = memo_size
+        self.hits = 0
+        self.misses = 0
+
+    def add(self, chrom, start, end, name):
+        self.index.add(chrom, int(start), int(end), name)
+
+    def build(self):
+        self.index.build()
+        return self
+
+    def resolve(self, chrom, pos):
+        key = (ii.chrom_key(chrom), int(pos))
+        if key in self.memo:
+            self.hits = self.hits + 1
+            return self.memo[key]
+        self.misses = self.misses + 1
+        names = self.index.stab(chrom, pos)
+        if (len(self.memo) >= self.memo_size):
+            self.memo = {}
+        name = self.memo[key] = names[0] if (len(names) > 0) else None
+        return name
+
+    def hitRate(self):
+        lookups = self.hits + self.misses
+        return (self.hits / float(lookups)) if (lookups > 0) else 0.0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+            'hit_rate': round(self.hitRate(), 4)}
+
+
+"""Labels of a position: the transcripts whose promoter-padded span holds
+   it, in table order; island() names the CpG island on it, if any
+"""
+class GeneHits(object):
+    def __init__(self, resolver, chrom, pos):
+        self.transcripts = []
+        self.resolver = resolver
+        self.chrom = chrom
+        self.pos = pos
+
+    def island(self):
+        return self.resolver.resolve(self.chrom, self.pos)
+
+
+"""Labelled region intervals of a refGene table
+   Every transcript contributes its span widened by promoter_offset (the
+   rows a lookup would return), its exons, CDS, UTRs and promoter window.
+   Intervals are closed, as u.isBetween compares. Promoters are resolved
+   to CpG islands by the islands resolver
+"""
+class GeneStructure(object):
+    def __init__(self, islands, promoter_offset=500):
+        self.promoter_offset = int(promoter_offset)
+        self.index = ii.IntervalIndex()
+        self.rows = []
+        self.models = []
+        self.islands = islands
+
+    def addTranscript(self, chrom, row):
+        t = len(self.rows)
+        model = tx.TranscriptModel(row, self.promoter_offset)
+        self.rows.append(row)
+        self.models.append(model)
+
+        add = lambda start, end, kind, exon=0: \
+            self.index.add(chrom, start, end, label(t, kind, exon))
+        add(model.promoter_plus, model.promoter_minus, TRANSCRIPT)
+        if model.complete:
+            for e in range(0, model.exonCount):
+                add(model.starts[e], model.ends[e], EXON, e)
+        if (model.cdsStart < model.cdsEnd):
+            add(model.cdsStart, model.cdsEnd, CDS)
+            if (model.strand == '+'):
+                add(model.txStart, model.cdsStart, UTR5)
+                add(model.cdsEnd, model.txEnd, UTR3)
+            elif (model.strand == '-'):
+                add(model.cdsEnd, model.txEnd, UTR5)
+                add(model.txStart, model.cdsStart, UTR3)
+        if (model.strand == '+'):
+            add(model.promoter_plus, model.txStart, PROMOTER)
+        elif (model.strand == '-'):
+            add(model.txEnd, model.promoter_minus, PROMOTER)
+
+    def build(self):
+        self.index.build()
+        return self
+
+    """Everything at a position, from a single stabbing query
+    """
+    def stab(self, chrom, pos):
+        hits = GeneHits(self.islands, chrom, pos)
+        found = {}
+        for x in self.index.stab(chrom, pos):
+            item = x >> ITEM_SHIFT
+            kind = (x >> KIND_SHIFT) & 0xff
+            if item not in found:
+                found[item] = TranscriptHit(self.rows[item],
+                    self.models[item])
+            hit = found[item]
+            if (kind == TRANSCRIPT):
+                hit.span = True
+            elif (kind == EXON):
+                hit.exons.append(x & 0xffff)
+            elif (kind == CDS):
+                hit.cds = True
+            elif (kind == PROMOTER):
+                hit.promoter = True
+            elif (kind == UTR5):
+                hit.utr5 = True
+            elif (kind == UTR3):
+                hit.utr3 = True
+
+        # Only transcripts whose padded span holds the position are hits
+        hits.transcripts = [found[t] for t in sorted(found) if found[t].span]
+        for hit in hits.transcripts:
+            hit.exons.sort()
+        return hits
+
+
+"""Resolver over a CpG island track (chrom, chromStart, chromEnd, name),
+   built once per process from the rows source.scan() returns
+"""
+def get_resolver(source, islands):
+    key = islands.key()
+    if key not in resolvers:
+        resolver = CpgIslandResolver()
+        for row in source.scan(islands):
+            resolver.add(row[0], row[1], row[2], row[3])
+        resolvers[key] = resolver.build()
+    return resolvers[key]
+
+
+"""Structure of a refGene track with the resolver of a CpG island track,
+   built once per process from the rows source.scan() returns for them
+"""
+def get_structure(source, genes, islands, promoter_offset=500):
+    key = (genes.key(), islands.key(), int(promoter_offset))
+    if key not in structures:
+        structure = GeneStructure(get_resolver(source, islands),
+            promoter_offset)
+        for row in source.scan(genes):
+            structure.addTranscript(row[2], row)
+        structures[key] = structure.build()
+    return structures[key]
+
+
+def stats():
+    return dict([(key[0], resolvers[key].stats()) for key in resolvers])
+
+### EOF
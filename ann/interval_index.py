@@ -0,0 +1,186 @@
+# interval_index.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# In-memory interval index for the range overlap reference tracks
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+from array import array
+
+# Indexes loaded by this process, keyed by table and columns
+indexes = {}
+
+
+"""Normalizes chromosome names the way MySQL's default collation
+   compares them (case-insensitive, trailing spaces ignored)
+"""
+def chrom_key(chrom):
+    if chrom is None:
+        return None
+    return str(chrom).rstrip(' ').lower()
+
+
+"""Implicit augmented interval tree over the intervals of one chromosome
+   Intervals are sorted by start and stored in arrays; node i of the tree
+   is element i and maxend[i] holds the largest end in its subtree
+   (the cgranges layout). Intervals are closed: start <= pos <= end
+"""
+class IntervalTree(object):
+    def __init__(self, items):
+        # items: (start, end, ordinal, row), sorted by (start, ordinal)
+        self.n = len(items)
+        self.starts = array('q', [x[0] for x in items])
+        self.ends = array('q', [x[1] for x in items])
+        self.ordinals = array('q', [x[2] for x in items])
+        self.rows = [x[3] for x in items]
+        self.maxend = array('q', self.ends)
+        self.root_k = self.prepare()
+
+    def prepare(self):
+        n = self.n
+        if (n == 0):
+            return -1
+        maxend = self.maxend
+        last_i = 0
+        last = 0
+        for i in range(0, n, 2):
+            last_i = i
+            last = maxend[i] = self.ends[i]
+        k = 1
+        while ((1 << k) <= n):
+            x = 1 << (k - 1)
+            i0 = (x << 1) - 1
+            step = x << 2
+            for i in range(i0, n, step):
+                el = maxend[i - x]
+                er = maxend[i + x] if (i + x < n) else last
+                maxend[i] = max(self.ends[i], el, er)
+            last_i = (last_i - x) if ((last_i >> k) & 1) else (last_i + x)
+            if (last_i < n and maxend[last_i] > last):
+                last = maxend[last_i]
+            k = k + 1
+        return k - 1
+
+    """Element indices of the intervals containing pos
+    """
+    def overlap(self, pos):
+        n = self.n
+        hits = []
+        if (n == 0):
+            return hits
+        starts = self.starts
+        ends = self.ends
+        maxend = self.maxend
+        stack = [(self.root_k, (1 << self.root_k) - 1, 0)]
+        while stack:
+            k, x, w = stack.pop()
+            if (k <= 3):
+                # small subtree; scan it linearly
+                i0 = x >> k << k
+                i1 = min(i0 + (1 << (k + 1)) - 1, n)
+                i = i0
+                while (i < i1 and starts[i] <= pos):
+                    if (pos <= ends[i]):
+                        hits.append(i)
+                    i = i + 1
+            elif (w == 0):
+                # left child first; it may be out of range in an
+                # incomplete tree but still have elements below it
+                y = x - (1 << (k - 1))
+                stack.append((k, x, 1))
+                if (y >= n or maxend[y] >= pos):
+                    stack.append((k - 1, y, 0))
+            elif (x < n and starts[x] <= pos):
+                if (pos <= ends[x]):
+                    hits.append(x)
+                stack.append((k - 1, x + (1 << (k - 1)), 0))
+        return hits
+
+    """Rows containing pos, in the order they were loaded from the table
+    """
+    def stab(self, pos):
+        hits = self.overlap(pos)
+        if (len(hits) > 1):
+            hits.sort(key=lambda i: self.ordinals[i])
+        return [self.rows[i] for i in hits]
+
+
+"""Per-chromosome interval index over the rows of a reference table
+"""
+class IntervalIndex(object):
+    def __init__(self):
+        self.pending = {}
+        self.trees = {}
+        self.size = 0
+
+    def add(self, chrom, start, end, row):
+        key = chrom_key(chrom)
+        if key not in self.pending:
+            self.pending[key] = []
+        self.pending[key].append((int(start), int(end), self.size, row))
+        self.size = self.size + 1
+
+    def build(self):
+        for key in self.pending:
+            items = self.pending[key]
+            items.sort(key=lambda x: (x[0], x[2]))
+            self.trees[key] = IntervalTree(items)
+        self.pending = {}
+        return self
+
+    """Rows with start <= pos <= end on chrom, in table order
+    """
+    def stab(self, chrom, pos):
+        tree = self.trees.get(chrom_key(chrom))
+        if tree is None:
+            return []
+        return tree.stab(int(pos))
+
+
+"""Index of position of a named column in a cursor result
+"""
+def column_index(cursor, name):
+    names = [str(d[0]).lower() for d in cursor.description]
+    return names.index(name.lower())
+
+
+"""Loads a table through the cursor (unbuffered, for large tables) into
+   an interval index, a batch of rows at a time. Without a chrom column
+   all rows are indexed under chrom None; pad widens every interval on
+   both sides
+"""
+def load_index(cursor, table, chrom_col='chrom', start_col='chromStart',
+    end_col='chromEnd', columns='*', pad=0, fetch_size=10000):
+
+    cursor.execute('select ' + columns + ' from ' + table + ';')
+    start_i = column_index(cursor, start_col)
+    end_i = column_index(cursor, end_col)
+    chrom_i = column_index(cursor, chrom_col) \
+        if (chrom_col is not None) else None
+
+    index = IntervalIndex()
+    while True:
+        rows = cursor.fetchmany(fetch_size)
+        if (len(rows) == 0):
+            break
+        for row in rows:
+            index.add(row[chrom_i] if (chrom_i is not None) else None,
+                int(row[start_i]) - pad, int(row[end_i]) + pad, row)
+    return index.build()
+
+
+"""Returns the index for a table, loading it once per process
+"""
+def get_index(cursor, table, chrom_col='chrom', start_col='chromStart',
+    end_col='chromEnd', columns='*', pad=0):
+
+    key = (table, chrom_col, start_col, end_col, columns, pad)
+    if key not in indexes:
+        indexes[key] = load_index(cursor, table, chrom_col=chrom_col,
+            start_col=start_col, end_col=end_col, columns=columns, pad=pad)
+    return indexes[key]
+
+### EOF
\ No newline at end of file
@@ -0,0 +1,345 @@
+# output_check.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Checks that the annotation engine writes the same output as the original
+# chain of one pass per stage: both annotate synthetic VCFs from a
+# synthetic reference bundle, the engine under each of the backend and
+# concurrency settings in CONFIGS, and the results and logs are compared
+# byte for byte
+#
+# Usage: python output_check.py [variants] [seed] [workdir]
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import contextlib
+import filecmp
+import io
+import json
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+
+import utils as u
+import annotate as ann
+import bundle
+import driver
+import sources as src
+import ucsc_bin
+
+# Chromosomes of the synthetic data, positions it spans and its bases
+CHROMS = ['1', '2', 'X', 'MT']
+SPAN = 20000
+BASES = 'ACGT'
+
+# Columns of the chrom_pos_* tables BigRefGeneStage reads
+BIG_REF_GENE_COLUMNS = ['id', 'CHR', 'start', 'end', 'haplotypeReference',
+    'haplotypeAlternate', 'name', 'name2', 'transcriptStrand',
+    'positionType', 'frame', 'mrnaCoord', 'codonCoord', 'spliceDist',
+    'referenceCodon', 'referenceAA', 'variantCodon', 'variantAA',
+    'changesAA', 'functionalClass', 'codingCoordStr', 'proteinCoordStr',
+    'inCodingRegion', 'spliceInfo', 'uorfChange']
+
+# Tables read by the range stages, for the sweep backend
+RANGE_TABLES = ['chrom_pos_unequal', 'refGene', 'cpgIslandExt', 'cytoBand',
+    'gadAll', 'targetScanS', 'hugo', 'dgv_Cnv', 'abParts_IG_T_CelReceptors',
+    'mcCarroll_Cnv', 'conrad_Cnv', 'genomicSuperDups', 'tfbsConsSites']
+ALL_TABLES = ['dbSNP', 'chrom_pos_equal_base', 'chrom_pos_equal_nobase',
+    'gwasCatalog'] + RANGE_TABLES
+
+# [ann] settings the engine is checked under, each over the bundle
+CONFIGS = [
+    ('bundle', {}),
+    ('memory', {'Sources': ', '.join([t + ': memory' for t in ALL_TABLES])}),
+    ('join', {'Sources': ', '.join([t + ': join' for t in ALL_TABLES])}),
+    ('sweep', {'Sources': ', '.join([t + ': sweep' for t in RANGE_TABLES])}),
+    ('StabChunk = 1', {'StabChunk': '1'}),
+    ('InFlight = 4', {'InFlight': '4'}),
+    ('Workers = 4', {'Workers': '4'}),
+    ('mixed, Workers = 4, InFlight = 4', {'Workers': '4', 'InFlight': '4',
+        'ShardWindow': '3000',
+        'Sources': 'dbSNP: memory, refGene: join, cytoBand: sweep, ' +
+        'hugo: memory, tfbsConsSites: sweep'}),
+]
+
+
+"""Rows of each synthetic table, as (table, [(column, MySQL type)], rows)
+"""
+def syntheticTables(rng):
+    def ranges(n, length, prefix='chr'):
+        for i in range(0, n):
+            start = rng.randint(0, SPAN)
+            end = start + rng.randint(0, length)
+            yield (i, prefix + rng.choice(CHROMS), start, end,
+                ucsc_bin.binFromRange(start, max(end, start + 1)))
+
+    tables = []
+    tables.append(('dbSNP', [('CHR', 'varchar'), ('POS', 'int'),
+        ('ID', 'varchar'), ('RSID', 'varchar'), ('REF', 'varchar'),
+        ('ALT', 'varchar'), ('INFO', 'varchar'), ('GMAF', 'varchar')],
+        [(rng.choice(CHROMS), rng.randint(1, SPAN), 'x', 'rs' + str(i),
+            rng.choice(BASES), rng.choice(BASES),
+            rng.choice(['SNV', 'SNV', 'DIV']),
+            rng.choice(['.', '0.01', '0.2'])) for i in range(0, 15000)]))
+
+    types = ['intron', 'non_coding_intron', 'CDS', 'non_coding_exon',
+        'utr5', 'utr3', 'CDS']
+    for table in ['chrom_pos_equal_base', 'chrom_pos_equal_nobase',
+        'chrom_pos_unequal']:
+        rows = []
+        for i in range(0, 800):
+            start = rng.randint(1, SPAN)
+            end = start if (table != 'chrom_pos_unequal') else \
+                start + rng.randint(0, 30)
+            rows.append((i, rng.choice(CHROMS), start, end,
+                rng.choice(BASES), rng.choice(BASES),
+                'NM_' + str(rng.randint(0, 50)),
+                'G' + str(rng.randint(0, 50)), rng.choice('+-'),
+                rng.choice(types), rng.randint(0, 2)) +
+                tuple([rng.choice(['0', '', 'v' + str(rng.randint(0, 5))])
+                for x in BIG_REF_GENE_COLUMNS[11:]]))
+        tables.append((table, [(c, 'int' if (c in ['id', 'start', 'end',
+            'frame']) else 'varchar') for c in BIG_REF_GENE_COLUMNS], rows))
+
+    rows = []
+    for i in range(0, 200):
+        chrom = 'chr' + rng.choice(CHROMS)
+        count = rng.randint(1, 6)
+        start = rng.randint(0, SPAN)
+        points = sorted(rng.sample(range(start, start + 3000), 2 * count))
+        starts, ends = points[0::2], points[1::2]
+        if (rng.random() < 0.25):
+            cds_start = cds_end = ends[-1]
+        else:
+            cds_start = rng.randint(starts[0], ends[-1])
+            cds_end = rng.randint(cds_start, ends[-1])
+        rows.append((ucsc_bin.binFromRange(starts[0], ends[-1]),
+            'NM_' + str(i), chrom, rng.choice('+-'), starts[0], ends[-1],
+            cds_start, cds_end, count,
+            (','.join(map(str, starts)) + ',').encode(),
+            (','.join(map(str, ends)) + ',').encode(), 0,
+            'GENE' + str(i % 97), 'cmpl', 'cmpl', b'0,'))
+    tables.append(('refGene', [('bin', 'int'), ('name', 'varchar'),
+        ('chrom', 'varchar'), ('strand', 'varchar'), ('txStart', 'int'),
+        ('txEnd', 'int'), ('cdsStart', 'int'), ('cdsEnd', 'int'),
+        ('exonCount', 'int'), ('exonStarts', 'longblob'),
+        ('exonEnds', 'longblob'), ('score', 'int'), ('name2', 'varchar'),
+        ('cdsStartStat', 'varchar'), ('cdsEndStat', 'varchar'),
+        ('exonFrames', 'longblob')], rows))
+
+    ucsc = [('bin', 'int'), ('chrom', 'varchar'), ('chromStart', 'int'),
+        ('chromEnd', 'int')]
+    tables.append(('cpgIslandExt', ucsc + [('name', 'varchar')],
+        [(b, c, s, e, 'CpG: ' + str(i)) for i, c, s, e, b in
+        ranges(150, 800)]))
+    tables.append(('cytoBand', ucsc[1:] + [('name', 'varchar'),
+        ('gieStain', 'varchar')],
+        [(c, s, e, ('p%d.%d ' % (i % 7, i % 3)) if (i % 5 == 0) else
+        ('q' + str(i % 9)), 'g') for i, c, s, e, b in ranges(100, 2000)]))
+    tables.append(('gadAll', [('chromosome', 'varchar'),
+        ('chromStart', 'int'), ('chromEnd', 'int'),
+        ('geneSymbol', 'varchar'), ('xcol', 'varchar')],
+        [(c, s, e, 'GAD' + str(i % 40), 'x') for i, c, s, e, b in
+        ranges(150, 2000, prefix='')]))
+    rows = []
+    for i in range(0, 800):
+        pos = rng.randint(1, SPAN)
+        rows.append((ucsc_bin.binFromRange(pos - 1, pos),
+            'chr' + rng.choice(CHROMS), pos - 1, pos, 'rs' + str(i),
+            1000 + i, 'a', 'd', 'j', 't', 'Trait ' + str(i % 13)))
+    tables.append(('gwasCatalog', ucsc + [('name', 'varchar'),
+        ('pubMedID', 'int'), ('author', 'varchar'), ('pubDate', 'varchar'),
+        ('journal', 'varchar'), ('title', 'varchar'),
+        ('trait', 'varchar')], rows))
+    tables.append(('targetScanS', ucsc + [('name', 'varchar'),
+        ('score', 'int'), ('strand', 'varchar')],
+        [(b, c, s, e, 'MIR' + str(i), 1, '+') for i, c, s, e, b in
+        ranges(250, 40)]))
+    tables.append(('hugo', ucsc + [('xcol', 'varchar'),
+        ('symbol', 'varchar'), ('descr', 'varchar')],
+        [(b, c, s, e, 'x', 'SYM' + str(i % 30), 'desc; ' + str(i % 4))
+        for i, c, s, e, b in ranges(150, 3000)]))
+    for table in ['dgv_Cnv', 'abParts_IG_T_CelReceptors', 'mcCarroll_Cnv',
+        'conrad_Cnv']:
+        tables.append((table, ucsc + [('name', 'varchar')],
+            [(b, c, s, e, 'cnv' + str(i)) for i, c, s, e, b in
+            ranges(100, 1500)]))
+    tables.append(('genomicSuperDups', ucsc + [('name', 'varchar'),
+        ('score', 'int'), ('strand', 'varchar'), ('otherChrom', 'varchar'),
+        ('otherStart', 'int'), ('otherEnd', 'int')],
+        [(b, c, s, e, 'sd', 1, '+', 'chr2', s * 2, e * 2) for
+        i, c, s, e, b in ranges(100, 1500)]))
+    for chrom in bundle.TFBS_CHROMS:
+        rows = []
+        for i in range(0, 100):
+            start = rng.randint(0, SPAN)
+            end = start + rng.randint(0, 30)
+            rows.append((ucsc_bin.binFromRange(start, max(end, start + 1)),
+                'chr' + chrom, start, end, 'V$TF' + str(i % 20)))
+        tables.append(('tfbsConsSites' + chrom, ucsc + [('name', 'varchar')],
+            rows))
+    return tables
+
+
+"""Writes a bundle of synthetic reference tables to bundle_dir, laid out
+   and indexed as bundle.export lays out the real ones
+"""
+def makeBundle(bundle_dir, seed=1):
+    version = 'synthetic'
+    os.makedirs(os.path.join(bundle_dir, version))
+    db = sqlite3.connect(os.path.join(bundle_dir, version, bundle.DB_FILE))
+    indexes = dict(bundle.TABLES)
+    tables = {}
+    for table, columns, rows in syntheticTables(random.Random(seed)):
+        db.execute('create table ' + bundle.quote(table) + ' (' +
+            ', '.join([bundle.quote(c) + ' ' + bundle.sqliteType(t)
+            for c, t in columns]) + ');')
+        db.executemany('insert into ' + bundle.quote(table) + ' values (' +
+            ', '.join(['?'] * len(columns)) + ');', rows)
+        names = dict([(c.lower(), c) for c, t in columns])
+        for index in indexes.get(table, []):
+            cols = [names[x.lower()] for x in index]
+            db.execute('create index ' +
+                bundle.quote('ix_' + table + '_' + '_'.join(cols)) + ' on ' +
+                bundle.quote(table) + ' (' +
+                ', '.join([bundle.quote(c) for c in cols]) + ');')
+        tables[table] = {'rows': len(rows),
+            'columns': [c for c, t in columns]}
+    db.commit()
+    db.close()
+    with open(os.path.join(bundle_dir, version, bundle.MANIFEST_FILE),
+        'w') as fh:
+        json.dump({'version': version, 'format': 'sqlite',
+            'tables': tables}, fh, indent=2)
+    with open(os.path.join(bundle_dir, bundle.CURRENT_FILE), 'w') as fh:
+        fh.write(version + '\n')
+
+
+"""Writes a VCF of n synthetic variants, in coordinate order if sort is
+   set; some are on chromosomes the tables do not have
+"""
+def makeVcf(path, n, seed=1, sort=False):
+    rng = random.Random(seed)
+    chroms = CHROMS + ['chr1', '7']
+    records = []
+    for i in range(0, n):
+        records.append([rng.choice(chroms), str(rng.randint(1, SPAN)),
+            rng.choice(['.', 'rs1']), rng.choice(BASES),
+            rng.choice(['A', 'C', 'G', 'T', 'G,C']), '.', 'PASS',
+            rng.choice(['.', 'AC=1;AN=2', 'AC=3;', 'DP=10'])] +
+            rng.choice([[], ['GT', '0/1'], ['GT:DP', '1/1:5']]))
+    if sort:
+        records.sort(key=lambda x: (chroms.index(x[0]), int(x[1])))
+    with open(path, 'w') as fh:
+        fh.write('##fileformat=VCFv4.0\n##reference=synthetic\n')
+        fh.write('#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n')
+        for record in records:
+            fh.write('\t'.join(record) + '\n')
+
+
+"""Annotates infile as the pipeline used to: one pass per stage, each
+   writing a temporary file the next reads, straight from the bundle
+"""
+def annotateChain(infile):
+    passes = [
+        lambda x: ann.getSnpsFromDbSnp(vcf=infile, tmpextin='',
+            tmpextout=x, source=src.SqlSource('bundle')),
+        lambda x, y: ann.getBigRefGene(vcf=infile, tmpextin=x, tmpextout=y,
+            source=src.SqlSource('bundle')),
+        lambda x, y: ann.getGenes(vcf=infile, table='refGene',
+            promoter_offset=500, tmpextin=x, tmpextout=y,
+            source=src.SqlSource('bundle')),
+    ] + [(lambda f, table: lambda x, y: f(vcf=infile, table=table,
+        tmpextin=x, tmpextout=y, source=src.SqlSource('bundle')))(f, table)
+        for f, table in [
+        (ann.addOverlapWithCytoband, 'cytoBand'),
+        (ann.addOverlapWithGadAll, 'gadAll'),
+        (ann.addOverlapWithGwasCatalog, 'gwasCatalog'),
+        (ann.addOverlapWithMiRNA, 'targetScanS'),
+        (ann.addOverlapWitHUGOGeneNomenclature, 'hugo'),
+        (ann.addOverlapWithCnvDatabase, 'dgv_Cnv'),
+        (ann.addOverlapWithCnvDatabase, 'abParts_IG_T_CelReceptors'),
+        (ann.addOverlapWithCnvDatabase, 'mcCarroll_Cnv'),
+        (ann.addOverlapWithCnvDatabase, 'conrad_Cnv'),
+        (ann.addOverlapWithGenomicSuperDups, 'genomicSuperDups'),
+        (ann.addOverlapWithTfbsConsSites, 'tfbsConsSites'),
+    ]]
+
+    passes[0]('.1')
+    for i in range(1, len(passes)):
+        passes[i]('.' + str(i), '.' + str(i + 1))
+    for i in range(1, len(passes)):
+        os.remove(infile + '.' + str(i))
+    os.rename(infile + '.' + str(len(passes)),
+        (infile + '.annot').replace('.vcf.annot', '.annot.vcf'))
+
+
+"""Sets [ann] settings for the driver and the sources alike
+"""
+def configure(settings):
+    for config in [u.config, driver.config]:
+        for key, value in settings.items():
+            config.set('ann', key, value)
+
+
+"""Annotates an unsorted and a sorted VCF with the chain and with the
+   engine under each of CONFIGS; returns the (VCF, configuration) pairs
+   whose output differed
+"""
+def check(workdir, variants=1000, seed=1):
+    bundle_dir = os.path.join(workdir, 'bundle')
+    makeBundle(bundle_dir, seed=seed)
+    defaults = dict([(key, driver.config.get('ann', key, fallback=''))
+        for key in ['Bundle', 'DefaultSource', 'Sources', 'Workers',
+        'InFlight', 'ShardWindow', 'StabChunk', 'BloomFilters']])
+    base = {'Bundle': bundle_dir, 'DefaultSource': 'bundle', 'Sources': '',
+        'Workers': '1', 'InFlight': '1', 'ShardWindow': '0',
+        'StabChunk': defaults['StabChunk'] or '64', 'BloomFilters': ''}
+
+    failed = []
+    try:
+        for sort in [False, True]:
+            name = 'sorted' if sort else 'unsorted'
+            chain_dir = os.path.join(workdir, name, 'chain')
+            os.makedirs(chain_dir)
+            makeVcf(os.path.join(chain_dir, 'in.vcf'), variants,
+                seed=seed, sort=sort)
+            configure(base)
+            with contextlib.redirect_stdout(io.StringIO()):
+                annotateChain(os.path.join(chain_dir, 'in.vcf'))
+
+            for i in range(0, len(CONFIGS)):
+                label, settings = CONFIGS[i]
+                run_dir = os.path.join(workdir, name, str(i))
+                os.makedirs(run_dir)
+                shutil.copy(os.path.join(chain_dir, 'in.vcf'), run_dir)
+                configure(dict(base, **settings))
+                with contextlib.redirect_stdout(io.StringIO()):
+                    driver.run(os.path.join(run_dir, 'in.vcf'), 'vcf')
+                same = all([filecmp.cmp(os.path.join(chain_dir, x),
+                    os.path.join(run_dir, x), shallow=False)
+                    for x in ['in.annot.vcf', 'in.vcf.count.log']])
+                print(f"{name} VCF, {label}: " +
+                    ('identical' if same else 'DIFFERENT'))
+                if not same:
+                    failed.append((name, label))
+    finally:
+        configure(defaults)
+    return failed
+
+
+if __name__ == '__main__':
+    variants = int(sys.argv[1]) if (len(sys.argv) > 1) else 1000
+    seed = int(sys.argv[2]) if (len(sys.argv) > 2) else 1
+    workdir = sys.argv[3] if (len(sys.argv) > 3) else tempfile.mkdtemp()
+    failed = check(workdir, variants=variants, seed=seed)
+    if (len(sys.argv) <= 3):
+        shutil.rmtree(workdir, ignore_errors=True)
+    sys.exit(1 if (len(failed) > 0) else 0)
+
+### EOF
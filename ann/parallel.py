@@ -0,0 +1,154 @@
+# parallel.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Chromosome-sharded parallel annotation over a process pool
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import copy
+import shutil
+import tempfile
+import multiprocessing
+from array import array
+
+import annotate as ann
+import pipeline as pl
+
+
+# Shard holding every header line
+HEADER_SHARD = ('#', 0)
+
+
+"""Shard a line belongs to: its chromosome, or (chromosome, window) when
+   windows are used; header lines all go to one shard, and lines without
+   a position go with their chromosome field as is
+"""
+def shardKey(line, sep='\t', window=0):
+    if line.startswith('#'):
+        return HEADER_SHARD
+    fields = line.split(sep)
+    chrom = fields[0].strip()
+    if (window <= 0 or len(fields) < 2):
+        return (chrom, 0)
+    try:
+        return (chrom, int(fields[1].strip()) // window)
+    except ValueError:
+        return (chrom, 0)
+
+
+"""Splits the input into one file per shard
+   Returns the shard files, their line counts, and for every input line
+   the number of the shard holding it
+"""
+def splitVcf(infile, workdir, sep='\t', window=0):
+    shards = {}
+    files = []
+    handles = []
+    sizes = []
+    order = array('I')
+
+    fh = open(infile)
+    for line in fh:
+        key = shardKey(line, sep=sep, window=window)
+        if key not in shards:
+            shards[key] = len(files)
+            files.append(os.path.join(workdir, f"shard{len(files)}.vcf"))
+            handles.append(open(files[-1], "w"))
+            sizes.append(0)
+        i = shards[key]
+        if not line.endswith('\n'):
+            line = line + '\n'
+        handles[i].write(line)
+        sizes[i] = sizes[i] + 1
+        order.append(i)
+    fh.close()
+
+    for fh_shard in handles:
+        fh_shard.close()
+    return files, sizes, order
+
+
+"""Annotates one shard in a pool worker; returns the stage counters
+   Workers keep their database connections open for their next shards
+"""
+def annotateShard(task):
+    infile, outfile, stages, format, sep, block_size, in_flight = task
+    if (in_flight > 1):
+        pl.annotateVcfAsync(infile, outfile, stages, format=format, sep=sep,
+            block_size=block_size, close_connections=False,
+            in_flight=in_flight)
+    else:
+        ann.annotateVcf(infile, outfile, stages, format=format, sep=sep,
+            block_size=block_size, close_connections=False)
+    return [stage.counts() for stage in stages]
+
+
+"""Writes the annotated shards back in the original line order
+"""
+def mergeShards(outfiles, order, outfile):
+    handles = [open(x) for x in outfiles]
+    fh_out = open(outfile, "w")
+    for i in order:
+        fh_out.write(handles[i].readline())
+    fh_out.close()
+    for fh in handles:
+        fh.close()
+
+
+"""Parallel counterpart of annotate.annotateVcf
+   The input is split by chromosome (and into fixed windows of that many
+   bases when window is set, for very large chromosomes); every shard
+   goes through all the stages in a pool of workers, each with its own
+   database connection. Output lines keep the input order and the stage
+   counters are summed before the log is written. Stages are passed
+   unopened and are copied into every shard. With in_flight above 1,
+   shards are annotated by the pipelined engine (see pipeline.py)
+"""
+def annotateVcfParallel(infile, outfile, stages, logfile=None, logmode='a',
+    format='vcf', sep='\t', block_size=10000, workers=None, window=0,
+    in_flight=1):
+
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+
+    workdir = tempfile.mkdtemp(prefix='shards.',
+        dir=os.path.dirname(os.path.abspath(outfile)))
+    try:
+        infiles, sizes, order = splitVcf(infile, workdir, sep=sep,
+            window=window)
+        outfiles = [x + '.annot' for x in infiles]
+
+        # Largest shards first so the pool finishes together; shards get
+        # copies of the stages taken before any counts are added to them
+        fresh = copy.deepcopy(stages)
+        tasks = [(infiles[i], outfiles[i], fresh, format, sep, block_size,
+            in_flight)
+            for i in sorted(range(0, len(infiles)), key=lambda i: -sizes[i])]
+
+        pool = multiprocessing.Pool(processes=max(1, workers))
+        try:
+            for counts in pool.imap_unordered(annotateShard, tasks):
+                for stage, c in zip(stages, counts):
+                    stage.addCounts(c)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+        mergeShards(outfiles, order, outfile)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if logfile is not None:
+        fh_log = open(logfile, logmode)
+        for stage in stages:
+            stage.writeLog(fh_log)
+        fh_log.close()
+
+### EOF
\ No newline at end of file
@@ -0,0 +1,151 @@
+# pipeline.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Pipelined annotation engine: asyncio keeps the stages' lookups in flight
+# on the pooled backends while earlier blocks are being annotated
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import asyncio
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+
+import annotate as ann
+import dbpool
+
+
+"""A block of input lines on its way through the stages
+   Records are parsed for every line some stage annotates, as annotateVcf
+   parses them; variants[s] are the records stage s annotates. done[s] is
+   set once stage s has annotated the block
+"""
+class Block(object):
+    def __init__(self, lines, stages, inds, sep='\t'):
+        self.lines = lines
+        self.records = [None] * len(lines)
+        self.variants = []
+        for stage in stages:
+            variants = []
+            for i in range(0, len(lines)):
+                if stage.isHeader(lines[i]):
+                    continue
+                if self.records[i] is None:
+                    self.records[i] = ann.Variant(lines[i], inds, sep=sep)
+                variants.append(self.records[i])
+            self.variants.append(variants)
+        self.done = [asyncio.Event() for x in stages]
+
+    def text(self):
+        return ''.join([(self.lines[i] if (self.records[i] is None)
+            else self.records[i].text()) + '\n'
+            for i in range(0, len(self.lines))])
+
+
+"""Runs blocks through the stages with their lookups pipelined
+   A stage's lookups for a block (its prefetch) start as soon as the stage
+   has annotated the block before, without waiting for the earlier stages
+   to annotate this one: stages never rewrite the chromosome, position or
+   alleles lookups are made on. Up to in_flight lookups run at once, on a
+   pool of threads borrowing pooled connections. Annotation itself runs
+   on a single thread, stage after stage, so a record is edited by one
+   stage at a time in stage order, and every stage sees its blocks, and
+   makes its lookups, in input order. Blocks are written in input order,
+   and at most lookahead blocks are read ahead of the one being written
+"""
+class Pipeline(object):
+    def __init__(self, stages, in_flight=4, lookahead=2):
+        self.stages = stages
+        self.in_flight = max(1, in_flight)
+        self.lookahead = max(1, lookahead)
+
+    def annotateAll(self, stage, variants):
+        for variant in variants:
+            variant.normalize()
+            stage.annotate(variant)
+
+    async def runStage(self, s, block, previous):
+        loop = asyncio.get_running_loop()
+        stage = self.stages[s]
+        if previous is not None:
+            await previous.done[s].wait()
+        async with self.slots:
+            await loop.run_in_executor(self.lookups, stage.prefetch,
+                block.variants[s])
+        if (s > 0):
+            await block.done[s - 1].wait()
+        await loop.run_in_executor(self.annotator, self.annotateAll, stage,
+            block.variants[s])
+        block.done[s].set()
+
+    async def read(self, fh, inds, sep, block_size, queue):
+        previous = None
+        while True:
+            lines = [line.strip()
+                for line in itertools.islice(fh, block_size)]
+            if (len(lines) == 0):
+                break
+            block = Block(lines, self.stages, inds, sep=sep)
+            tasks = [asyncio.ensure_future(self.runStage(s, block, previous))
+                for s in range(0, len(self.stages))]
+            # Waits while lookahead blocks are queued ahead of the writer
+            await queue.put((block, tasks))
+            previous = block
+        await queue.put(None)
+
+    async def write(self, fh_out, queue):
+        while True:
+            item = await queue.get()
+            if item is None:
+                break
+            block, tasks = item
+            await asyncio.gather(*tasks)
+            fh_out.write(block.text())
+
+    async def run(self, fh, fh_out, inds, sep='\t', block_size=10000):
+        self.slots = asyncio.Semaphore(self.in_flight)
+        self.lookups = ThreadPoolExecutor(max_workers=self.in_flight)
+        self.annotator = ThreadPoolExecutor(max_workers=1)
+        queue = asyncio.Queue(maxsize=self.lookahead)
+        try:
+            await asyncio.gather(self.read(fh, inds, sep, block_size, queue),
+                self.write(fh_out, queue))
+        finally:
+            self.lookups.shutdown(wait=True, cancel_futures=True)
+            self.annotator.shutdown(wait=True, cancel_futures=True)
+
+
+"""Pipelined counterpart of annotate.annotateVcf, taking the same stages
+   and writing the same output; in_flight bounds the lookups running at
+   once across all the stages
+"""
+def annotateVcfAsync(infile, outfile, stages, logfile=None, logmode='a',
+    format='vcf', sep='\t', block_size=10000, close_connections=True,
+    in_flight=4, lookahead=2):
+
+    inds = ann.getFormatSpecificIndices(format=format)
+    for stage in stages:
+        stage.open()
+
+    fh = open(infile)
+    fh_out = open(outfile, "w")
+    pipeline = Pipeline(stages, in_flight=in_flight, lookahead=lookahead)
+    asyncio.run(pipeline.run(fh, fh_out, inds, sep=sep,
+        block_size=block_size))
+
+    if logfile is not None:
+        fh_log = open(logfile, logmode)
+        for stage in stages:
+            stage.writeLog(fh_log)
+        fh_log.close()
+
+    for stage in stages:
+        stage.close()
+    if close_connections:
+        dbpool.closeAll()
+    fh.close()
+    fh_out.close()
+
+### EOF
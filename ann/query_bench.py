@@ -0,0 +1,102 @@
+# query_bench.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Per-query latency of the annotation lookups sent as literal SQL (values
+# written into the statement text, as the stages used to build them) and
+# as parameterized statements
+#
+# Usage: python query_bench.py [backend] [n]
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import sys
+import time
+
+import utils as u
+import sources as src
+
+# Lookups timed, with the query sampling the positions they are made at
+LOOKUPS = [
+    ('dbSNP point lookup', 'point', src.Track('dbSNP', chrom='CHR', pos='POS'),
+        'select CHR, POS from dbSNP'),
+    ('refGene range lookup', 'stab',
+        src.Track('refGene', start='txStart', end='txEnd'),
+        'select chrom, txStart from refGene'),
+    ('cytoBand range lookup', 'stab', src.Track('cytoBand'),
+        'select chrom, chromEnd from cytoBand'),
+]
+
+
+"""Statement with its arguments written into the text
+"""
+def literal(sql, args):
+    return sql % tuple([str(x) if isinstance(x, int) else
+        '"' + str(x).replace('"', '') + '"' for x in args])
+
+
+"""Seconds each statement took to run and fetch, in order
+"""
+def timeStatements(conn, statements, parameterized):
+    times = []
+    cursor = conn.cursor()
+    for sql, args in statements:
+        t = time.perf_counter()
+        if parameterized:
+            cursor.execute(sql, args)
+        else:
+            cursor.execute(literal(sql, args))
+        cursor.fetchall()
+        times.append(time.perf_counter() - t)
+    cursor.close()
+    return times
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+"""Times n lookups of each kind both ways, alternating over a few rounds
+   and keeping each way's best median so caches warm up for both
+"""
+def bench(backend='mysql', n=1000, rounds=3):
+    source = src.SqlSource(backend)
+    conn = u.connect(backend)
+    results = []
+    try:
+        for name, kind, track, sample in LOOKUPS:
+            cursor = conn.cursor()
+            cursor.execute(sample + ' limit ' + str(int(n)) + ';')
+            positions = cursor.fetchall()
+            cursor.close()
+            if (kind == 'point'):
+                statements = [source.lookupSql(track, chrom, pos)
+                    for chrom, pos in positions]
+            else:
+                statements = [source.stabSql(track, chrom, pos)
+                    for chrom, pos in positions]
+
+            best = {True: None, False: None}
+            for r in range(0, rounds):
+                for parameterized in [False, True]:
+                    m = median(timeStatements(conn, statements, parameterized))
+                    if (best[parameterized] is None or m < best[parameterized]):
+                        best[parameterized] = m
+            results.append((name, len(statements), best[False], best[True]))
+    finally:
+        conn.close()
+    return results
+
+
+if __name__ == '__main__':
+    backend = sys.argv[1] if (len(sys.argv) > 1) else 'mysql'
+    n = int(sys.argv[2]) if (len(sys.argv) > 2) else 1000
+    for name, count, lit, par in bench(backend, n):
+        print(f"{name} ({count} queries): literal {lit * 1e6:.1f} us, " +
+            f"parameterized {par * 1e6:.1f} us per query " +
+            f"({(1 - par / lit) * 100 if lit > 0 else 0.0:+.1f}%)")
+
+### EOF
@@ -43,73 +43,114 @@ region_name = config['aws']['AwsRegionName']
 table_name = config['dynamodb']['TABLENAME']
 tpic_arn = config['sns']['arn']
 
+# AWS clients and resources, created once per process and reused by every
+# job it runs
+aws = {}
+
+
+"""Client (or resource) for an AWS service, created once per process
+"""
+def aws_client(service, resource=False):
+  key = (service, resource, os.getpid())
+  if key not in aws:
+    make = boto3.resource if resource else boto3.client
+    aws[key] = make(service, region_name = region_name, config = Config(signature_version = 's3v4'))
+  return aws[key]
+
+
+"""Annotates a job's input file, uploads the results and log file, marks
+   the job COMPLETED and publishes its notification
+   Warm workers (see workers.py) keep their database connections open
+   between jobs with close_connections=False
+"""
+def run_job(input_file, job_id, user_id, email, close_connections=True):
+  # Call the AnnTools pipeline
+  with Timer():
+    driver.run(input_file, 'vcf', close_connections=close_connections)
+  complete_time = int(time.time())
+
+  s3 = aws_client('s3')
+  folder_name = os.path.dirname(input_file)
+
+  # ref: https://boto3.amazonaws.com/v1/documentation/api/1.9.42/guide/s3-example-creating-buckets.html
+  # 1. Upload the results file to S3 results bucket
+  result_file = os.path.basename(input_file)[:-4] + ".annot.vcf"
+  s3_key_result_file  =  'wxh/' + user_id + '/' + job_id + '~' + result_file
+  s3.upload_file(folder_name+ "/" + result_file, 'gas-results', 'wxh/' + user_id + '/' + job_id + '~' + result_file)
+
+  # 2. Upload the log file to S3 results bucket
+  log_file =  os.path.basename(input_file) + ".count.log"
+  s3_key_log_file = 'wxh/' + user_id + '/' + job_id + '~' + log_file
+  s3.upload_file(folder_name+ "/" + log_file, 'gas-results', 'wxh/' + user_id + '/' + job_id + '~' + log_file)
+
+  # 3. Clean up (delete) local job files
+  os.remove(folder_name+ "/" + result_file)
+  os.remove(folder_name+ "/" + log_file)
+
+  # Updates the job item in DynamoDB table 
+  table = aws_client('dynamodb', resource=True).Table(table_name)
+  try:
+    table.update_item(
+      Key = {'job_id':job_id},
+      UpdateExpression = 'SET s3_results_bucket = :val, s3_key_result_file = :val1, s3_key_log_file = :val2, complete_time =:val3, job_status = :val4', 
+      ExpressionAttributeValues = {
+        ':val' : 'gas-results',   # Adds the name of the S3 results bucket
+        ':val1': s3_key_result_file,  # Adds the name of the S3 key for the results file
+        ':val2': s3_key_log_file, # Adds the name of the S3 key for the log file
+        ':val3': complete_time, # Adds the completion time (use the current system time)
+        ':val4': "COMPLETED"  # Updates the “job_status” key to “COMPLETED”
+      }
+    )
+  except botocore.exceptions.ClientError as error:
+    print("Update DynamoDB failed!", error)
+
+  # Publishes a notification to the SNS when job is completed
+  client = aws_client('sns')
+  try:
+    response = client.publish(
+    TopicArn = tpic_arn,
+    Message = json.dumps({
+      "user_id": user_id,
+      "job_id":  job_id ,
+      "s3_key_result_file": s3_key_result_file,
+      "recipients":email,
+      "complete_time": complete_time,
+      "link": "https://wxh-a16-web.ucmpcs.org:4433/annotations" + '/' + job_id
+    })
+    )
+  except botocore.exceptions.ClientError as error:
+    print("Publish notification failed!", error)
+
+
+"""Marks a job FAILED, unless it completed; for jobs lost with the worker
+   running them. Runs on the pool's callers' threads, so it uses a boto3
+   session of its own rather than the process's clients
+"""
+def fail_job(job_id):
+  session = boto3.session.Session()
+  dynamodb = session.resource('dynamodb', region_name = region_name, config = Config(signature_version = 's3v4'))
+  try:
+    dynamodb.Table(table_name).update_item(
+      Key = {'job_id': job_id},
+      UpdateExpression = 'SET job_status = :val',
+      ConditionExpression = 'job_status <> :val1',
+      ExpressionAttributeValues = {
+        ':val': "FAILED",
+        ':val1': "COMPLETED"
+      }
+    )
+  except botocore.exceptions.ClientError as error:
+    print("Update DynamoDB failed!", job_id, error)
+
+
 if __name__ == '__main__':
-    # Call the AnnTools pipeline
-    if len(sys.argv) > 1:
+    if len(sys.argv) > 4:
+        run_job(sys.argv[1], sys.argv[2], sys.argv[3], sys.argv[4])
+    elif len(sys.argv) > 1:
+        # Annotate only, leaving the results next to the input
         with Timer():
             driver.run(sys.argv[1], 'vcf')
-        complete_time = int(time.time())
-        job_id = sys.argv[2]
-        user_id = sys.argv[3]
-        email = sys.argv[4]
-
-        s3 = boto3.client('s3',region_name=region_name, config = botocore.client.Config(signature_version = 's3v4'))
-        folder_name = os.path.dirname(sys.argv[1])
-
-        # ref: https://boto3.amazonaws.com/v1/documentation/api/1.9.42/guide/s3-example-creating-buckets.html
-        # 1. Upload the results file to S3 results bucket
-        result_file = os.path.basename(sys.argv[1])[:-4] + ".annot.vcf"
-        s3_key_result_file  =  'wxh/' + user_id + '/' + job_id + '~' + result_file
-        s3.upload_file(folder_name+ "/" + result_file, 'gas-results', 'wxh/' + user_id + '/' + job_id + '~' + result_file)
-
-        # 2. Upload the log file to S3 results bucket
-        log_file =  os.path.basename(sys.argv[1]) + ".count.log"
-        s3_key_log_file = 'wxh/' + user_id + '/' + job_id + '~' + log_file
-        s3.upload_file(folder_name+ "/" + log_file, 'gas-results', 'wxh/' + user_id + '/' + job_id + '~' + log_file)
-
-        # 3. Clean up (delete) local job files
-        os.remove(folder_name+ "/" + result_file)
-        os.remove(folder_name+ "/" + log_file)
-
-        # Updates the job item in DynamoDB table 
-        dynamodb = boto3.resource('dynamodb', region_name = region_name, config = botocore.client.Config(signature_version = 's3v4'))
-        table = dynamodb.Table(table_name)
-        try:
-          table.update_item(
-            Key = {'job_id':job_id},
-            UpdateExpression = 'SET s3_results_bucket = :val, s3_key_result_file = :val1, s3_key_log_file = :val2, complete_time =:val3, job_status = :val4', 
-            ExpressionAttributeValues = {
-              ':val' : 'gas-results',   # Adds the name of the S3 results bucket
-              ':val1': s3_key_result_file,  # Adds the name of the S3 key for the results file
-              ':val2': s3_key_log_file, # Adds the name of the S3 key for the log file
-              ':val3': complete_time, # Adds the completion time (use the current system time)
-              ':val4': "COMPLETED"  # Updates the “job_status” key to “COMPLETED”
-            }
-          )
-        except botocore.exceptions.ClientError as error:
-          print("Update DynamoDB failed!", error)
-
-        # Publishes a notification to the SNS when job is completed
-        # Open a connection to the SNS service
-        client = boto3.client('sns', region_name = region_name, config=Config(signature_version='s3v4'))
-        try:
-          response = client.publish(
-          TopicArn = tpic_arn,
-          Message = json.dumps({
-            "user_id": user_id,
-            "job_id":  job_id ,
-            "s3_key_result_file": s3_key_result_file,
-            "recipients":email,
-            "complete_time": complete_time,
-            "link": "https://wxh-a16-web.ucmpcs.org:4433/annotations" + '/' + job_id
-          })
-          )
-        except botocore.exceptions.ClientError as error:
-          print("Publish notification failed!", errro)
-       
-
     else:
         print("A valid .vcf file must be provided as input to this program.")
 
 ### EOF
-
@@ -0,0 +1,330 @@
+# scheduler.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Job scheduling for the annotator: how many jobs an instance runs at once,
+# whether its CPU, memory and disk leave room for another, and which of
+# the job requests it holds starts next
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import json
+import os
+import shutil
+import time
+from collections import deque
+
+import utils as u
+
+# Seconds between checks of the instance's resources while jobs are
+# refused, if no job ends sooner
+RECHECK_SECS = 5
+
+# Tiers of service, highest priority first; jobs without one are free
+TIERS = ['premium', 'free']
+
+# Queue waits kept per tier for the percentiles
+WAIT_SAMPLES = 1000
+
+# Bytes per variant assumed for jobs whose variant count is not estimated
+DEFAULT_LINE_BYTES = 100
+
+
+"""Memory available to new processes, in MB, or None where the kernel
+   does not report it
+"""
+def available_memory():
+    try:
+        with open('/proc/meminfo') as fh:
+            for line in fh:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) // 1024
+    except OSError:
+        pass
+    return None
+
+
+"""Admits jobs to a worker pool (see workers.py) while fewer than
+   max_jobs are running and the instance has room for another: a load
+   average per core up to max_load, at least min_memory MB of memory and
+   min_disk MB free on the disk holding path. The load average lags, so
+   it only holds jobs back while some are running here. Settings come
+   from the [ann] MaxJobs (0 = the pool's size), AdmitMaxLoad,
+   AdmitMinMemoryMB and AdmitMinDiskMB settings
+"""
+class Scheduler(object):
+    def __init__(self, pool, path='/', max_jobs=None, max_load=None,
+        min_memory=None, min_disk=None):
+
+        self.pool = pool
+        self.path = path
+        if max_jobs is None:
+            max_jobs = u.config.getint('ann', 'MaxJobs', fallback=0)
+        self.max_jobs = max_jobs if (max_jobs > 0) else pool.size
+        self.max_load = max_load if (max_load is not None) else \
+            u.config.getfloat('ann', 'AdmitMaxLoad', fallback=1.5)
+        self.min_memory = min_memory if (min_memory is not None) else \
+            u.config.getint('ann', 'AdmitMinMemoryMB', fallback=1024)
+        self.min_disk = min_disk if (min_disk is not None) else \
+            u.config.getint('ann', 'AdmitMinDiskMB', fallback=2048)
+
+    """Why another job cannot start now, or None if it can
+    """
+    def refusal(self):
+        busy = self.pool.busy()
+        if (busy >= self.max_jobs):
+            return f"{busy} of {self.max_jobs} jobs running"
+        load = os.getloadavg()[0] / (os.cpu_count() or 1)
+        if (busy > 0 and load > self.max_load):
+            return f"load {load:.2f} per core"
+        memory = available_memory()
+        if (memory is not None and memory < self.min_memory):
+            return f"{memory} MB of memory available"
+        disk = shutil.disk_usage(self.path).free // (1024 * 1024)
+        if (disk < self.min_disk):
+            return f"{disk} MB free on {self.path}"
+        return None
+
+    """Jobs that can start now: the slots left under max_jobs, or none
+       while the instance is short of resources
+    """
+    def free(self):
+        if self.refusal() is not None:
+            return 0
+        return self.max_jobs - self.pool.busy()
+
+    """Blocks until another job can start; messages are not received
+       meanwhile, so they stay on the queue for other instances. idle is
+       called every RECHECK_SECS or so while waiting
+    """
+    def admit(self, idle=None):
+        reason = self.refusal()
+        if reason is None:
+            return
+        print(f"Holding off new jobs: {reason}")
+        while reason is not None:
+            self.pool.wait(RECHECK_SECS)
+            self.pool.respawn()
+            if idle is not None:
+                idle()
+            reason = self.refusal()
+        print("Accepting jobs")
+
+
+"""Weights of the tiers from a comma-separated list of tier: weight
+   pairs, e.g. premium: 4, free: 1; tiers left out weigh 1
+"""
+def parse_weights(text):
+    weights = dict([(tier, 1.0) for tier in TIERS])
+    for item in text.split(','):
+        if (len(item.strip()) > 0):
+            tier, weight = item.split(':')
+            weights[tier.strip()] = float(weight)
+    return weights
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+"""A job request taken from a queue and not yet started
+   The tier is the queue's, if it is set for the queue, or the priority
+   the web tier set on the request. sent is when the request reached the
+   queue (its SentTimestamp), from which queue waits are measured. cost is
+   the job's expected length: the variant count the web tier estimated,
+   else its input size in bytes over DEFAULT_LINE_BYTES, else None.
+   Raises ValueError or KeyError for a message that is not a job request
+"""
+class Job(object):
+    def __init__(self, message, queue_url, tier=None):
+        self.queue_url = queue_url
+        self.receipt_handle = message['ReceiptHandle']
+        self.request = json.loads(json.loads(message['Body'])['Message'])
+        self.job_id = self.request['job_id']
+        self.user_id = self.request['user_id']
+        self.tier = tier or self.request.get('priority', 'free')
+        if self.tier not in TIERS:
+            self.tier = 'free'
+        self.received = time.time()
+        self.renewed = self.received
+        sent = message.get('Attributes', {}).get('SentTimestamp')
+        self.sent = (int(sent) / 1000.0) if sent else self.received
+        self.deferred = False
+        self.cost = None
+        if (self.request.get('estimated_variants') is not None):
+            self.cost = int(self.request['estimated_variants'])
+        elif (self.request.get('input_size') is not None):
+            self.cost = int(self.request['input_size']) // DEFAULT_LINE_BYTES
+
+    """Order jobs of a tier start in: shortest expected first, then those
+       of unknown length, each in the order they were sent
+    """
+    def order(self):
+        return (self.cost is None, self.cost or 0, self.sent)
+
+    def waited(self, now=None):
+        return (now if (now is not None) else time.time()) - self.sent
+
+
+"""Job requests an annotator holds until they can start, and the order
+   they start in
+   Tiers share the starts by weight (weighted fair queueing: the next job
+   is from the waiting tier with the fewest starts per unit of weight; a
+   tier that was idle joins at the others' count, rather than making up
+   for the time it was idle). Jobs of a tier start shortest expected
+   first (see Job.order), so short jobs do not queue behind long ones, or
+   in the order they were sent if shortest_first is off. A job that has
+   waited over max_wait seconds since it was sent starts ahead of all
+   others, oldest first, so neither free jobs nor long ones are starved.
+   A user runs at most user_max_jobs jobs at once (0 = no cap): the jobs
+   of a user at the cap are deferred, held until one of theirs ends, and
+   the others' jobs start meanwhile. Users take turns within a tier, the
+   user whose last job started longest ago going first. Settings come
+   from the [ann] Backlog, TierWeights, MaxQueueWait, ShortestFirst and
+   UserMaxJobs settings
+"""
+class Backlog(object):
+    def __init__(self, size=None, weights=None, max_wait=None,
+        shortest_first=None, user_max_jobs=None):
+        self.size = size if (size is not None) else \
+            u.config.getint('ann', 'Backlog', fallback=10)
+        self.weights = weights if (weights is not None) else \
+            parse_weights(u.config.get('ann', 'TierWeights',
+                fallback='premium: 4, free: 1'))
+        self.max_wait = max_wait if (max_wait is not None) else \
+            u.config.getint('ann', 'MaxQueueWait', fallback=600)
+        self.shortest_first = shortest_first \
+            if (shortest_first is not None) else \
+            u.config.getboolean('ann', 'ShortestFirst', fallback=True)
+        self.user_max_jobs = user_max_jobs \
+            if (user_max_jobs is not None) else \
+            u.config.getint('ann', 'UserMaxJobs', fallback=2)
+        self.jobs = dict([(tier, []) for tier in TIERS])
+        self.served = dict([(tier, 0.0) for tier in TIERS])
+        self.waits = dict([(tier, deque(maxlen=WAIT_SAMPLES))
+            for tier in TIERS])
+        self.rescued = dict([(tier, 0) for tier in TIERS])
+        # Start number of each user's last job, jobs deferred and jobs
+        # released back to the queue, per user
+        self.starts = 0
+        self.turns = {}
+        self.deferrals = {}
+        self.released = {}
+
+    def __len__(self):
+        return sum([len(self.jobs[tier]) for tier in TIERS])
+
+    """Job requests that can still be taken on
+    """
+    def room(self):
+        return max(0, self.size - len(self))
+
+    def held(self):
+        return [job for tier in TIERS for job in self.jobs[tier]]
+
+    def add(self, job):
+        waiting = [tier for tier in TIERS if (len(self.jobs[tier]) > 0)]
+        if (job.tier not in waiting and len(waiting) > 0):
+            self.served[job.tier] = max(self.served[job.tier],
+                min([self.served[tier] for tier in waiting]))
+        self.jobs[job.tier].append(job)
+        if self.shortest_first:
+            self.jobs[job.tier].sort(key=lambda x: x.order())
+        else:
+            self.jobs[job.tier].sort(key=lambda x: x.sent)
+
+    """Whether a user with running[user_id] jobs running may start another
+    """
+    def allowed(self, user_id, running):
+        return (self.user_max_jobs <= 0 or
+            running.get(user_id, 0) < self.user_max_jobs)
+
+    """Marks the held jobs of users at their cap deferred, counting each
+       job once; returns the jobs that are not
+    """
+    def defer(self, running):
+        eligible = []
+        for job in self.held():
+            if self.allowed(job.user_id, running):
+                eligible.append(job)
+            elif not job.deferred:
+                job.deferred = True
+                self.deferrals[job.user_id] = \
+                    self.deferrals.get(job.user_id, 0) + 1
+        return eligible
+
+    """First of jobs (in the tier's order) of the user whose turn it is
+    """
+    def pick(self, jobs):
+        users = list(dict.fromkeys([job.user_id for job in jobs]))
+        user_id = min(users, key=lambda x: self.turns.get(x, 0))
+        return [job for job in jobs if (job.user_id == user_id)][0]
+
+    """Removes and returns the job to start next, or None if no job can
+       start; running maps users to the jobs they have running
+    """
+    def next(self, running=None):
+        now = time.time()
+        eligible = self.defer(running or {})
+        waiting = [tier for tier in TIERS
+            if any([job.tier == tier for job in eligible])]
+        if (len(waiting) == 0):
+            return None
+        oldest = min(eligible, key=lambda x: x.sent)
+        tier = min(waiting, key=lambda x: self.served[x])
+        job = self.pick([x for x in eligible if (x.tier == tier)])
+        if (oldest.waited(now) > self.max_wait):
+            if (oldest is not job):
+                self.rescued[oldest.tier] = self.rescued[oldest.tier] + 1
+            tier = oldest.tier
+            job = oldest
+        self.jobs[tier].remove(job)
+        self.served[tier] = self.served[tier] + 1.0 / self.weights[tier]
+        self.waits[tier].append(job.waited(now))
+        self.starts = self.starts + 1
+        self.turns[job.user_id] = self.starts
+        return job
+
+    """Removes and returns the deferred jobs, to be handed back to their
+       queue and make room for other users' jobs
+    """
+    def release(self, running):
+        eligible = self.defer(running)
+        released = [job for job in self.held() if job not in eligible]
+        for job in released:
+            self.jobs[job.tier].remove(job)
+            self.released[job.user_id] = \
+                self.released.get(job.user_id, 0) + 1
+        return released
+
+    """Queue waits of the jobs started, per tier: the median, 90th and 99th
+       percentiles in seconds over the last WAIT_SAMPLES jobs, and how many
+       jobs were started ahead of their turn for having waited too long
+    """
+    def stats(self):
+        stats = {}
+        for tier in TIERS:
+            waits = list(self.waits[tier])
+            stats[tier] = {'jobs': len(waits), 'held': len(self.jobs[tier]),
+                'rescued': self.rescued[tier]}
+            for p in [50, 90, 99]:
+                stats[tier]['p' + str(p)] = \
+                    round(percentile(waits, p), 1) if waits else None
+        return stats
+
+    """Deferrals per user: jobs deferred for the user being at their cap,
+       how many of those were released back to the queue, and how many of
+       the user's jobs are held now
+    """
+    def userStats(self):
+        held = {}
+        for job in self.held():
+            held[job.user_id] = held.get(job.user_id, 0) + 1
+        return dict([(user_id, {'deferred': self.deferrals[user_id],
+            'released': self.released.get(user_id, 0),
+            'held': held.get(user_id, 0)}) for user_id in self.deferrals])
+
+### EOF
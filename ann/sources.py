@@ -0,0 +1,717 @@
+# sources.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Backends the annotation stages read reference tables from
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import pymysql
+
+import utils as u
+import dbpool
+import interval_index as ii
+import exact_index as ei
+import sweep as sw
+import bloom
+import ucsc_bin as ub
+
+# Backends a table can be placed on in [ann] Sources
+BACKENDS = ['mysql', 'bundle', 'memory', 'sweep', 'join']
+
+# Session temporary table the join backend loads a batch of lookups into
+QUERY_TABLE = 'ann_queries'
+
+# Point lookup tables loaded by this process into memory
+points = {}
+
+
+"""Value a position is bound as; numeric positions are bound as integers
+   so that they compare as numbers with untyped columns too
+"""
+def bindPos(pos):
+    return int(pos) if str(pos).isdigit() else str(pos)
+
+
+"""Compares values the way MySQL's default collation does
+   (case-insensitive, trailing spaces ignored)
+"""
+def mysqlEquals(a, b):
+    return str(a).rstrip(' ').lower() == str(b).rstrip(' ').lower()
+
+
+"""Layout of a reference table: the columns lookups match on
+   chrom is None when the table holds a single chromosome. Point lookups
+   match pos (and ref/alt); range lookups match start <= pos <= end,
+   widened by pad on both sides. filters are (column, value) pairs every
+   row must match. name is the table name used in the configuration
+"""
+class Track(object):
+    def __init__(self, table, chrom='chrom', start='chromStart',
+        end='chromEnd', pos=None, ref=None, alt=None, columns='*', pad=0,
+        filters=(), name=None):
+
+        self.table = table
+        self.chrom = chrom
+        self.start = start
+        self.end = end
+        self.pos = pos
+        self.ref = ref
+        self.alt = alt
+        self.columns = columns
+        self.pad = pad
+        self.filters = tuple(filters)
+        self.name = name if (name is not None) else table
+
+    def key(self):
+        return (self.table, self.chrom, self.start, self.end, self.pos,
+            self.ref, self.alt, self.columns, self.pad, self.filters)
+
+
+"""Allele alternatives as (ref, alt) pairs; ref and alt are each None, a
+   value, or a sequence of values matched pairwise
+"""
+def allelePairs(ref, alt):
+    if (ref is None and alt is None):
+        return []
+    refs = [ref] if (ref is None or isinstance(ref, str)) else list(ref)
+    alts = [alt] if (alt is None or isinstance(alt, str)) else list(alt)
+    if (len(refs) == 1):
+        refs = refs * len(alts)
+    if (len(alts) == 1):
+        alts = alts * len(refs)
+    return list(zip(refs, alts))
+
+
+"""Base class for the backends
+   point_lookup returns the rows at a position (with matching alleles),
+   stab the rows whose range contains it; both in table order. The batch
+   forms take a list of queries and return a list of row lists. scan
+   iterates over every row of a track in table order
+"""
+class AnnotationSource(object):
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def point_lookup(self, track, chrom, pos, ref=None, alt=None):
+        raise NotImplementedError
+
+    """queries: (chrom, pos, ref, alt) tuples
+    """
+    def batch_lookup(self, track, queries):
+        return [self.point_lookup(track, chrom, pos, ref, alt)
+            for chrom, pos, ref, alt in queries]
+
+    def stab(self, track, chrom, pos):
+        raise NotImplementedError
+
+    def scan(self, track):
+        raise NotImplementedError
+
+    """First row containing the position, or None
+    """
+    def stab_first(self, track, chrom, pos):
+        rows = self.stab(track, chrom, pos)
+        return rows[0] if (len(rows) > 0) else None
+
+    """queries: (chrom, pos) tuples
+    """
+    def batch_stab(self, track, queries):
+        return [self.stab(track, chrom, pos) for chrom, pos in queries]
+
+
+"""SQL lookups against the RDS database ('mysql') or a local reference
+   bundle ('bundle'); one query per lookup, each on a connection borrowed
+   from the backend's pool
+"""
+class SqlSource(AnnotationSource):
+    def __init__(self, backend='mysql'):
+        self.backend = backend
+        self.bins = u.config.getboolean('ann', 'UcscBins', fallback=True)
+        self.chunk = u.config.getint('ann', 'StabChunk', fallback=64)
+        self.chunk_rows = u.config.getint('ann', 'StabChunkRows',
+            fallback=2000)
+        self.sizers = {}
+
+    """Rows of a query, or its first row; with columns, also the
+       positions of those columns in the result
+    """
+    def query(self, sql, args=None, first=False, columns=()):
+        with dbpool.connection(self.backend) as conn:
+            cursor = conn.cursor()
+            cursor.execute(sql, args)
+            rows = cursor.fetchone() if first else cursor.fetchall()
+            indexes = [ii.column_index(cursor, x) if (x is not None) else None
+                for x in columns]
+            cursor.close()
+        if (len(columns) > 0):
+            return rows, indexes
+        return rows
+
+    """Rows of a query read in batches from an unbuffered cursor, so
+       large results are never held whole; the connection is held until
+       they have all been read
+    """
+    def stream(self, sql, args=None, fetch_size=10000):
+        pool = dbpool.get(self.backend)
+        conn = pool.acquire(wait=False)
+        finished = False
+        try:
+            cursor = conn.cursor(pymysql.cursors.SSCursor)
+            cursor.execute(sql, args)
+            while True:
+                rows = cursor.fetchmany(fetch_size)
+                if (len(rows) == 0):
+                    break
+                for row in rows:
+                    yield row
+            cursor.close()
+            finished = True
+        finally:
+            pool.release(conn, broken=not finished)
+
+    """Statement selecting the track's columns (and extra ones) where all
+       the (condition, arguments) terms hold, with its arguments
+    """
+    def selectSql(self, track, where, extra=()):
+        sql = 'select ' + ', '.join([track.columns] + list(extra)) + \
+            ' from ' + track.table
+        if (len(where) > 0):
+            sql = sql + ' where ' + ' AND '.join([x[0] for x in where])
+        return sql + ';', [arg for x in where for arg in x[1]]
+
+    def chromSql(self, track, chrom):
+        return track.chrom + ' = %s', [str(chrom)]
+
+    def alleleSql(self, track, ref, alt):
+        terms = []
+        args = []
+        for r, a in allelePairs(ref, alt):
+            term = []
+            if r is not None:
+                term.append(track.ref + ' = %s')
+                args.append(str(r))
+            if a is not None:
+                term.append(track.alt + ' = %s')
+                args.append(str(a))
+            terms.append('(' + ' AND '.join(term) + ')')
+        return '(' + ' OR '.join(terms) + ')', args
+
+    def filterSql(self, track):
+        return [(c + ' = %s', [str(v)]) for c, v in track.filters]
+
+    def lookupSql(self, track, chrom, pos, ref=None, alt=None):
+        where = [self.chromSql(track, chrom),
+            (track.pos + ' = %s', [bindPos(pos)])]
+        if (ref is not None or alt is not None):
+            where.append(self.alleleSql(track, ref, alt))
+        return self.selectSql(track, where + self.filterSql(track))
+
+    """Whether range queries on a table can be narrowed by its UCSC bin
+       column
+    """
+    def binned(self, track):
+        if not self.bins:
+            return False
+        with dbpool.connection(self.backend) as conn:
+            return ub.isBinned(conn, self.backend, track.table)
+
+    """Rows overlapping any position from low to high; extra columns are
+       selected after the track's
+    """
+    def windowSql(self, track, chrom, low, high, extra=()):
+        start = track.start
+        end = track.end
+        if (track.pad != 0):
+            start = '(' + start + ' - ' + str(int(track.pad)) + ')'
+            end = '(' + end + ' + ' + str(int(track.pad)) + ')'
+        where = [('(' + start + ' <= %s AND %s <= ' + end + ')',
+            [bindPos(high), bindPos(low)])]
+        if (str(low).isdigit() and str(high).isdigit() and
+            self.binned(track)):
+            where.insert(0, ub.binSql(int(low) - int(track.pad),
+                int(high) + int(track.pad)))
+        if track.chrom is not None:
+            where.insert(0, self.chromSql(track, chrom))
+        return self.selectSql(track, where + self.filterSql(track), extra)
+
+    def stabSql(self, track, chrom, pos):
+        return self.windowSql(track, chrom, pos, pos)
+
+    def point_lookup(self, track, chrom, pos, ref=None, alt=None):
+        return self.query(*self.lookupSql(track, chrom, pos, ref, alt))
+
+    """One query per chromosome for all the positions; rows are matched
+       back to the queries by position and alleles
+    """
+    def batch_lookup(self, track, queries):
+        positions = {}
+        for chrom, pos, ref, alt in queries:
+            if str(chrom) not in positions:
+                positions[str(chrom)] = set([])
+            positions[str(chrom)].add(int(pos))
+
+        found = {}
+        for chrom in positions:
+            values = sorted(positions[chrom])
+            sql, args = self.selectSql(track, [self.chromSql(track, chrom),
+                (track.pos + ' IN (' + ','.join(['%s'] * len(values)) + ')',
+                values)] + self.filterSql(track))
+            rows, (pos_i, ref_i, alt_i) = self.query(sql, args,
+                columns=(track.pos, track.ref, track.alt))
+            for row in rows:
+                key = (chrom, int(row[pos_i]))
+                if key not in found:
+                    found[key] = []
+                found[key].append((row, ref_i, alt_i))
+
+        results = []
+        for chrom, pos, ref, alt in queries:
+            candidates = found.get((str(chrom), int(pos)), [])
+            results.append(matchAlleles(candidates, ref, alt))
+        return results
+
+    def stab(self, track, chrom, pos):
+        return self.query(*self.stabSql(track, chrom, pos))
+
+    """Rows of one query over a window of positions, resolved to each of
+       them locally, in the order the query returned them
+    """
+    def windowStab(self, track, chrom, positions):
+        index = ii.IntervalIndex()
+        count = 0
+        for row in self.stream(*self.windowSql(track, chrom, positions[0],
+            positions[-1], extra=(track.start, track.end))):
+            count = count + 1
+            if (row[-2] is not None and row[-1] is not None):
+                index.add('', int(row[-2]) - int(track.pad),
+                    int(row[-1]) + int(track.pad), row[0:-2])
+        index.build()
+        return count, dict([(pos, index.stab('', pos)) for pos in positions])
+
+    """Positions are grouped by chromosome and looked up a window at a
+       time (see WindowSizer); StabChunk = 1 queries them one by one
+    """
+    def batch_stab(self, track, queries):
+        if (self.chunk <= 1):
+            return AnnotationSource.batch_stab(self, track, queries)
+
+        positions = {}
+        for chrom, pos in queries:
+            if str(pos).isdigit():
+                positions.setdefault(str(chrom), set([])).add(int(pos))
+
+        key = track.key()
+        if key not in self.sizers:
+            self.sizers[key] = WindowSizer(self.chunk, self.chunk_rows)
+        sizer = self.sizers[key]
+
+        found = {}
+        for chrom in positions:
+            for window in sizer.windows(sorted(positions[chrom])):
+                count, rows = self.windowStab(track, chrom, window)
+                sizer.observe(window, count)
+                for pos in window:
+                    found[(chrom, pos)] = rows[pos]
+
+        return [found[(str(chrom), int(pos))] if str(pos).isdigit()
+            else self.stab(track, chrom, pos) for chrom, pos in queries]
+
+    """Rows of the whole track, streamed
+    """
+    def scan(self, track):
+        return self.stream(*self.selectSql(track, self.filterSql(track)))
+
+    def stab_first(self, track, chrom, pos):
+        sql, args = self.stabSql(track, chrom, pos)
+        return self.query(sql, args, first=True)
+
+
+"""Sizes the windows of positions chunked range lookups query together
+   A window holds up to k positions; k halves after a window returns more
+   than target rows and doubles after a full window returns less than a
+   quarter of that. The rows per base seen so far also cap the span of a
+   window, so one reaching into a dense region does not pull in a huge
+   result set
+"""
+class WindowSizer(object):
+    def __init__(self, max_k=64, target=2000):
+        self.max_k = max(1, max_k)
+        self.k = self.max_k
+        self.target = target
+        self.density = None
+
+    def span(self):
+        if not self.density:
+            return float('inf')
+        return self.target / self.density
+
+    """Consecutive windows of sorted positions, each sized as the
+       observations so far allow
+    """
+    def windows(self, positions):
+        i = 0
+        while (i < len(positions)):
+            j = i + 1
+            span = self.span()
+            while (j < len(positions) and (j - i) < self.k and
+                (positions[j] - positions[i]) <= span):
+                j = j + 1
+            yield positions[i:j]
+            i = j
+
+    def observe(self, window, rows):
+        if (rows > self.target):
+            self.k = max(1, self.k // 2)
+        elif (rows * 4 < self.target and len(window) >= self.k):
+            self.k = min(self.max_k, self.k * 2)
+        density = rows / float(window[-1] - window[0] + 1)
+        self.density = density if (self.density is None) else \
+            (self.density + density) / 2.0
+
+
+"""Rows of (row, ref column, alt column) whose alleles match a lookup
+"""
+def matchAlleles(candidates, ref, alt):
+    pairs = allelePairs(ref, alt)
+    if (len(pairs) == 0):
+        return [x[0] for x in candidates]
+    rows = []
+    for row, ref_i, alt_i in candidates:
+        for r, a in pairs:
+            if ((r is None or mysqlEquals(row[ref_i], r)) and
+                (a is None or mysqlEquals(row[alt_i], a))):
+                rows.append(row)
+                break
+    return rows
+
+
+"""Whole tables held in memory: an interval index for range lookups and
+   a compact exact index (see exact_index.py) for point lookups, loaded
+   once per process from the given database backend
+"""
+class MemorySource(AnnotationSource):
+    def __init__(self, backend='mysql'):
+        self.backend = backend
+        self.ranges = {}
+
+    def pointIndex(self, track):
+        key = track.key()
+        if key not in points:
+            with dbpool.connection(self.backend) as conn:
+                index, names = ei.load_exact(conn, track.table,
+                    chrom_col=track.chrom, pos_col=track.pos,
+                    columns=track.columns, filters=track.filters,
+                    matches=mysqlEquals)
+            names = [x.lower() for x in names]
+            ref_i = names.index(track.ref.lower()) \
+                if (track.ref is not None) else None
+            alt_i = names.index(track.alt.lower()) \
+                if (track.alt is not None) else None
+            points[key] = (index, (ref_i, alt_i))
+        return points[key]
+
+    def rangeIndex(self, track):
+        key = track.key()
+        if key in self.ranges:
+            return self.ranges[key]
+        if (len(track.filters) > 0):
+            raise ValueError(f"Filtered range table {track.table} " +
+                "cannot be held in memory")
+        with dbpool.connection(self.backend) as conn:
+            cursor = conn.cursor(pymysql.cursors.SSCursor)
+            self.ranges[key] = ii.get_index(cursor, track.table,
+                chrom_col=track.chrom, start_col=track.start,
+                end_col=track.end, columns=track.columns, pad=track.pad)
+            cursor.close()
+        return self.ranges[key]
+
+    def point_lookup(self, track, chrom, pos, ref=None, alt=None):
+        index, (ref_i, alt_i) = self.pointIndex(track)
+        return matchAlleles([(row, ref_i, alt_i) for row in
+            index.lookup(chrom if (track.chrom is not None) else None, pos)],
+            ref, alt)
+
+    def stab(self, track, chrom, pos):
+        chrom = chrom if (track.chrom is not None) else None
+        return self.rangeIndex(track).stab(chrom, pos)
+
+    def scan(self, track):
+        return SqlSource(self.backend).scan(track)
+
+
+"""Range lookups by a sweep over tracks streamed in start order, for
+   coordinate-sorted input (see sweep.py). The first out-of-order lookup
+   ends the sweep and it and all later lookups go to the fallback source.
+   One table is swept at a time; moving on to another table finishes the
+   current one, so coming back to it also counts as out of order
+"""
+class SweepSource(AnnotationSource):
+    def __init__(self, backend='mysql', fallback=None):
+        self.backend = backend
+        self.fallback = fallback if (fallback is not None) else \
+            MemorySource(backend)
+        self.sweep = None
+        self.table = None
+        self.done = set([])
+        self.sorted = True
+
+    def close(self):
+        if self.sweep is not None:
+            self.sweep.close()
+        self.sweep = None
+        self.fallback.close()
+
+    """Streams one chromosome of the track in start order, numbering the
+       rows in table order
+    """
+    def sweepSql(self, track, chrom):
+        where = ''
+        args = []
+        if track.chrom is not None:
+            where = ' where ' + track.chrom + ' = %s'
+            args = [str(chrom)]
+        return 'select * from (select ' + track.columns + ', row_number() ' + \
+            'over () as sweepOrder from ' + track.table + where + \
+            ') as track order by ' + track.start + ';', args
+
+    def sweepStab(self, track, chrom, pos):
+        if (track.table != self.table):
+            if (track.table in self.done):
+                return None
+            if self.sweep is not None:
+                self.sweep.close()
+                self.done.add(self.table)
+            self.table = track.table
+            self.sweep = sw.SweepLine(lambda c: self.sweepSql(track, c),
+                start_col=track.start, end_col=track.end, pad=track.pad,
+                backend=self.backend)
+        return self.sweep.stab(chrom, pos)
+
+    def stab(self, track, chrom, pos):
+        if self.sorted:
+            rows = self.sweepStab(track, chrom, pos)
+            if rows is not None:
+                return rows
+            # input is not sorted; finish the file from the fallback
+            self.sorted = False
+            if self.sweep is not None:
+                self.sweep.close()
+            self.sweep = None
+        return self.fallback.stab(track, chrom, pos)
+
+    def point_lookup(self, track, chrom, pos, ref=None, alt=None):
+        return self.fallback.point_lookup(track, chrom, pos, ref, alt)
+
+    def scan(self, track):
+        return self.fallback.scan(track)
+
+
+"""Set-based lookups: the positions of a batch are loaded into a session
+   temporary table with multi-row inserts, and each track is resolved
+   with one join against it. Rows come back tagged with the number of the
+   lookup they answer, and keep the order the join returns them in (table
+   order on the bundle). Single lookups are plain SqlSource queries
+"""
+class JoinSource(SqlSource):
+    def __init__(self, backend='mysql', insert_size=1000):
+        SqlSource.__init__(self, backend)
+        self.insert_size = insert_size
+        self.order = ' order by q.line, t.rowid' if (backend == 'bundle') \
+            else ''
+
+    def qualify(self, columns):
+        return ', '.join(['t.' + x.strip() for x in columns.split(',')])
+
+    def joinFilterSql(self, track):
+        return [('t.' + c + ' = %s', [str(v)]) for c, v in track.filters]
+
+    """Replaces the lookups in the connection's temporary table
+    """
+    def load(self, conn, keys):
+        cursor = conn.cursor()
+        cursor.execute('create temporary table if not exists ' + QUERY_TABLE +
+            ' (line int primary key, chrom varchar(64), pos bigint);')
+        cursor.execute('delete from ' + QUERY_TABLE + ';')
+        rows = [(i, keys[i][0], keys[i][1]) for i in range(0, len(keys))]
+        for i in range(0, len(rows), self.insert_size):
+            cursor.executemany('insert into ' + QUERY_TABLE +
+                ' (line, chrom, pos) values (%s, %s, %s);',
+                rows[i:i + self.insert_size])
+        cursor.close()
+
+    """Rows of a join of the lookups with a track, one list per lookup;
+       with columns, also the positions of those columns in the rows.
+       The result is streamed from an unbuffered cursor
+    """
+    def join(self, track, keys, on, columns=(), fetch_size=10000):
+        on = on + self.joinFilterSql(track)
+        sql = 'select q.line, ' + self.qualify(track.columns) + ' from ' + \
+            QUERY_TABLE + ' q join ' + track.table + ' t on ' + \
+            ' AND '.join([x[0] for x in on]) + self.order + ';'
+        results = [[] for x in keys]
+        with dbpool.connection(self.backend) as conn:
+            self.load(conn, keys)
+            cursor = conn.cursor(pymysql.cursors.SSCursor)
+            cursor.execute(sql, [arg for x in on for arg in x[1]])
+            indexes = [(ii.column_index(cursor, x) - 1) if (x is not None)
+                else None for x in columns]
+            while True:
+                rows = cursor.fetchmany(fetch_size)
+                if (len(rows) == 0):
+                    break
+                for row in rows:
+                    results[row[0]].append(row[1:])
+            cursor.close()
+            conn.commit()
+        return results, indexes
+
+    """Distinct (chrom, pos) keys of the lookups that can be joined
+    """
+    def keys(self, queries):
+        keys = {}
+        for query in queries:
+            if str(query[1]).isdigit():
+                keys[(str(query[0]), int(query[1]))] = 1
+        return list(keys)
+
+    def chromOn(self, track):
+        return [('t.' + track.chrom + ' = q.chrom', [])] \
+            if (track.chrom is not None) else []
+
+    def batch_lookup(self, track, queries):
+        keys = self.keys(queries)
+        found = {}
+        if (len(keys) > 0):
+            rows, (ref_i, alt_i) = self.join(track, keys,
+                self.chromOn(track) + [('t.' + track.pos + ' = q.pos', [])],
+                columns=(track.ref, track.alt))
+            found = dict(zip(keys, rows))
+
+        results = []
+        for chrom, pos, ref, alt in queries:
+            if str(pos).isdigit():
+                results.append(matchAlleles([(row, ref_i, alt_i) for row in
+                    found[(str(chrom), int(pos))]], ref, alt))
+            else:
+                results.append(self.point_lookup(track, chrom, pos, ref, alt))
+        return results
+
+    def batch_stab(self, track, queries):
+        keys = self.keys(queries)
+        found = {}
+        if (len(keys) > 0):
+            start = 't.' + track.start
+            end = 't.' + track.end
+            if (track.pad != 0):
+                start = '(' + start + ' - ' + str(track.pad) + ')'
+                end = '(' + end + ' + ' + str(track.pad) + ')'
+            rows, indexes = self.join(track, keys, self.chromOn(track) +
+                [(start + ' <= q.pos', []), ('q.pos <= ' + end, [])])
+            found = dict(zip(keys, rows))
+
+        return [found[(str(chrom), int(pos))] if str(pos).isdigit()
+            else self.stab(track, chrom, pos) for chrom, pos in queries]
+
+
+"""Routes each table to the backend configured for it
+   tables maps table names to backend names; others use default. A track
+   split into a table per chromosome (tfbsConsSites1, ...) is routed by
+   its table, else by the name of the whole track. Range lookups and point
+   lookups both go to the table's backend. Point lookups on tables with a
+   Bloom filter (see bloom.py) skip the backend for positions the filter
+   rules out
+"""
+class SourceRouter(AnnotationSource):
+    def __init__(self, default='mysql', tables=None, load='mysql'):
+        self.default = default
+        self.tables = dict(tables or {})
+        self.load = load
+        self.sources = {}
+
+    def make(self, backend):
+        if (backend in ['mysql', 'bundle']):
+            return SqlSource(backend)
+        if (backend == 'memory'):
+            return MemorySource(self.load)
+        if (backend == 'sweep'):
+            return SweepSource(self.load)
+        if (backend == 'join'):
+            return JoinSource(self.load)
+        raise ValueError(f"Unknown annotation source {backend}")
+
+    def source(self, track):
+        backend = self.tables.get(track.table,
+            self.tables.get(track.name, self.default))
+        if backend not in self.sources:
+            self.sources[backend] = self.make(backend)
+            self.sources[backend].open()
+        return self.sources[backend]
+
+    def close(self):
+        for backend in self.sources:
+            self.sources[backend].close()
+        self.sources = {}
+
+    def point_lookup(self, track, chrom, pos, ref=None, alt=None):
+        bf = bloom.get(track.table)
+        if (bf is not None and not bf.check(chrom, pos)):
+            return []
+        rows = self.source(track).point_lookup(track, chrom, pos, ref, alt)
+        if bf is not None:
+            bf.found(len(rows) > 0)
+        return rows
+
+    def batch_lookup(self, track, queries):
+        bf = bloom.get(track.table)
+        if bf is None:
+            return self.source(track).batch_lookup(track, queries)
+
+        passed = [i for i in range(0, len(queries))
+            if bf.check(queries[i][0], queries[i][1])]
+        results = [[] for x in queries]
+        if (len(passed) > 0):
+            rows = self.source(track).batch_lookup(track,
+                [queries[i] for i in passed])
+            for i, found in zip(passed, rows):
+                results[i] = found
+                bf.found(len(found) > 0)
+        return results
+
+    def stab(self, track, chrom, pos):
+        return self.source(track).stab(track, chrom, pos)
+
+    def stab_first(self, track, chrom, pos):
+        return self.source(track).stab_first(track, chrom, pos)
+
+    def scan(self, track):
+        return self.source(track).scan(track)
+
+    def batch_stab(self, track, queries):
+        return self.source(track).batch_stab(track, queries)
+
+
+"""Router for the backends set in ann_config.ini: [ann] DefaultSource and
+   Sources, a comma-separated list of table: backend pairs. memory, sweep
+   and join read tables from the default database backend
+"""
+def configured():
+    default = u.config.get('ann', 'DefaultSource', fallback='mysql').strip()
+    tables = {}
+    for item in u.config.get('ann', 'Sources', fallback='').split(','):
+        if (len(item.strip()) > 0):
+            table, backend = item.split(':')
+            tables[table.strip()] = backend.strip()
+
+    for backend in [default] + list(tables.values()):
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown annotation source {backend}")
+    load = default if (default in ['mysql', 'bundle']) else 'mysql'
+    return SourceRouter(default=default, tables=tables, load=load)
+
+### EOF
\ No newline at end of file
@@ -0,0 +1,131 @@
+# sweep.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Sort-merge (sweep-line) overlap lookups for coordinate-sorted input
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import heapq
+import pymysql
+
+import dbpool
+import interval_index as ii
+
+
+"""Sweeps a reference track alongside a coordinate-sorted VCF
+   For each chromosome the track is streamed sorted by start over an
+   unbuffered cursor on its own connection to the backend; intervals
+   (widened by pad) are admitted as the sweep position passes their start
+   and retired from a heap keyed on end, so memory is bounded by the
+   number of intervals active at a position.
+
+   query(chr) returns the SQL (and its arguments) streaming one
+   chromosome of the track
+   ordered by start, with the row's position in table order appended as
+   the last column; overlapping rows are returned in table order, the
+   order the interval index and the per-variant queries return them in.
+   stab() returns None as soon as the positions it is given are not
+   sorted (a position goes backwards, or a chromosome is seen again after
+   another one); callers fall back to indexed lookups.
+"""
+class SweepLine(object):
+    def __init__(self, query, start_col='chromStart', end_col='chromEnd',
+        pad=0, backend='mysql', fetch_size=1000):
+
+        self.query = query
+        self.start_col = start_col
+        self.end_col = end_col
+        self.pad = pad
+        self.backend = backend
+        self.fetch_size = fetch_size
+        self.conn = None
+        self.cursor = None
+        self.chrom = None
+        self.last_pos = None
+        self.done = set([])
+        self.active = []
+        self.buffer = []
+        self.exhausted = True
+
+    def startChrom(self, chr, key):
+        if self.chrom is not None:
+            self.done.add(self.chrom)
+        if self.conn is None:
+            # held for the whole stream, so never waits for the pool
+            self.conn = dbpool.get(self.backend).acquire(wait=False)
+        if self.cursor is not None:
+            self.cursor.close()
+
+        self.cursor = self.conn.cursor(pymysql.cursors.SSCursor)
+        self.cursor.execute(*self.query(chr))
+        self.start_i = ii.column_index(self.cursor, self.start_col)
+        self.end_i = ii.column_index(self.cursor, self.end_col)
+
+        self.chrom = key
+        self.last_pos = None
+        self.active = []
+        self.buffer = []
+        self.exhausted = False
+
+    """Next streamed row, or None at the end of the chromosome
+    """
+    def nextRow(self):
+        if (len(self.buffer) == 0):
+            if self.exhausted:
+                return None
+            self.buffer = list(self.cursor.fetchmany(self.fetch_size))
+            self.buffer.reverse()
+            if (len(self.buffer) == 0):
+                self.exhausted = True
+                return None
+        return self.buffer.pop()
+
+    def peekRow(self):
+        row = self.nextRow()
+        if row is not None:
+            self.buffer.append(row)
+        return row
+
+    """Rows with start <= pos <= end, ordered by start; None if unsorted
+    """
+    def stab(self, chr, pos):
+        key = ii.chrom_key(chr)
+        pos = int(pos)
+        if (key != self.chrom):
+            if key in self.done:
+                return None
+            self.startChrom(chr, key)
+        elif (pos < self.last_pos):
+            return None
+        self.last_pos = pos
+
+        row = self.peekRow()
+        while (row is not None and
+            int(row[self.start_i]) - self.pad <= pos):
+            self.nextRow()
+            end = int(row[self.end_i]) + self.pad
+            if (end >= pos):
+                heapq.heappush(self.active, (end, int(row[-1]), row[:-1]))
+            row = self.peekRow()
+
+        while (len(self.active) > 0 and self.active[0][0] < pos):
+            heapq.heappop(self.active)
+
+        return [x[2] for x in sorted(self.active, key=lambda x: x[1])]
+
+    """Returns the connection to the pool; one left in the middle of a
+       stream is closed instead of draining the rest of the track
+    """
+    def close(self):
+        if self.conn is not None:
+            finished = self.exhausted and (len(self.buffer) == 0)
+            if finished:
+                self.cursor.close()
+            dbpool.get(self.backend).release(self.conn, broken=not finished)
+        self.conn = None
+        self.cursor = None
+
+### EOF
\ No newline at end of file
@@ -0,0 +1,65 @@
+# transcripts.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Parsed refGene transcript models
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+from array import array
+
+
+"""A refGene transcript with its exons parsed into integer arrays
+   Positions are compared inclusively at both ends, as u.isBetween does.
+   Exons are looked up in the gene structure (see genes.py); exonsAt()
+   checks every exon, in order, for transcripts whose exons could not be
+   parsed
+"""
+class TranscriptModel(object):
+    def __init__(self, row, promoter_offset=500):
+        self.strand = str(row[3])
+        self.txStart = int(row[4])
+        self.txEnd = int(row[5])
+        self.cdsStart = int(row[6])
+        self.cdsEnd = int(row[7])
+        self.exonCount = int(row[8])
+        exonsSt = str(row[9].decode('utf-8')).split(',')
+        exonsEn = str(row[10].decode('utf-8')).split(',')
+
+        self.promoter_plus = self.txStart - int(promoter_offset)
+        self.promoter_minus = self.txEnd + int(promoter_offset)
+
+        n = self.exonCount
+        try:
+            self.starts = array('q', [int(x) for x in exonsSt[0:n]])
+            self.ends = array('q', [int(x) for x in exonsEn[0:n]])
+            self.complete = (len(self.starts) == n and len(self.ends) == n)
+        except ValueError:
+            self.complete = False
+        if not self.complete:
+            # Malformed exons fail in exonsAt(), where the scan did
+            self.exonsSt = exonsSt
+            self.exonsEn = exonsEn
+
+    def isCoding(self):
+        return (self.cdsStart != self.cdsEnd)
+
+    """Indices of the exons containing pos, in exon order
+    """
+    def exonsAt(self, pos):
+        if not self.complete:
+            return [e for e in range(0, self.exonCount)
+                if (int(self.exonsSt[e]) <= pos <= int(self.exonsEn[e]))]
+        return [e for e in range(0, self.exonCount)
+            if (self.starts[e] <= pos <= self.ends[e])]
+
+    """Exon number as annotated: counted from the 5' end of the transcript
+    """
+    def exonNumber(self, e):
+        if (self.strand == '-'):
+            return self.exonCount - e
+        return e + 1
+
+### EOF
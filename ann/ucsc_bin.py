@@ -0,0 +1,203 @@
+# ucsc_bin.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# UCSC binning scheme: the bin column of the UCSC tables, the bins a range
+# query has to look in, and a tool that checks the bins and the indexes
+# range queries need
+#
+# Usage: python ucsc_bin.py [--create]
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import sys
+
+import utils as u
+import bundle
+
+# Bins of each level, smallest (128kb) to largest (512Mb), in the standard
+# scheme; ranges ending past 512Mb use the extended scheme
+BIN_OFFSETS = [512 + 64 + 8 + 1, 64 + 8 + 1, 8 + 1, 1, 0]
+BIN_OFFSETS_EXTENDED = [4096 + 512 + 64 + 8 + 1, 512 + 64 + 8 + 1,
+    64 + 8 + 1, 8 + 1, 1, 0]
+BIN_FIRST_SHIFT = 17
+BIN_NEXT_SHIFT = 3
+MAXEND_STANDARD = 512 * 1024 * 1024
+# First bin of the extended scheme
+EXTENDED_OFFSET = 4681
+
+# Start and end columns of the rows of each table, whose bins are
+# computed from them
+RANGE_COLUMNS = dict([
+    ('refGene', ('txStart', 'txEnd')),
+    ('cpgIslandExt', ('chromStart', 'chromEnd')),
+    ('cytoBand', ('chromStart', 'chromEnd')),
+    ('gadAll', ('chromStart', 'chromEnd')),
+    ('gwasCatalog', ('chromStart', 'chromEnd')),
+    ('targetScanS', ('chromStart', 'chromEnd')),
+    ('hugo', ('chromStart', 'chromEnd')),
+    ('dgv_Cnv', ('chromStart', 'chromEnd')),
+    ('abParts_IG_T_CelReceptors', ('chromStart', 'chromEnd')),
+    ('mcCarroll_Cnv', ('chromStart', 'chromEnd')),
+    ('conrad_Cnv', ('chromStart', 'chromEnd')),
+    ('genomicSuperDups', ('chromStart', 'chromEnd')),
+] + [('tfbsConsSites' + c, ('chromStart', 'chromEnd'))
+    for c in bundle.TFBS_CHROMS])
+
+# Tables found to have a bin column, by backend and table
+binned = {}
+
+
+"""Bin of a row with 0-based, half-open coordinates [start, end)
+"""
+def binFromRange(start, end):
+    if (end <= MAXEND_STANDARD):
+        offsets = BIN_OFFSETS
+        extra = 0
+    else:
+        offsets = BIN_OFFSETS_EXTENDED
+        extra = EXTENDED_OFFSET
+    start_bin = start >> BIN_FIRST_SHIFT
+    end_bin = (end - 1) >> BIN_FIRST_SHIFT
+    for offset in offsets:
+        if (start_bin == end_bin):
+            return extra + offset + start_bin
+        start_bin = start_bin >> BIN_NEXT_SHIFT
+        end_bin = end_bin >> BIN_NEXT_SHIFT
+    raise ValueError(f"Range {start}-{end} out of range for binning")
+
+
+"""Every bin a row overlapping [start, end) can be in, as UCSC queries
+   them: all levels of the scheme, plus the top extended bin
+"""
+def binsForRange(start, end):
+    start = max(0, start)
+    end = max(start + 1, end)
+    bins = []
+    if (end <= MAXEND_STANDARD):
+        offsets = BIN_OFFSETS
+        extra = 0
+    else:
+        offsets = BIN_OFFSETS_EXTENDED
+        extra = EXTENDED_OFFSET
+    start_bin = start >> BIN_FIRST_SHIFT
+    end_bin = (end - 1) >> BIN_FIRST_SHIFT
+    for offset in offsets:
+        bins.extend(range(extra + offset + start_bin,
+            extra + offset + end_bin + 1))
+        start_bin = start_bin >> BIN_NEXT_SHIFT
+        end_bin = end_bin >> BIN_NEXT_SHIFT
+    if (extra == 0):
+        bins.append(EXTENDED_OFFSET)
+    return bins
+
+
+"""Predicate selecting the bins of rows that may contain a position
+   between low and high, compared as start <= position <= end, with the
+   bins it binds. Rows are binned on [start, end), so the range is
+   widened by a base each side
+"""
+def binSql(low, high, column='bin'):
+    bins = binsForRange(low - 1, high + 1)
+    return column + ' IN (' + ','.join(['%s'] * len(bins)) + ')', bins
+
+
+def hasBin(cursor, table):
+    cursor.execute('select * from ' + table + ' limit 0;')
+    return ('bin' in [str(d[0]).lower() for d in cursor.description])
+
+
+"""Whether a table of a backend has a bin column, checked once per process
+"""
+def isBinned(conn, backend, table):
+    key = (backend, table)
+    if key not in binned:
+        cursor = conn.cursor()
+        binned[key] = hasBin(cursor, table)
+        cursor.close()
+    return binned[key]
+
+
+"""Columns of the index range queries on a binned table need: the
+   chromosome column (unless the table holds one chromosome) and bin
+"""
+def indexColumns(indexes):
+    first = indexes[0][0]
+    if first.lower() in ['chromstart', 'start']:
+        return ('bin',)
+    return (first, 'bin')
+
+
+"""Whether some index of a MySQL table starts with the given columns
+"""
+def hasIndex(conn, table, columns):
+    cursor = conn.cursor()
+    cursor.execute('select index_name, seq_in_index, column_name from ' +
+        'information_schema.statistics where table_schema = database() ' +
+        'and table_name = %s order by index_name, seq_in_index;', (table,))
+    found = {}
+    for name, seq, column in cursor.fetchall():
+        found.setdefault(name, []).append(str(column).lower())
+    cursor.close()
+    wanted = [x.lower() for x in columns]
+    return any([x[0:len(wanted)] == wanted for x in found.values()])
+
+
+"""Rows of a sample whose bin does not match their coordinates; range
+   queries would miss them
+"""
+def badBins(conn, table, start_col, end_col, sample=1000):
+    cursor = conn.cursor()
+    cursor.execute('select bin, ' + start_col + ', ' + end_col + ' from ' +
+        table + ' limit ' + str(int(sample)) + ';')
+    bad = [row for row in cursor.fetchall()
+        if (int(row[0]) != binFromRange(int(row[1]), int(row[2])))]
+    cursor.close()
+    return bad
+
+
+"""Checks every binned table of the pipeline, creating missing indexes
+   when create is set
+"""
+def verify(conn, create=False):
+    for table, indexes in bundle.TABLES:
+        cursor = conn.cursor()
+        if not hasBin(cursor, table):
+            cursor.close()
+            continue
+        cursor.close()
+
+        if table in RANGE_COLUMNS:
+            start_col, end_col = RANGE_COLUMNS[table]
+            bad = badBins(conn, table, start_col, end_col)
+            if (len(bad) > 0):
+                print(f"{table}: {len(bad)} sampled rows have the wrong " +
+                    f"bin, e.g. {bad[0]}; set UcscBins = false")
+        else:
+            print(f"{table}: range columns unknown, bins not checked")
+
+        columns = indexColumns(indexes)
+        if hasIndex(conn, table, columns):
+            print(f"{table}: index on {', '.join(columns)} found")
+        elif create:
+            cursor = conn.cursor()
+            cursor.execute('create index ix_' + '_'.join(columns) + ' on ' +
+                table + ' (' + ', '.join(columns) + ');')
+            cursor.close()
+            conn.commit()
+            print(f"{table}: created index on {', '.join(columns)}")
+        else:
+            print(f"{table}: no index on {', '.join(columns)}; " +
+                "run with --create")
+
+
+if __name__ == '__main__':
+    conn = u.mysql_connect()
+    try:
+        verify(conn, create=('--create' in sys.argv[1:]))
+    finally:
+        conn.close()
+
+### EOF
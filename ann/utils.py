@@ -12,22 +12,55 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 
 import os
-import json
+import sys
 import pymysql
-import boto3
 from botocore.exceptions import ClientError
 
+import bundle
+
+# Secrets cache shared with the utilities
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    os.path.pardir, 'util'))
+import secrets_cache
+
+# Get configuration
+from configparser import ConfigParser
+config = ConfigParser(os.environ)
+config.read(os.path.join(os.path.abspath(os.path.dirname(__file__)),
+    'ann_config.ini'))
+
+
 """Get connection to reference database
+   The local reference bundle when [ann] DefaultSource is bundle, and the
+   shared RDS database otherwise
 """
 def db_connect():
+    if (config.get('ann', 'DefaultSource', fallback='mysql') == 'bundle'):
+        return connect('bundle')
+    return connect('mysql')
+
+
+"""Get connection to a database backend: 'mysql' (RDS) or 'bundle'
+   (the local reference bundle at [ann] Bundle)
+"""
+def connect(backend='mysql'):
+    if (backend == 'bundle'):
+        return bundle.connect(config.get('ann', 'Bundle'))
+    return mysql_connect()
+
+
+"""Get connection to the RDS annotator database
+   Credentials come from the process-wide secrets cache; if they are
+   rejected (the secret was rotated) they are fetched again once
+"""
+def mysql_connect(retry=True):
     AWS_REGION_NAME = os.environ['AWS_REGION_NAME'] if \
         ('AWS_REGION_NAME' in  os.environ) else "us-east-1"
 
     # Get RDS secret from AWS Secrets Manager
-    asm = boto3.client('secretsmanager', region_name=AWS_REGION_NAME)
     try:
-        asm_response = asm.get_secret_value(SecretId='rds/anntools_database')
-        rds_secret = json.loads(asm_response['SecretString'])
+        rds_secret = secrets_cache.get_secret('rds/anntools_database',
+            region_name=AWS_REGION_NAME)
     except ClientError as e:
         print(f"Unable to retrieve RDS credentials from AWS Secrets Manager: {e}")
         raise e
@@ -40,12 +73,19 @@ def db_connect():
     database_name = 'annotator'
 
     # Return a connection to the database
-    return pymysql.connect(
-        host=rds_host,
-        port=mysql_port,
-        user=username,
-        passwd=password,
-        db=database_name)
+    try:
+        return pymysql.connect(
+            host=rds_host,
+            port=mysql_port,
+            user=username,
+            passwd=password,
+            db=database_name)
+    except pymysql.err.OperationalError as e:
+        # 1045: access denied
+        if (not retry or e.args[0] != 1045):
+            raise e
+        secrets_cache.invalidate('rds/anntools_database')
+        return mysql_connect(retry=False)
 
 
 """Column inices for pileup and VCF
@@ -0,0 +1,210 @@
+# workers.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Warm annotation workers: processes forked once, with the pipeline's
+# modules, reference caches, database connections and AWS clients loaded,
+# that the annotators hand jobs to over a local queue instead of starting
+# python run.py for every job
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import traceback
+
+import utils as u
+import dbpool
+import driver
+import sources as src
+import run
+
+
+"""Database backends the configured sources read from
+"""
+def backends():
+    router = src.configured()
+    return set([router.load] + [backend for backend in
+        [router.default] + list(router.tables.values())
+        if backend in ['mysql', 'bundle']])
+
+
+"""Builds the reference caches the stages keep per process (interval
+   indexes, gene structures, Bloom filters) by annotating a copy of vcf
+   once; run before the workers are forked, so they start with the caches
+   and share them with this process copy-on-write
+"""
+def preload(vcf):
+    if not vcf:
+        return
+    tmp = tempfile.mkdtemp()
+    try:
+        infile = os.path.join(tmp, os.path.basename(vcf))
+        shutil.copy(vcf, infile)
+        driver.run(infile, 'vcf')
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+"""Opens what each worker keeps for all its jobs: a pooled connection to
+   every configured database backend and the AWS clients run_job uses
+"""
+def warm():
+    for backend in backends():
+        with dbpool.connection(backend):
+            pass
+    run.aws_client('s3')
+    run.aws_client('sns')
+    run.aws_client('dynamodb', resource=True)
+
+
+"""Worker loop: runs jobs from the jobs queue until it gets None. Each
+   job is reported on the done queue when it starts, as ('start', job_id,
+   pid), and when it ends, as ('done', job_id, error or None). A worker
+   that cannot warm up still serves, connecting when jobs need to
+"""
+def serve(jobs, done):
+    try:
+        warm()
+    except Exception as e:
+        print(f"Worker {os.getpid()} could not warm up: {e}")
+    for job in iter(jobs.get, None):
+        done.put(('start', job[1], os.getpid()))
+        try:
+            run.run_job(*job, close_connections=False)
+            done.put(('done', job[1], None))
+        except Exception:
+            done.put(('done', job[1], traceback.format_exc()))
+    dbpool.closeAll()
+
+
+"""Pool of warm workers, started from the [ann] JobWorkers (0 = one per
+   core) and WarmupVcf settings
+   Workers are forked after the preload and replaced if they die; jobs
+   wait on the queue until a worker is free. running maps the jobs
+   submitted and not yet done to the pid of the worker running them (None
+   while queued), and owners to the user they were submitted for; changed
+   is notified when a job ends
+"""
+class WorkerPool(object):
+    def __init__(self, size=None, warmup=None):
+        if size is None:
+            size = u.config.getint('ann', 'JobWorkers', fallback=0)
+        if warmup is None:
+            warmup = u.config.get('ann', 'WarmupVcf', fallback='').strip()
+        self.size = size if (size > 0) else os.cpu_count()
+        self.context = multiprocessing.get_context('fork')
+        self.jobs = self.context.Queue()
+        # Written without a feeder thread, so a worker killed mid-job has
+        # already reported the job it started
+        self.done = self.context.SimpleQueue()
+        self.lock = threading.Lock()
+        self.running = {}
+        self.owners = {}
+        self.changed = threading.Condition(self.lock)
+
+        preload(warmup)
+        self.workers = [self.spawn() for i in range(0, self.size)]
+        self.reporter = threading.Thread(target=self.report, daemon=True)
+        self.reporter.start()
+
+    def spawn(self):
+        worker = self.context.Process(target=serve,
+            args=(self.jobs, self.done))
+        worker.start()
+        return worker
+
+    """Replaces workers that exited, e.g. killed running out of memory;
+       the job a worker was running is lost with it, and marked FAILED as
+       its message is already deleted. Replacements are forked, and jobs
+       marked, without holding the lock, which the reporter thread takes
+    """
+    def respawn(self):
+        lost = []
+        with self.lock:
+            dead = [i for i in range(0, len(self.workers))
+                if (self.workers[i] is not None and
+                    not self.workers[i].is_alive())]
+            for i in dead:
+                worker = self.workers[i]
+                print(f"Worker {worker.pid} exited " +
+                    f"({worker.exitcode}), replacing it")
+                for job_id in [x for x in self.running
+                    if (self.running[x] == worker.pid)]:
+                    print(f"Annotation job {job_id} lost")
+                    del self.running[job_id]
+                    self.owners.pop(job_id, None)
+                    lost.append(job_id)
+                # Empty while its replacement is forked, so other callers
+                # leave the slot alone
+                self.workers[i] = None
+            if (len(dead) > 0):
+                self.changed.notify_all()
+
+        for i in dead:
+            worker = self.spawn()
+            with self.lock:
+                self.workers[i] = worker
+        for job_id in lost:
+            try:
+                run.fail_job(job_id)
+            except Exception as e:
+                print(f"Annotation job {job_id} not marked failed: {e}")
+
+    def submit(self, input_file, job_id, user_id, email):
+        self.respawn()
+        with self.lock:
+            self.running[job_id] = None
+            self.owners[job_id] = user_id
+        self.jobs.put((input_file, job_id, user_id, email))
+
+    """Jobs submitted and not yet done
+    """
+    def busy(self):
+        with self.lock:
+            return len(self.running)
+
+    """Jobs submitted and not yet done, per user
+    """
+    def users(self):
+        with self.lock:
+            counts = {}
+            for user_id in self.owners.values():
+                counts[user_id] = counts.get(user_id, 0) + 1
+            return counts
+
+    """Waits until a job ends, or timeout seconds
+    """
+    def wait(self, timeout=None):
+        with self.lock:
+            self.changed.wait(timeout)
+
+    def report(self):
+        for event, job_id, detail in iter(self.done.get, None):
+            with self.lock:
+                if (event == 'start'):
+                    if job_id in self.running:
+                        self.running[job_id] = detail
+                    continue
+                self.running.pop(job_id, None)
+                self.owners.pop(job_id, None)
+                self.changed.notify_all()
+            if detail is None:
+                print(f"Annotation job {job_id} completed")
+            else:
+                print(f"Annotation job {job_id} failed\n{detail}")
+
+    def close(self):
+        for worker in self.workers:
+            self.jobs.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.done.put(None)
+        self.reporter.join()
+
+### EOF
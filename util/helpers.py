@@ -13,16 +13,20 @@ import json
 import boto3
 from botocore.exceptions import ClientError
 
+import secrets_cache
+
 # Get util configuration
 from configparser import ConfigParser
 config = ConfigParser(os.environ)
 config.read(os.path.join(os.path.abspath(os.path.dirname(__file__)), 'util_config.ini'))
 
-"""Send email via Amazon SES
+"""Send email via Amazon SES, through the given SES client or a new one
 """
-def send_email_ses(recipients=None, sender=None, subject=None, body=None):
+def send_email_ses(recipients=None, sender=None, subject=None, body=None,
+  ses=None):
 
-  ses = boto3.client('ses', region_name=config['aws']['AwsRegionName'])
+  if ses is None:
+    ses = boto3.client('ses', region_name=config['aws']['AwsRegionName'])
 
   try:
     response = ses.send_email(
@@ -46,11 +50,10 @@ import psycopg2.extras
 """Access user profile in accounts database
 """
 def get_user_profile(id=None, db_name=None):
-  # Get database connection details from AWS Secrets Manager
-  asm = boto3.client('secretsmanager', region_name=config['aws']['AwsRegionName'])
+  # Get database connection details from AWS Secrets Manager (cached)
   try:
-    asm_response = asm.get_secret_value(SecretId='rds/accounts_database')
-    rds_secret = json.loads(asm_response['SecretString'])
+    rds_secret = secrets_cache.get_secret('rds/accounts_database',
+      region_name=config['aws']['AwsRegionName'])
   except ClientError as e:
     raise e
 
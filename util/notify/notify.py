@@ -12,6 +12,7 @@ import time
 import os
 import sys
 import json
+from concurrent.futures import ThreadPoolExecutor
 import psycopg2
 from botocore.exceptions import ClientError
 import botocore
@@ -29,27 +30,26 @@ config.read('notify_config.ini')
 region_name = config['aws']['AwsRegionName']
 queue_url = config['sqs']['URL']
 
-'''Capstone - Exercise 3(d)
-Reads result messages from SQS and sends notification emails.
+# Messages taken per receive (at most 10), and seconds a receive waits
+# for messages when the queue was found empty
+max_messages = min(10, config.getint('sqs', 'MaxMessages', fallback=10))
+wait_time = config.getint('sqs', 'WaitTime', fallback=20)
+
+# Notifications of a batch are sent concurrently, through one SES client
+# created up front: clients can be shared between threads, but creating
+# them at once on the default session is not safe
+senders = ThreadPoolExecutor(max_workers=max_messages)
+ses = boto3.client('ses', region_name = region_name)
+
+'''Sends the notification email of one result message; returns the
+message's receipt handle once sent, or None to leave it to be received
+again
 '''
-def handle_results_queue(sqs=None):
-  # Read a message from the queue
-  response = sqs.receive_message(
-    QueueUrl = queue_url,
-    AttributeNames=[
-        'SentTimestamp'
-    ],
-    MaxNumberOfMessages=1,
-    MessageAttributeNames=[
-        'All'
-    ],
-    WaitTimeSeconds=20
-  )
-  # print(response)
-  if 'Messages' in response:
+def send_notification(message):
+  try:
     # Parse the message
-    Message_body = json.loads(response['Messages'][0]['Body'])
-    receipt_handle = response['Messages'][0]['ReceiptHandle']
+    Message_body = json.loads(message['Body'])
+    receipt_handle = message['ReceiptHandle']
     Message = json.loads(Message_body['Message'])
     print(Message)
     # Get the information from message
@@ -60,19 +60,50 @@ def handle_results_queue(sqs=None):
     user_id = Message['user_id']
     recipients = helpers.get_user_profile(user_id)[4]
     # recipients = Message['recipients']
-    
+
     # Process message
-    send_response = helpers.send_email_ses(recipients = recipients, sender=None, subject = subject, body = body)
+    send_response = helpers.send_email_ses(recipients = recipients, sender=None, subject = subject, body = body, ses = ses)
     print(send_response)
+  except Exception as e:
+    print("Notification failed!", message.get('MessageId'), e)
+    return None
+  return receipt_handle
 
-    # Delete message
-    sqs.delete_message(
+'''Capstone - Exercise 3(d)
+Reads result messages from SQS and sends notification emails.
+Takes up to max_messages per receive and waits wait seconds for them;
+returns how many it received.
+'''
+def handle_results_queue(sqs=None, wait=wait_time):
+  # Read messages from the queue
+  response = sqs.receive_message(
+    QueueUrl = queue_url,
+    AttributeNames=[
+        'SentTimestamp'
+    ],
+    MaxNumberOfMessages=max_messages,
+    MessageAttributeNames=[
+        'All'
+    ],
+    WaitTimeSeconds=wait
+  )
+  # print(response)
+  messages = response.get('Messages', [])
+  if (len(messages) == 0):
+    return 0
+
+  # Send the notifications, then delete the messages of those sent
+  handles = list(senders.map(send_notification, messages))
+  entries = [{'Id': str(i), 'ReceiptHandle': handles[i]}
+    for i in range(0, len(handles)) if handles[i] is not None]
+  if (len(entries) > 0):
+    deleted = sqs.delete_message_batch(
       QueueUrl =queue_url,
-      ReceiptHandle=receipt_handle
+      Entries=entries
     )
-
-
-  pass
+    for failed in deleted.get('Failed', []):
+      print("Delete message failed!", failed)
+  return len(messages)
 
 if __name__ == '__main__':
   
@@ -81,7 +112,11 @@ if __name__ == '__main__':
   # Poll queue for new results and process them
   sqs = boto3.client('sqs', region_name = region_name)
 
+  # A full batch means more are waiting: receive again without waiting
+  # while the queue drains, and long poll once it comes back empty
+  wait = wait_time
   while True:
-    handle_results_queue(sqs=sqs)
+    received = handle_results_queue(sqs=sqs, wait=wait)
+    wait = 0 if (received == max_messages) else wait_time
 
 ### EOF
@@ -0,0 +1,183 @@
+# secrets_cache.py
+#
+# Copyright (C) 2011-2021 Vas Vasiliadis
+# University of Chicago
+#
+# Process-wide cache of AWS Secrets Manager secrets
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import json
+import time
+import threading
+import boto3
+
+# Encrypting the warm cache file needs the cryptography package; without
+# it (or without a key) secrets are only cached in memory
+try:
+  from cryptography.fernet import Fernet, InvalidToken
+except ImportError:
+  Fernet = None
+
+# Settings, from the environment so the web app, the annotator and the
+# utilities configure the cache the same way
+TTL = int(os.environ.get('GAS_SECRETS_TTL', 3600))
+REFRESH_AHEAD = int(os.environ.get('GAS_SECRETS_REFRESH_AHEAD', 300))
+CACHE_FILE = os.environ.get('GAS_SECRETS_CACHE_FILE')
+CACHE_KEY = os.environ.get('GAS_SECRETS_CACHE_KEY')
+
+cache = None
+cache_lock = threading.Lock()
+
+
+"""Secrets Manager secrets held for ttl seconds
+Secrets are parsed from JSON once and shared by every caller in the
+process. A secret read within refresh_ahead seconds of expiring is
+refreshed in a background thread while the cached value is returned, so
+callers only wait on Secrets Manager the first time (or after a refresh
+has failed until expiry). With a cache file and a Fernet key, secrets are
+also kept encrypted on disk so that a new process starts warm.
+"""
+class SecretsCache(object):
+  def __init__(self, region_name='us-east-1', ttl=TTL,
+    refresh_ahead=REFRESH_AHEAD, cache_file=CACHE_FILE, cache_key=CACHE_KEY):
+
+    self.region_name = region_name
+    self.ttl = ttl
+    self.refresh_ahead = min(refresh_ahead, ttl)
+    self.cache_file = cache_file
+    self.fernet = Fernet(cache_key) \
+      if (cache_file and cache_key and Fernet is not None) else None
+    self.secrets = {}
+    self.forked()
+    self.hits = 0
+    self.misses = 0
+    self.refreshes = 0
+    self.load()
+
+  """Locks and refresh threads do not survive a fork; a child starts its
+  own with the secrets it inherited
+  """
+  def forked(self):
+    self.pid = os.getpid()
+    self.lock = threading.Lock()
+    self.refreshing = set([])
+    self.asm = None
+
+  """Secrets Manager client, on a session of its own: callers on several
+  threads may create it at once, which the default session is not safe for
+  """
+  def client(self):
+    if self.asm is None:
+      self.asm = boto3.session.Session().client('secretsmanager',
+        region_name=self.region_name)
+    return self.asm
+
+  def fetch(self, secret_id):
+    response = self.client().get_secret_value(SecretId=secret_id)
+    value = json.loads(response['SecretString'])
+    with self.lock:
+      self.secrets[secret_id] = (value, time.time())
+    self.save()
+    return value
+
+  def refresh(self, secret_id):
+    try:
+      self.fetch(secret_id)
+      self.refreshes = self.refreshes + 1
+    except Exception as e:
+      print(f"Unable to refresh secret {secret_id}: {e}")
+    finally:
+      with self.lock:
+        self.refreshing.discard(secret_id)
+
+  """Secret as a dict; raises ClientError as get_secret_value does
+  """
+  def get(self, secret_id):
+    if (self.pid != os.getpid()):
+      self.forked()
+
+    with self.lock:
+      entry = self.secrets.get(secret_id)
+      age = (time.time() - entry[1]) if (entry is not None) else None
+      if (entry is not None and age < self.ttl):
+        self.hits = self.hits + 1
+        if (age >= self.ttl - self.refresh_ahead and
+          secret_id not in self.refreshing):
+          self.refreshing.add(secret_id)
+          threading.Thread(target=self.refresh, args=(secret_id,),
+            daemon=True).start()
+        return entry[0]
+      self.misses = self.misses + 1
+
+    return self.fetch(secret_id)
+
+  """Drops a secret, e.g. after its credentials were rejected because it
+  was rotated; the next get() fetches it again
+  """
+  def invalidate(self, secret_id):
+    with self.lock:
+      self.secrets.pop(secret_id, None)
+    self.save()
+
+  def load(self):
+    if (self.fernet is None or not os.path.exists(self.cache_file)):
+      return
+    try:
+      with open(self.cache_file, 'rb') as fh:
+        saved = json.loads(self.fernet.decrypt(fh.read(), ttl=self.ttl))
+    except (InvalidToken, ValueError, OSError) as e:
+      print(f"Ignoring secrets cache {self.cache_file}: {e}")
+      return
+    now = time.time()
+    for secret_id in saved:
+      value, fetched = saved[secret_id]
+      if (now - fetched < self.ttl):
+        self.secrets[secret_id] = (value, fetched)
+
+  """Writes the secrets, encrypted, to the cache file; readable by the
+  owner only and replaced atomically so readers never see a partial file
+  """
+  def save(self):
+    if self.fernet is None:
+      return
+    with self.lock:
+      saved = dict([(k, list(v)) for k, v in self.secrets.items()])
+    token = self.fernet.encrypt(json.dumps(saved).encode())
+    tmp_file = f"{self.cache_file}.{os.getpid()}.tmp"
+    try:
+      fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+      with os.fdopen(fd, 'wb') as fh:
+        fh.write(token)
+      os.replace(tmp_file, self.cache_file)
+    except OSError as e:
+      print(f"Unable to write secrets cache {self.cache_file}: {e}")
+
+  def stats(self):
+    return {'secrets': len(self.secrets), 'hits': self.hits,
+      'misses': self.misses, 'refreshes': self.refreshes}
+
+
+"""The process-wide cache
+"""
+def get_cache(region_name='us-east-1'):
+  global cache
+  with cache_lock:
+    if cache is None:
+      cache = SecretsCache(region_name=region_name)
+    return cache
+
+
+"""Get a secret (parsed from its JSON string) through the process-wide cache
+"""
+def get_secret(secret_id, region_name='us-east-1'):
+  return get_cache(region_name=region_name).get(secret_id)
+
+
+def invalidate(secret_id):
+  if cache is not None:
+    cache.invalidate(secret_id)
+
+### EOF
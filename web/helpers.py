@@ -87,4 +87,34 @@ def get_portal_tokens(scopes=None):
 get_portal_tokens.lock = Lock()
 get_portal_tokens.access_tokens = None
 
+# Length assumed for VCF data lines when a sample has none to measure
+DEFAULT_LINE_BYTES = 100
+
+"""Size in bytes of a VCF input object and an estimate of its variant
+count, from the data lines in its first sample_bytes: (size - header) /
+average data line length. Headers longer than the sample are taken to end
+with it, and lines to be DEFAULT_LINE_BYTES long
+"""
+def estimate_variant_count(s3, bucket, key, sample_bytes=65536):
+  size = s3.head_object(Bucket=bucket, Key=key)['ContentLength']
+  if (size == 0):
+    return 0, 0
+  sample = s3.get_object(Bucket=bucket, Key=key,
+    Range='bytes=0-' + str(sample_bytes - 1))['Body'].read()
+  lines = sample.split(b'\n')
+  if (len(sample) < size):
+    # The last line of the sample is cut off
+    lines = lines[:-1]
+
+  header = 0
+  data = []
+  for line in lines:
+    if (len(data) == 0 and line.startswith(b'#')):
+      header = header + len(line) + 1
+    elif (len(line.strip()) > 0):
+      data.append(len(line) + 1)
+
+  line_bytes = (sum(data) / len(data)) if data else DEFAULT_LINE_BYTES
+  return size, max(len(data), int(round((size - header) / line_bytes)))
+
 ### EOF
\ No newline at end of file
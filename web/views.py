@@ -23,6 +23,7 @@ from flask import (abort, flash, redirect, render_template,
 
 from app import app, db
 from decorators import authenticated, is_premium
+from helpers import estimate_variant_count
 
 from auth import get_profile
 
@@ -109,6 +110,21 @@ def create_annotation_job_request():
   file_name = s3_key[index2+1 : ]
   user_id = session.get('primary_identity')
   submit_time = int(time.time())
+  profile = get_profile(identity_id = user_id)
+
+  # Premium users' jobs are scheduled ahead of free users' jobs
+  priority = 'premium' if (profile.role == 'premium_user') else 'free'
+
+  # The annotator starts the jobs expected to be shortest first
+  s3 = boto3.client('s3',
+    region_name=app.config['AWS_REGION_NAME'],
+    config=Config(signature_version='s3v4'))
+  try:
+    input_size, estimated_variants = \
+      estimate_variant_count(s3, bucket_name, s3_key)
+  except ClientError as error:
+    app.logger.error(f"Unable to estimate the size of {s3_key}: {error}")
+    input_size = estimated_variants = None
 
   # Persist job to database
   data = { "job_id": job_id,
@@ -117,8 +133,12 @@ def create_annotation_job_request():
           "s3_inputs_bucket": bucket_name,
           "s3_key_input_file": s3_key,
           "submit_time": submit_time,
-          "job_status": "PENDING"
+          "job_status": "PENDING",
+          "priority": priority
         }
+  if input_size is not None:
+    data['input_size'] = input_size
+    data['estimated_variants'] = estimated_variants
   # ref: https://boto3.amazonaws.com/v1/documentation/api/latest/guide/dynamodb.html -> Creating a new item
   dynamodb = boto3.resource('dynamodb', region_name=app.config['AWS_REGION_NAME'], config=Config(signature_version='s3v4'))
   table_name = app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE']
@@ -144,12 +164,16 @@ def create_annotation_job_request():
   client = boto3.client('sns', 
     region_name=app.config['AWS_REGION_NAME'], 
     config=Config(signature_version='s3v4'))
-  profile = get_profile(identity_id = user_id)
   data['email'] = profile.email
   tpic_arn = app.config['AWS_SNS_JOB_REQUEST_TOPIC']
+  # The priority attribute lets subscription filter policies route premium
+  # and free jobs to separate queues
   response = client.publish(
     TopicArn = tpic_arn,
-    Message = json.dumps(data)
+    Message = json.dumps(data),
+    MessageAttributes = {
+      'priority': {'DataType': 'String', 'StringValue': priority}
+    }
   )
 
   return render_template('annotate_confirm.html', job_id=job_id)